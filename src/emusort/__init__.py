@@ -22,4 +22,49 @@ __version__ = version()  # Dynamically retrieve the version
 
 from .emusort import main  # Import the main function or class
 
-__all__ = ["main", "__version__"]  # Expose main and version
+# Python API, to run the pipeline in a long-lived process without reloading data
+from .emusort import (
+    compare_result_folders,
+    compare_scoring_methods,
+    compute_template_unit_metrics,
+    export_result_folders,
+    extract_waveforms_in_memory,
+    compute_unit_metrics,
+    get_emusort_scores,
+    load_config,
+    load_ephys_data,
+    load_result_folder,
+    plan_sorting,
+    prepare_group_recording,
+    prepare_group_recordings,
+    preprocess_ephys_data,
+    rescore_result_folder,
+    rescore_result_folders,
+    run_sort,
+    score_sorting,
+    sort_group,
+)
+
+__all__ = [
+    "main",
+    "__version__",
+    "load_config",
+    "load_ephys_data",
+    "preprocess_ephys_data",
+    "prepare_group_recording",
+    "prepare_group_recordings",
+    "plan_sorting",
+    "run_sort",
+    "sort_group",
+    "extract_waveforms_in_memory",
+    "compute_unit_metrics",
+    "compute_template_unit_metrics",
+    "get_emusort_scores",
+    "score_sorting",
+    "load_result_folder",
+    "rescore_result_folder",
+    "rescore_result_folders",
+    "export_result_folders",
+    "compare_result_folders",
+    "compare_scoring_methods",
+]  # Expose main, version and the Python API
@@ -5,16 +5,23 @@ if sys.version_info < (3, 9):
         "Error: Your Python version is not supported. Please use Python 3.9 or later."
     )
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 start_time = datetime.now()  # include imports in time cost
 
 import argparse
 import asyncio
+import hashlib
+import inspect
+import json
 import os
 import platform
 import shutil
 import subprocess
+import threading
+import time
+import warnings
+import weakref
 from copy import deepcopy
 from pathlib import Path
 from typing import Union
@@ -28,6 +35,10 @@ from probeinterface import Probe
 from ruamel.yaml import YAML
 from sklearn.model_selection import ParameterGrid
 from spikeinterface.core import write_binary_recording
+from spikeinterface.preprocessing.basepreprocessor import (
+    BasePreprocessor,
+    BasePreprocessorSegment,
+)
 from spikeinterface.qualitymetrics.misc_metrics import (
     compute_amplitude_cutoffs,
     compute_firing_ranges,
@@ -163,6 +174,548 @@ def movetree(src, dest):
         shutil.move(str(item), str(dest))
 
 
+def open_recording_files(
+    files: list, read_function, num_workers: int
+) -> si.BaseRecording:
+    """
+    Opens multiple recording files in parallel and appends them in the given order, after checking
+    that their sampling rates, channels and data types match.
+
+    Parameters:
+    - files: list - The paths of the recording files, in the order they should be appended.
+    - read_function: callable - Function which opens a single file path as a recording.
+    - num_workers: int - The maximum number of files opened at once.
+
+    Returns:
+    - si.BaseRecording: The appended recording, with one segment per file.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # opening is mostly waiting on file headers, so threads are enough
+    num_workers = max(1, min(num_workers, len(files)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        recording_list = list(executor.map(read_function, files))
+
+    # check all files against the first one in a single pass
+    reference = recording_list[0]
+    mismatches = []
+    for this_file, this_recording in zip(files[1:], recording_list[1:]):
+        if (
+            this_recording.get_sampling_frequency()
+            != reference.get_sampling_frequency()
+        ):
+            mismatches.append(
+                f"{Path(this_file).name}: sampling rate {this_recording.get_sampling_frequency()} Hz "
+                f"!= {reference.get_sampling_frequency()} Hz"
+            )
+        if not np.array_equal(
+            this_recording.get_channel_ids(), reference.get_channel_ids()
+        ):
+            mismatches.append(
+                f"{Path(this_file).name}: {this_recording.get_num_channels()} channels "
+                "do not match the channels of the first file"
+            )
+        if this_recording.get_dtype() != reference.get_dtype():
+            mismatches.append(
+                f"{Path(this_file).name}: dtype {this_recording.get_dtype()} != {reference.get_dtype()}"
+            )
+    if mismatches:
+        raise ValueError(
+            f"Recording files do not match the first file, {Path(files[0]).name}:\n"
+            + "\n".join(mismatches)
+        )
+    return si.append_recordings(recording_list)
+
+
+class PrefetchRecordingSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, num_chunks, chunk_frames, num_threads):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.num_chunks = num_chunks
+        self.chunk_frames = chunk_frames
+        self.num_threads = num_threads
+        self.num_frames = parent_recording_segment.get_num_samples()
+        self.total_chunks = -(-self.num_frames // chunk_frames)
+        # chunk index -> [future with the traces of all channels, whether it was read]
+        self.chunks = {}
+        self.last_read = None  # (first, last) chunk of the previous read
+        self.lock = threading.Lock()
+        self.executor = None
+        self.finalizer = None
+        self.stats = {"hits": 0, "misses": 0, "prefetched": 0, "unused": 0}
+
+    def stop_prefetch(self):
+        # discards the chunks read ahead and stops the threads, later reads start them again
+        with self.lock:
+            for future, was_read in self.chunks.values():
+                if not was_read:
+                    future.cancel()
+                    self.stats["unused"] += 1
+            self.chunks.clear()
+            self.last_read = None
+            if self.finalizer is not None:
+                self.finalizer()
+            self.executor = None
+            self.finalizer = None
+
+    def read_chunk(self, chunk_index):
+        start_frame = chunk_index * self.chunk_frames
+        end_frame = min(start_frame + self.chunk_frames, self.num_frames)
+        return self.parent_recording_segment.get_traces(start_frame, end_frame, None)
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        from concurrent.futures import Future, ThreadPoolExecutor
+
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.num_frames
+        if end_frame <= start_frame:
+            return self.parent_recording_segment.get_traces(
+                start_frame, end_frame, channel_indices
+            )
+        first = start_frame // self.chunk_frames
+        last = (end_frame - 1) // self.chunk_frames
+
+        missed = []
+        with self.lock:
+            # reads which start within or right after the previous read are sequential,
+            # like the chunked reads of filters, which overlap by their margins
+            is_sequential = (
+                self.last_read is not None
+                and self.last_read[0] <= first <= self.last_read[1] + 1
+            )
+            # keep only the chunks of this read and those read ahead of it
+            for chunk_index in list(self.chunks):
+                if chunk_index < first or (not is_sequential and chunk_index > last):
+                    future, was_read = self.chunks.pop(chunk_index)
+                    if not was_read:
+                        future.cancel()
+                        self.stats["unused"] += 1
+            futures = []
+            for chunk_index in range(first, last + 1):
+                if chunk_index in self.chunks:
+                    self.stats["hits"] += 1
+                else:
+                    self.stats["misses"] += 1
+                    self.chunks[chunk_index] = [Future(), False]
+                    missed.append((chunk_index, self.chunks[chunk_index][0]))
+                self.chunks[chunk_index][1] = True
+                futures.append(self.chunks[chunk_index][0])
+            # read the next chunks in the background while this read is processed
+            if is_sequential:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.num_threads,
+                        thread_name_prefix="emusort-prefetch",
+                    )
+                    # stop the threads once the segment is garbage collected
+                    self.finalizer = weakref.finalize(
+                        self, self.executor.shutdown, wait=False, cancel_futures=True
+                    )
+                for chunk_index in range(
+                    last + 1, min(last + 1 + self.num_chunks, self.total_chunks)
+                ):
+                    if chunk_index not in self.chunks:
+                        self.chunks[chunk_index] = [
+                            self.executor.submit(self.read_chunk, chunk_index),
+                            False,
+                        ]
+                        self.stats["prefetched"] += 1
+            self.last_read = (first, last)
+
+        # chunks which were not read ahead are read in this thread
+        for chunk_index, future in missed:
+            try:
+                future.set_result(self.read_chunk(chunk_index))
+            except BaseException as e:
+                future.set_exception(e)
+                with self.lock:
+                    if self.chunks.get(chunk_index, [None])[0] is future:
+                        del self.chunks[chunk_index]
+                raise
+
+        offset = first * self.chunk_frames
+        if len(futures) == 1:
+            # copy, so the buffered chunk can not be modified by the caller
+            traces = np.array(
+                futures[0].result()[start_frame - offset : end_frame - offset]
+            )
+        else:
+            traces = np.concatenate([future.result() for future in futures], axis=0)[
+                start_frame - offset : end_frame - offset
+            ]
+        if channel_indices is not None:
+            traces = traces[:, channel_indices]
+        return traces
+
+
+class PrefetchRecording(BasePreprocessor):
+    """
+    Wraps a recording so that sequential chunked reads, such as those of the filters while
+    preprocessed data is saved, read the next chunks of the file in background threads while
+    the current chunk is processed. Chunks of chunk_frames are read for all channels, and at
+    most num_chunks chunks are read ahead of each segment's read position, which bounds the
+    buffer memory. Reads which jump elsewhere discard the chunks read ahead.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording to read ahead from.
+    - num_chunks: int - The number of chunks read ahead of the current read.
+    - chunk_frames: int - The number of frames of each chunk (default: from chunk_duration).
+    - num_threads: int - The number of threads reading ahead for each segment.
+    """
+
+    name = "prefetch"
+
+    def __init__(self, recording, num_chunks=4, chunk_frames=None, num_threads=2):
+        BasePreprocessor.__init__(self, recording)
+        if chunk_frames is None:
+            chunk_frames = get_chunk_frames(recording.get_sampling_frequency())
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(
+                PrefetchRecordingSegment(
+                    parent_segment, num_chunks, chunk_frames, num_threads
+                )
+            )
+        self._kwargs = dict(
+            recording=recording,
+            num_chunks=num_chunks,
+            chunk_frames=chunk_frames,
+            num_threads=num_threads,
+        )
+
+    def stop_prefetch(self):
+        """
+        Stops the read-ahead threads of all segments and frees their buffered chunks, e.g., once
+        the preprocessed data is saved. The recording can still be read, which starts them again.
+        """
+        for segment in self._recording_segments:
+            segment.stop_prefetch()
+
+    def get_prefetch_stats(self) -> dict:
+        """
+        Returns the number of chunks which were already read ahead when requested ("hits"),
+        had to be read on request ("misses"), were read ahead ("prefetched") and were read ahead
+        but discarded before being requested ("unused"), summed over all segments, and the
+        maximum buffer memory of each segment in bytes ("buffer_bytes").
+        """
+        stats = {"hits": 0, "misses": 0, "prefetched": 0, "unused": 0}
+        for segment in self._recording_segments:
+            with segment.lock:
+                for key in stats:
+                    stats[key] += segment.stats[key]
+        # the chunks of the current read and those read ahead of it
+        segment = self._recording_segments[0]
+        stats["buffer_bytes"] = int(
+            (segment.num_chunks + 2)
+            * segment.chunk_frames
+            * self.get_num_channels()
+            * self.get_dtype().itemsize
+        )
+        return stats
+
+
+class ChunkCache:
+    """
+    Thread-safe LRU cache of trace chunks with a limit on their total size in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        from collections import OrderedDict
+
+        self.max_bytes = max_bytes
+        self.chunks = OrderedDict()
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "hit_bytes": 0}
+
+    def get(self, *keys) -> tuple:
+        # returns the first cached chunk of the given keys with its key, or (None, None)
+        with self.lock:
+            for key in keys:
+                traces = self.chunks.get(key)
+                if traces is not None:
+                    self.chunks.move_to_end(key)
+                    self.stats["hits"] += 1
+                    self.stats["hit_bytes"] += traces.nbytes
+                    return traces, key
+            self.stats["misses"] += 1
+            return None, None
+
+    def put(self, key, traces: np.ndarray):
+        if traces.nbytes > self.max_bytes:
+            return
+        # cached chunks are shared by all callers, so they must not be modified
+        traces = np.array(traces)
+        traces.flags.writeable = False
+        with self.lock:
+            if key in self.chunks:
+                return
+            self.chunks[key] = traces
+            self.num_bytes += traces.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.chunks.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "num_chunks": len(self.chunks),
+                "num_bytes": self.num_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+# chunk caches shared by all recordings of this process with the same cache name, which
+# are freed once no recording uses them
+CHUNK_CACHES = weakref.WeakValueDictionary()
+CHUNK_CACHES_LOCK = threading.Lock()
+
+
+def get_chunk_cache(cache_name: str, max_bytes: int) -> ChunkCache:
+    with CHUNK_CACHES_LOCK:
+        cache = CHUNK_CACHES.get(cache_name)
+        if cache is None:
+            cache = CHUNK_CACHES[cache_name] = ChunkCache(max_bytes)
+        return cache
+
+
+class ChunkCacheRecordingSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, cache, segment_index, num_channels):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.cache = cache
+        self.segment_index = segment_index
+        self.num_channels = num_channels
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_samples()
+        if channel_indices is None:
+            channels = None
+        else:
+            channels = tuple(np.arange(self.num_channels)[channel_indices].tolist())
+        key = (self.segment_index, start_frame, end_frame, channels)
+        # chunks read with all channels also serve reads of a subset of channels
+        traces, found_key = self.cache.get(key, key[:3] + (None,))
+        if traces is None:
+            traces = self.parent_recording_segment.get_traces(
+                start_frame, end_frame, channel_indices
+            )
+            self.cache.put(key, traces)
+            return traces
+        # callers may modify the traces they get, so they get a copy of the cached chunk
+        if found_key != key:
+            return np.array(traces[:, list(channels)])
+        return np.array(traces)
+
+
+class ChunkCacheRecording(BasePreprocessor):
+    """
+    Wraps a (lazily preprocessed) recording with an LRU cache of the chunks read from it, so
+    consumers which read the same chunks, such as the extraction tasks of several sorting jobs,
+    share the filtered traces instead of each recomputing them from the raw data. Chunks are
+    keyed by (segment, start frame, end frame, channels), and all ChunkCacheRecordings with the
+    same cache_name in a process share one cache of at most max_bytes.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording to cache the chunks of.
+    - max_bytes: int - The maximum total size of the cached chunks in bytes.
+    - cache_name: str - The name of the shared cache (default: a new cache).
+    """
+
+    name = "chunk_cache"
+
+    def __init__(self, recording, max_bytes=1024**3, cache_name=None):
+        import uuid
+
+        BasePreprocessor.__init__(self, recording)
+        if cache_name is None:
+            cache_name = uuid.uuid4().hex
+        self.cache = get_chunk_cache(cache_name, max_bytes)
+        for segment_index, parent_segment in enumerate(recording._recording_segments):
+            self.add_recording_segment(
+                ChunkCacheRecordingSegment(
+                    parent_segment,
+                    self.cache,
+                    segment_index,
+                    recording.get_num_channels(),
+                )
+            )
+        self._kwargs = dict(
+            recording=recording, max_bytes=max_bytes, cache_name=cache_name
+        )
+
+    def get_cache_stats(self) -> dict:
+        """
+        Returns the number of reads served from the cache ("hits") or read from the recording
+        ("misses"), the bytes served from the cache ("hit_bytes"), the number of chunks evicted
+        ("evictions"), and the current number and size of the cached chunks ("num_chunks",
+        "num_bytes") with the size limit ("max_bytes").
+        """
+        return self.cache.get_stats()
+
+
+FANOUT_MAX_PENDING_CHUNKS = (
+    4  # raw chunks kept for channel groups that have not read them yet
+)
+
+
+class ChunkFanOut:
+    """
+    Shares the raw chunks read by several consumers that read the same windows in the same
+    order, such as the preprocessing of each channel group while all groups are saved at once.
+    Each chunk is read once with all channels and dropped as soon as every consumer read it.
+    Consumers which get more than max_pending chunks ahead of the others wait for them, which
+    bounds the memory of the pending chunks. Reads of other callers pass through.
+
+    Consumers behind the others only read chunks which are pending for them, in order. A consumer
+    which reads any other chunk while chunks are pending for it reads different windows, so it
+    releases its pending chunks and reads on its own, with a warning. The consumers which wait
+    are therefore only held back by consumers which still make progress, and never deadlock.
+    """
+
+    def __init__(self, max_pending: int = FANOUT_MAX_PENDING_CHUNKS):
+        from collections import OrderedDict
+
+        self.max_pending = max_pending
+        self.consumers = set()
+        # chunk key -> [future with the traces of all channels, consumers yet to read it]
+        self.chunks = OrderedDict()
+        self.cond = threading.Condition()
+        self.stats = {"reads": 0, "shared": 0}
+
+    def set_consumers(self, consumers):
+        with self.cond:
+            self.consumers = set(consumers)
+
+    def remove_consumer(self, consumer):
+        # consumers which finish or fail no longer hold back the others
+        with self.cond:
+            self._remove_consumer(consumer)
+
+    def _remove_consumer(self, consumer):
+        self.consumers.discard(consumer)
+        for key in list(self.chunks):
+            self.chunks[key][1].discard(consumer)
+            if not self.chunks[key][1]:
+                del self.chunks[key]
+        self.cond.notify_all()
+
+    def get(self, consumer, key, read_function) -> np.ndarray:
+        from concurrent.futures import Future
+
+        entry, is_reader = None, True
+        with self.cond:
+            is_pending = key in self.chunks and consumer in self.chunks[key][1]
+            if (
+                consumer in self.consumers
+                and not is_pending
+                and any(consumer in waiting for _, waiting in self.chunks.values())
+            ):
+                # the consumer skipped chunks pending for it, so it reads different windows
+                warnings.warn(
+                    f"Consumer {consumer} reads different chunks than the others, "
+                    "so it reads them separately."
+                )
+                self._remove_consumer(consumer)
+            # only consumers with no pending chunks wait, for those behind them
+            self.cond.wait_for(
+                lambda: consumer not in self.consumers
+                or key in self.chunks
+                or len(self.chunks) < self.max_pending
+            )
+            if consumer in self.consumers:
+                entry = self.chunks.get(key)
+                is_reader = entry is None or consumer not in entry[1]
+                if is_reader:
+                    entry = [Future(), self.consumers - {consumer}]
+                    if entry[1]:
+                        self.chunks[key] = entry
+                    self.stats["reads"] += 1
+                else:
+                    entry[1].discard(consumer)
+                    if not entry[1]:
+                        del self.chunks[key]
+                        self.cond.notify_all()
+                    self.stats["shared"] += 1
+        if entry is None:
+            return read_function()
+        if is_reader:
+            try:
+                entry[0].set_result(read_function())
+            except BaseException as e:
+                entry[0].set_exception(e)
+                raise
+        return entry[0].result()
+
+    def get_stats(self) -> dict:
+        with self.cond:
+            return dict(self.stats)
+
+
+# fan-outs shared by the recordings of all channel groups, freed once no recording uses them
+CHUNK_FANOUTS = weakref.WeakValueDictionary()
+
+
+def get_chunk_fanout(fanout_name: str) -> ChunkFanOut:
+    with CHUNK_CACHES_LOCK:
+        fanout = CHUNK_FANOUTS.get(fanout_name)
+        if fanout is None:
+            fanout = CHUNK_FANOUTS[fanout_name] = ChunkFanOut()
+        return fanout
+
+
+class FanOutRecordingSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, fanout, consumer, segment_index):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.fanout = fanout
+        self.consumer = consumer
+        self.segment_index = segment_index
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        traces = self.fanout.get(
+            self.consumer,
+            (self.segment_index, start_frame, end_frame),
+            lambda: self.parent_recording_segment.get_traces(
+                start_frame, end_frame, None
+            ),
+        )
+        # the traces are shared with the other consumers, so they must not be modified
+        if channel_indices is None:
+            return np.array(traces)
+        return traces[:, channel_indices]
+
+
+class FanOutRecording(BasePreprocessor):
+    """
+    Wraps the raw recording of one channel group so that the reads of all groups with the same
+    fanout_name are served from one read of each raw chunk (see ChunkFanOut).
+
+    Parameters:
+    - recording: si.BaseRecording - The raw recording, with the channels of all groups.
+    - fanout_name: str - The name of the fan-out shared by all groups.
+    - consumer: int - The index of the channel group reading from this recording.
+    """
+
+    name = "fan_out"
+
+    def __init__(self, recording, fanout_name: str, consumer: int):
+        BasePreprocessor.__init__(self, recording)
+        self.fanout = get_chunk_fanout(fanout_name)
+        for segment_index, parent_segment in enumerate(recording._recording_segments):
+            self.add_recording_segment(
+                FanOutRecordingSegment(
+                    parent_segment, self.fanout, consumer, segment_index
+                )
+            )
+        self._kwargs = dict(
+            recording=recording, fanout_name=fanout_name, consumer=consumer
+        )
+
+
 def load_ephys_data(
     config: dict,
 ) -> si.ChannelSliceRecording:
@@ -178,6 +731,7 @@ def load_ephys_data(
     """
     session_folder = config["Data"]["session_folder"]
     dataset_type = config["Data"]["dataset_type"]
+    num_workers = config["Data"]["file_open_workers"]
     if dataset_type == "openephys":
         # If loading Open Ephys data
         loaded_recording = se.read_openephys(
@@ -209,11 +763,11 @@ def load_ephys_data(
             chosen_nsx_files = [nsx_files[i] for i in config["Data"]["emg_recordings"]]
 
         # Load Blackrock data
-        loaded_recording_list = []
-        for nsx_file in chosen_nsx_files:
-            loaded_recording_list.append(se.read_blackrock(str(nsx_file)))
-
-        loaded_recording = si.append_recordings(loaded_recording_list)
+        loaded_recording = open_recording_files(
+            chosen_nsx_files,
+            lambda nsx_file: se.read_blackrock(str(nsx_file)),
+            num_workers,
+        )
 
     elif dataset_type == "intan":
         # get list of intan recordings
@@ -229,10 +783,11 @@ def load_ephys_data(
                 rhd_and_rhs_files[i] for i in config["Data"]["emg_recordings"]
             ]
         # If loading Intan data
-        loaded_recording_list = []
-        for iRec in chosen_rhd_and_rhs_files:
-            loaded_recording_list.append(se.read_intan(str(iRec), stream_id="0"))
-        loaded_recording = si.append_recordings(loaded_recording_list)
+        loaded_recording = open_recording_files(
+            chosen_rhd_and_rhs_files,
+            lambda iRec: se.read_intan(str(iRec), stream_id="0"),
+            num_workers,
+        )
     elif dataset_type == "nwb":
         # get list of nwb recordings
         nwb_files = [
@@ -245,10 +800,9 @@ def load_ephys_data(
         else:
             chosen_nwb_files = [nwb_files[i] for i in config["Data"]["emg_recordings"]]
         # If loading NWB data
-        loaded_recording_list = []
-        for iRec in chosen_nwb_files:
-            loaded_recording_list.append(se.read_nwb(str(iRec)))
-        loaded_recording = si.append_recordings(loaded_recording_list)
+        loaded_recording = open_recording_files(
+            chosen_nwb_files, lambda iRec: se.read_nwb(str(iRec)), num_workers
+        )
     elif dataset_type == "binary":
         # get list of binary recordings
         bin_or_dat_files = [
@@ -263,23 +817,184 @@ def load_ephys_data(
                 bin_or_dat_files[i] for i in config["Data"]["emg_recordings"]
             ]
         # If loading binary data
-        loaded_recording_list = []
-        for iRec in chosen_bin_or_dat_files:
-            loaded_recording_list.append(
-                se.read_binary(
-                    str(iRec),
-                    sampling_frequency=config["Data"]["binary_sampling_rate"],
-                    num_channels=config["Data"]["binary_num_channels"],
-                    dtype=config["Data"]["binary_dtype"],
-                )
-            )
-        loaded_recording = si.append_recordings(loaded_recording_list)
+        loaded_recording = open_recording_files(
+            chosen_bin_or_dat_files,
+            lambda iRec: se.read_binary(
+                str(iRec),
+                sampling_frequency=config["Data"]["binary_sampling_rate"],
+                num_channels=config["Data"]["binary_num_channels"],
+                dtype=config["Data"]["binary_dtype"],
+            ),
+            num_workers,
+        )
+
+    # overlap reading the files with the filtering of previously read chunks
+    if config["Data"]["prefetch_chunks"] > 0:
+        loaded_recording = PrefetchRecording(
+            loaded_recording, num_chunks=config["Data"]["prefetch_chunks"]
+        )
 
     return loaded_recording
 
 
+def get_time_window_epochs(
+    data_config: dict, num_frames_per_recording: list, sampling_frequency: float
+) -> np.ndarray:
+    """
+    Returns the epochs of the recordings to sort from the time_windows of the Data section. The
+    windows are either given as a list in the configuration file, or as the path of an events
+    file (absolute or relative to the session folder) with one window or event per line. Rows
+    are [start, end] in seconds for the first recording, [recording, start, end] with the index of
+    the recording within emg_recordings, or a single event time, which needs time_window_padding.
+    Windows are padded by time_window_padding seconds, clipped to the recording, and overlapping
+    windows are merged.
+
+    Parameters:
+    - data_config: dict - The Data section of the configuration file.
+    - num_frames_per_recording: list - The number of frames of each selected recording.
+    - sampling_frequency: float - The sampling frequency of the recordings in Hz.
+
+    Returns:
+    - np.ndarray: One row per epoch of (recording, start_frame, end_frame, original_start_frame,
+      sorted_start_frame), where the original start frame is in the timebase of all selected
+      recordings concatenated, and the sorted start frame is in the concatenation of the epochs.
+    """
+    time_windows = data_config["time_windows"]
+    padding = data_config["time_window_padding"] or 0
+    if isinstance(time_windows, (str, Path)):
+        events_path = Path(time_windows).expanduser()
+        if not events_path.is_absolute():
+            events_path = Path(data_config["session_folder"]) / events_path
+        # accept comma or whitespace separated columns
+        rows = [
+            [float(val) for val in line.replace(",", " ").split()]
+            for line in events_path.read_text().splitlines()
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+    else:
+        rows = [
+            [float(val) for val in np.atleast_1d(row).tolist()] for row in time_windows
+        ]
+
+    windows = []
+    for row in rows:
+        if len(row) == 1:
+            assert (
+                padding > 0
+            ), "time_window_padding must be above 0 when time_windows contains single event times."
+            windows.append((0, row[0], row[0]))
+        elif len(row) == 2:
+            windows.append((0, row[0], row[1]))
+        elif len(row) == 3:
+            windows.append((int(row[0]), row[1], row[2]))
+        else:
+            raise ValueError(
+                f"Rows of time_windows must be [start, end], [recording, start, end] or a single event time, but got {row}."
+            )
+
+    assert all(
+        0 <= window[0] < len(num_frames_per_recording) for window in windows
+    ), f"Recording indices of time_windows must be below {len(num_frames_per_recording)}."
+    recording_offsets = np.concatenate([[0], np.cumsum(num_frames_per_recording)])
+    epochs = []
+    for recording in range(len(num_frames_per_recording)):
+        these_windows = sorted(
+            (
+                max(int(round((start - padding) * sampling_frequency)), 0),
+                min(
+                    int(round((end + padding) * sampling_frequency)),
+                    num_frames_per_recording[recording],
+                ),
+            )
+            for this_recording, start, end in windows
+            if this_recording == recording
+        )
+        for start_frame, end_frame in these_windows:
+            if end_frame <= start_frame:
+                continue
+            if epochs and epochs[-1][0] == recording and start_frame <= epochs[-1][2]:
+                # merge overlapping windows
+                epochs[-1][2] = max(epochs[-1][2], end_frame)
+            else:
+                epochs.append([recording, start_frame, end_frame])
+    assert epochs, "time_windows does not contain any data within the recordings."
+
+    epochs = np.array(epochs, dtype=np.int64)
+    original_start_frames = recording_offsets[epochs[:, 0]] + epochs[:, 1]
+    num_epoch_frames = epochs[:, 2] - epochs[:, 1]
+    sorted_start_frames = np.concatenate([[0], np.cumsum(num_epoch_frames)[:-1]])
+    return np.column_stack([epochs, original_start_frames, sorted_start_frames])
+
+
+def map_to_original_frames(spike_times: np.ndarray, epochs: np.ndarray) -> np.ndarray:
+    # frames of the concatenated epochs to frames in the timebase of the selected recordings
+    epochs = np.asarray(epochs, dtype=np.int64).reshape(-1, 5)
+    spike_times = np.asarray(spike_times, dtype=np.int64)
+    epoch_indices = np.searchsorted(epochs[:, 4], spike_times, side="right") - 1
+    return spike_times - epochs[epoch_indices, 4] + epochs[epoch_indices, 3]
+
+
+RESAMPLE_PASSBAND_FACTOR = 2.5  # automatic rate relative to the top of emg_passband, leaving room for the anti-aliasing roll-off
+RESAMPLE_RATE_STEP = 500  # automatic rates are rounded up to a multiple of this, in Hz
+# Kilosort parameters in samples which keep their duration when resampling, besides nt
+RESAMPLED_KS_PARAMS = ["batch_size", "nt0min", "duplicate_spike_bins"]
+
+
+def get_resample_rate(data_config: dict, sampling_frequency: float) -> Union[int, None]:
+    """
+    Returns the sampling rate to resample the filtered data to, from the resample_rate of the
+    Data section. 'auto' derives the rate from the upper emg_passband frequency, while a number
+    sets the rate in Hz, which must be above twice the upper passband frequency. Returns None if
+    resampling is disabled or the rate would not be below the native rate.
+    """
+    resample_rate = data_config.get("resample_rate")
+    if not resample_rate:
+        return None
+    passband_high = data_config["emg_passband"][1]
+    if resample_rate == "auto":
+        resample_rate = int(
+            np.ceil(RESAMPLE_PASSBAND_FACTOR * passband_high / RESAMPLE_RATE_STEP)
+            * RESAMPLE_RATE_STEP
+        )
+    else:
+        assert isinstance(resample_rate, (int, float)) and resample_rate > 2 * (
+            passband_high
+        ), f"resample_rate must be 'auto' or a rate in Hz above twice the upper emg_passband frequency ({2 * passband_high} Hz), but got {resample_rate}."
+        resample_rate = int(resample_rate)
+    if resample_rate >= sampling_frequency:
+        return None
+    return resample_rate
+
+
+def adjust_KS_params_for_resampling(ks_config: dict, resampling: dict):
+    """
+    Scales the Kilosort parameters which are given in samples (nt and RESAMPLED_KS_PARAMS) from
+    the native sampling rate to the resampled rate in place, so they keep their duration. nt is
+    kept odd, so the spike time stays at the same sample of each waveform.
+
+    Parameters:
+    - ks_config: dict - The KS section of the configuration of a job, with native rate values.
+    - resampling: dict - The "native_sampling_frequency" and "sampling_frequency" of the data.
+    """
+    ratio = resampling["sampling_frequency"] / resampling["native_sampling_frequency"]
+    # nearest odd number of samples
+    ks_config["nt"] = int(2 * np.floor(ks_config["nt"] * ratio / 2) + 1)
+    for key in RESAMPLED_KS_PARAMS:
+        if ks_config.get(key):
+            ks_config[key] = max(1, int(round(ks_config[key] * ratio)))
+
+
+def map_to_native_frames(spike_times: np.ndarray, resampling: dict) -> np.ndarray:
+    # frames at the resampled rate to the nearest frames at the native rate
+    ratio = resampling["native_sampling_frequency"] / resampling["sampling_frequency"]
+    return np.round(np.asarray(spike_times, dtype=np.int64) * ratio).astype(np.int64)
+
+
 def preprocess_ephys_data(
-    recording_obj: si.ChannelSliceRecording, this_config: dict, iChanGroup: Union[int]
+    recording_obj: si.ChannelSliceRecording,
+    this_config: dict,
+    iChanGroup: Union[int],
+    fanout_name: Union[str, None] = None,
 ) -> Union[si.ChannelSliceRecording, si.FrameSliceRecording]:
     """
     Preprocesses the electrophysiological data based on the specified configuration.
@@ -287,6 +1002,7 @@ def preprocess_ephys_data(
     Parameters:
     - recording_obj: si.ChannelSliceRecording - The ChannelSliceRecording object containing the electrophysiological data.
     - config: dict - The configuration dictionary containing the preprocessing parameters.
+    - fanout_name: Union[str, None] - If given, the raw data is read through the fan-out of this name, shared with the other channel groups (see ChunkFanOut).
 
     Returns:
     - si.ChannelSliceRecording: The preprocessed ChannelSliceRecording object.
@@ -298,6 +1014,10 @@ def preprocess_ephys_data(
     assert time_range_is_disabled or (
         this_config["Data"]["time_range"][0] < this_config["Data"]["time_range"][1]
     ), "First element of time_range must be less than the second element."
+    use_time_windows = bool(this_config["Data"]["time_windows"])
+    assert (
+        time_range_is_disabled or not use_time_windows
+    ), "time_range must be disabled (i.e., time_range: [0, 0]) when time_windows are used."
 
     # check which recordings to use and whether to call concatenate_emg_data
     if this_config["Data"]["emg_recordings"][0] == "all":
@@ -310,7 +1030,10 @@ def preprocess_ephys_data(
             "Time range must be disabled if concatenating recordings (i.e., time_range: [0, 0])."
         )
     # concatenate the recordings if it's the first sort group, otherwise simply load it from last iteration
-    if len(emg_recordings_to_use) > 1 and iChanGroup == 0:
+    if use_time_windows:
+        # the epochs of all recordings are concatenated after filtering
+        loaded_recording = recording_obj.select_segments(emg_recordings_to_use)
+    elif len(emg_recordings_to_use) > 1 and iChanGroup == 0:
         loaded_recording = concatenate_emg_data(
             this_config["Data"]["session_folder"],
             emg_recordings_to_use,
@@ -322,6 +1045,8 @@ def preprocess_ephys_data(
         loaded_recording = si.load_extractor(concat_data_path)
     else:
         loaded_recording = recording_obj.select_segments(emg_recordings_to_use)
+    if fanout_name is not None:
+        loaded_recording = FanOutRecording(loaded_recording, fanout_name, iChanGroup)
 
     # check for [all] in emg_chan_list
     if this_config["Group"]["emg_chan_list"][iChanGroup][0] == "all":
@@ -431,6 +1156,49 @@ def preprocess_ephys_data(
     recording_notch = spre.notch_filter(
         recording_filtered, freq=60, q=30
     )  # Apply notch filter at 60 Hz
+    native_sampling_frequency = recording_notch.get_sampling_frequency()
+    resample_rate = get_resample_rate(this_config["Data"], native_sampling_frequency)
+    if resample_rate is not None:
+        # the passband is far below the native Nyquist frequency, so fewer samples suffice for
+        # every later stage. FFT resampling removes everything above the new Nyquist frequency,
+        # and the margin avoids edge effects between chunks
+        recording_notch = spre.resample(
+            recording_notch, resample_rate=resample_rate, margin_ms=100.0
+        )
+        # saved with the results, to scale Kilosort parameters and map spike times back
+        this_config["resampling"] = {
+            "native_sampling_frequency": float(native_sampling_frequency),
+            "sampling_frequency": float(resample_rate),
+        }
+        print(
+            f"Resampled from {native_sampling_frequency} Hz to {resample_rate} Hz "
+            f"({native_sampling_frequency / resample_rate:.1f}x fewer samples)."
+        )
+    else:
+        this_config.pop("resampling", None)
+    if use_time_windows:
+        # cut the epochs from the filtered data, so the filters do not ring at their edges
+        epochs = get_time_window_epochs(
+            this_config["Data"],
+            [
+                recording_notch.get_num_frames(segment_index=i)
+                for i in range(recording_notch.get_num_segments())
+            ],
+            recording_notch.get_sampling_frequency(),
+        )
+        recording_notch = si.concatenate_recordings(
+            [
+                recording_notch.select_segments([int(recording)]).frame_slice(
+                    start_frame=int(start_frame), end_frame=int(end_frame)
+                )
+                for recording, start_frame, end_frame, _, _ in epochs
+            ]
+        )
+        # saved with the results, to map spike times back to the original timebase
+        this_config["epochs"] = epochs.tolist()
+        print(
+            f"Sorting {len(epochs)} epochs of {recording_notch.get_total_duration():.1f} s in total."
+        )
     # set a probe for the recording
     probe = create_probe(recording_notch)
     preprocessed_recording = recording_notch.set_probe(probe)
@@ -536,406 +1304,5279 @@ def concatenate_emg_data(
     return recording_concatenated
 
 
-def get_emusort_scores(we, wid):
-    ### Compute sorting quality metrics, Overall EMUsort score
-    def get_t1_scores(we):
-        ## Check Type I errors (false positives)
-        rp_contamination, _ = compute_refrac_period_violations(
-            we,
-            refractory_period_ms=1,
-            censored_period_ms=0,
-        )
-        rp_contamination_scores = 1 - np.fromiter(rp_contamination.values(), float)
-
-        # num_spikes = compute_num_spikes(
-        #     we,
-        # )
-        # rp_violation_fraction_scores = 1 - np.fromiter(rp_violations.values(), int) / (
-        # 1 + np.fromiter(num_spikes.values(), int)
-        # )
-        type_I_scores = rp_contamination_scores  # rp_violation_fraction_scores
-        return type_I_scores
-
-    def get_t2_scores(we):
-        ## Check Type II errors (false negatives)
-        presence_ratios = compute_presence_ratios(
-            we, bin_duration_s=20.0, mean_fr_ratio_thresh=0.5
-        )
-        presence_ratio_scores = np.fromiter(presence_ratios.values(), float)
-
-        amplitude_cutoffs = compute_amplitude_cutoffs(
-            we, peak_sign="both", num_histogram_bins=32, amplitudes_bins_min_ratio=4
-        )
-        amplitude_Gaussianity_scores = 1 - np.fromiter(
-            amplitude_cutoffs.values(), float
-        )
-        denan_amplitude_Gaussianity_scores = np.nan_to_num(
-            amplitude_Gaussianity_scores,
-            nan=0,  # if nan, replace with 0 (bad score due to too few spikes)
-        )
-
-        type_II_scores = denan_amplitude_Gaussianity_scores * presence_ratio_scores
-        return type_II_scores
-
-    def get_fr_val_scores(we):
-        ## Check Firing Rates Validity Against Known MU properties (200Hz sigmoid dropoff)
-        firing_rates = compute_firing_rates(
-            we,
-        )
-        firing_rate_viol_scores = 1 / (
-            1 + np.exp((np.fromiter(firing_rates.values(), float) + 1e-8) - 200)
-        )
-        firing_ranges = compute_firing_ranges(we, bin_size_s=0.5)
-        firing_range_viol_scores = 1 / (
-            1 + np.exp((np.fromiter(firing_ranges.values(), float) + 1e-8) - 200)
-        )
-        firing_rate_validity_scores = firing_rate_viol_scores * firing_range_viol_scores
-        return firing_rate_validity_scores
-
-    def get_snr_scores(we):
-        # gets ratio of largest peak to snippet standard deviation
-        snrs = compute_snrs(
-            we,
-            peak_sign="both",
-        )
-        # set sigmoid so that the score is 0.5 at 4
-        snr_scores = 1 - (1 / (1 + np.exp((np.fromiter(snrs.values(), float) - 4))))
-        # clip it 0 to 1 to prevent the plunge to negative infinity when the sd to snr ratio is > 1
-        clipped_snr_scores = np.clip(snr_scores, 0, 1)
-        return clipped_snr_scores
-
-    # get quality metric scores asynchronously
-    clipped_snr_scores = get_snr_scores(we)
-    firing_rate_validity_scores = get_fr_val_scores(we)
-    type_I_scores = get_t1_scores(we)
-    type_II_scores = get_t2_scores(we)
+def cache_preprocessed_recording(
+    preproc_recording: si.BaseRecording, this_config: dict, iChanGroup: int
+) -> si.BaseRecording:
+    """
+    Saves the preprocessed recording of a channel group to binary once, so that all sorting
+    jobs of the group share the same filtered data instead of each job recomputing the filters
+    and writing its own copy for Kilosort. Results are saved in the "preprocessed_data/g#"
+    folder within the session folder. If the cached data already exists and the settings of
+    the preprocessing stage have not changed, data will be loaded instead of recomputed.
 
-    # produce overall score, accounting for all quality metrics
-    emusort_scores = (
-        clipped_snr_scores
-        * firing_rate_validity_scores
-        * type_I_scores
-        * type_II_scores
-    )
-    emusort_score = np.nanmean(emusort_scores)
+    Parameters:
+    - preproc_recording: si.BaseRecording - The lazily preprocessed recording for this channel group.
+    - this_config: dict - The configuration dictionary used to preprocess the recording.
+    - iChanGroup: int - The index of the channel group.
 
-    # get quality metric report string for this worker
-    report = (
-        "------------------------------------------------------------\n"
-        f" Worker {wid} Quality Scores Report:\n"
-        f" SNR scores:\n{clipped_snr_scores}\n"
-        f" Firing rate validity:\n{firing_rate_validity_scores}\n"
-        f" Type I error scores:\n{type_I_scores}\n"
-        f" Type II error scores:\n{type_II_scores}\n"
-        f" EMUsort scores:\n{emusort_scores}\n"
-        "------------------------------------------------------------\n"
-        f" Worker {wid} Overall EMUsort score: {emusort_score:.3f}\n"
-        "------------------------------------------------------------\n"
+    Returns:
+    - si.BaseRecording: The binary-backed preprocessed recording.
+    """
+    session_folder = Path(this_config["Data"]["session_folder"])
+    cache_path = session_folder / "preprocessed_data" / f"g{iChanGroup}"
+    last_config_path = cache_path / "last_config.yaml"
+    # all settings which determine the output of the preprocessing stage
+    stage_config = path_to_str_recursive(
+        {
+            # without the settings which only change how fast the data is read
+            "Data": {
+                key: val
+                for key, val in this_config["Data"].items()
+                if key not in ["file_open_workers", "prefetch_chunks"]
+            },
+            "Group": {
+                "emg_chan_list": list(
+                    this_config["Group"]["emg_chan_list"][iChanGroup]
+                ),
+                "remove_bad_emg_chans": this_config["Group"]["remove_bad_emg_chans"][
+                    iChanGroup
+                ],
+            },
+            "emg_chans_used": preproc_recording.get_channel_ids().tolist(),
+        }
     )
-    return (
-        clipped_snr_scores,
-        firing_rate_validity_scores,
-        type_I_scores,
-        type_II_scores,
-        emusort_scores,
-        emusort_score,
-        report,
+    if this_config.get("epochs"):
+        # also changes when an events file of time_windows is edited
+        stage_config["epochs"] = this_config["epochs"]
+
+    if last_config_path.exists():
+        yaml = YAML()
+        with open(last_config_path) as f:
+            try:
+                last_config_dict = dict(yaml.load(f))
+            except TypeError:
+                print(
+                    "Error loading previous configuration file 'last_config.yaml' or it is empty."
+                )
+                last_config_dict = {}
+        if dicts_match(last_config_dict, stage_config):
+            try:
+                cached_recording = si.load_extractor(cache_path / "recording")
+                print(
+                    f"Preprocessing settings for group {iChanGroup} have not changed since last run, will load previous preprocessed data..."
+                )
+                return cached_recording
+            except Exception:
+                print(
+                    "Failed to load previously preprocessed data, re-running preprocessing..."
+                )
+        else:
+            print(
+                f"Preprocessing settings for group {iChanGroup} have changed since last run, re-running preprocessing..."
+            )
+        # invalidate the cache before overwriting, so a partial save is never reused
+        last_config_path.unlink()
+        (cache_path / NOISE_LEVELS_FILENAME).unlink(missing_ok=True)
+
+    cache_path.mkdir(parents=True, exist_ok=True)
+    print(f"Saving preprocessed data for group {iChanGroup} to {cache_path}")
+    cached_recording = preproc_recording.save(
+        format="binary", folder=cache_path / "recording", overwrite=True
     )
+    dump_yaml(last_config_path, stage_config)
+
+    return cached_recording
+
+
+# per-unit metrics saved in each result folder, in the order of the unit_ids column
+UNIT_METRICS_FILENAME = "unit_metrics.npz"
+UNIT_METRIC_COLUMNS = [
+    "num_spikes",
+    "rp_contamination",
+    "presence_ratio",
+    "amplitude_cutoff",
+    "firing_rate",
+    "firing_range",
+    "snr",
+    "peak_amplitude",
+    "extremum_channel",
+]
+# methods of computing the unit metrics, from extracted waveforms or from the Kilosort outputs
+SCORING_METHODS = ["waveforms", "templates"]
+WAVEFORM_MAX_SPIKES_PER_UNIT = (
+    500  # waveforms extracted per unit, as si.extract_waveforms
+)
+# compact float16 waveform summary of each unit saved in each result folder, for plotting
+WAVEFORM_SUMMARY_FILENAME = "waveform_summary.npz"
+WAVEFORM_SUMMARY_SPIKES = 20  # spikes per unit kept on the extremum channel
+WAVEFORM_SUMMARY_BINS = 32  # bins of the amplitude histogram of each unit
+WAVEFORM_SUMMARY_COLUMNS = [
+    "templates_mean",
+    "templates_std",
+    "waveforms",
+    "amplitude_hist",
+    "amplitude_bins",
+]
+# columns in the units of the recording, saved as float16 relative to the scale of each unit
+WAVEFORM_SUMMARY_SCALED_COLUMNS = [
+    "templates_mean",
+    "templates_std",
+    "waveforms",
+    "amplitude_bins",
+]
+
+
+class UnitWaveforms:
+    """
+    Waveforms of a random subset of the spikes of each unit, held in a single array for all
+    units instead of one buffer per unit. Provides the parts of the WaveformExtractor interface
+    which EMUsort and the spikeinterface quality metrics use, so the metrics are computed by
+    spikeinterface as with si.extract_waveforms. The noise levels shared by the jobs of the
+    group are provided as the "noise_levels" extension.
 
+    Parameters:
+    - recording: si.BaseRecording - The recording the waveforms were extracted from.
+    - sorting: si.BaseSorting - The sorting the waveforms were extracted for, without spikes
+      which exceed the recording bounds.
+    - waveforms: np.ndarray - The waveforms (spikes x samples x channels), sorted by unit.
+    - waveform_labels: np.ndarray - The unit index of each waveform.
+    - nbefore: int - The number of samples before the spike time in each waveform.
+    - nafter: int - The number of samples from the spike time on in each waveform.
+    """
 
-def write_rec_and_params(
-    we,
-    sorted_folder,
-    this_sorting,
-    this_config,
-    use_relative_path=True,
-    dtype=None,
-    **job_kwargs,
-):
-    # save dat file
-    if dtype is None:
-        if we.has_recording():
-            dtype = we.recording.get_dtype()
-        else:
-            dtype = we.dtype
-
-    if we.has_recording():
-        rec_path = sorted_folder / "recording.dat"
-        write_binary_recording(
-            we.recording, file_paths=rec_path, dtype=dtype, **job_kwargs
+    sparsity = None
+    return_scaled = False  # in the units of recording.dat, as the metrics cache expects
+
+    def __init__(self, recording, sorting, waveforms, waveform_labels, nbefore, nafter):
+        self.recording = recording
+        self.sorting = sorting
+        self.unit_ids = sorting.unit_ids
+        self.channel_ids = recording.channel_ids
+        self.sampling_frequency = recording.get_sampling_frequency()
+        self.waveforms = waveforms
+        self.waveform_labels = waveform_labels
+        self.nbefore = nbefore
+        self.nafter = nafter
+        self.nsamples = nbefore + nafter
+        # waveforms of each unit are contiguous, from unit_starts[i] to unit_starts[i + 1]
+        self.unit_starts = np.searchsorted(
+            waveform_labels, np.arange(len(self.unit_ids) + 1)
         )
-    else:  # don't save recording.dat
-        print("Recording will not be copied since waveform extractor is recordingless.")
-        rec_path = "None"
+        self._templates = {}
 
-    dtype_str = np.dtype(dtype).name
+    def is_sparse(self) -> bool:
+        return False
 
-    # write params.py
-    # if exists delete
-    if (sorted_folder / "params.py").exists():
-        (sorted_folder / "params.py").unlink()
-        # create new
-        Path(sorted_folder / "params.py").touch()
-    with (sorted_folder / "params.py").open("w") as f:
-        if use_relative_path:
-            f.write(f"dat_path = r'recording.dat'\n")
-        else:
-            f.write(f"dat_path = r'{str(rec_path)}'\n")
-        f.write(f"n_channels_dat = {this_config['num_chans']}\n")
-        f.write(f"dtype = '{dtype_str}'\n")
-        f.write(f"offset = 0\n")
-        f.write(f"sample_rate = {this_sorting.get_sampling_frequency()}\n")
-        f.write(f"hp_filtered = {we.is_filtered()}")
+    def get_num_segments(self) -> int:
+        return self.recording.get_num_segments()
 
+    def get_num_samples(self, segment_index=None) -> int:
+        return self.recording.get_num_samples(segment_index=segment_index)
 
-async def extract_sorting_result(this_sorting, this_config, this_job, wid):
-    """
-    Asynchronous version of extract_sorting_result, offloading blocking I/O tasks to background threads.
+    def get_total_samples(self) -> int:
+        return self.recording.get_total_samples()
+
+    def get_total_duration(self) -> float:
+        return self.recording.get_total_duration()
+
+    def channel_ids_to_indices(self, channel_ids) -> np.ndarray:
+        return self.recording.ids_to_indices(channel_ids)
+
+    def has_extension(self, extension_name: str) -> bool:
+        return extension_name == "noise_levels"
+
+    is_extension = has_extension
+
+    def load_extension(self, extension_name: str):
+        from types import SimpleNamespace
+
+        assert self.has_extension(extension_name), f"No {extension_name} extension"
+        noise_levels = get_recording_noise_levels(self.recording)
+        return SimpleNamespace(get_data=lambda: noise_levels)
+
+    def get_waveforms(self, unit_id) -> np.ndarray:
+        unit_index = list(self.unit_ids).index(unit_id)
+        return self.waveforms[
+            self.unit_starts[unit_index] : self.unit_starts[unit_index + 1]
+        ]
+
+    def get_template(self, unit_id, mode: str = "average") -> np.ndarray:
+        return self.get_all_templates(mode=mode)[list(self.unit_ids).index(unit_id)]
+
+    def get_all_templates(self, unit_ids=None, mode: str = "average") -> np.ndarray:
+        # units without waveforms get flat templates
+        if mode not in self._templates:
+            templates = np.zeros(
+                (len(self.unit_ids),) + self.waveforms.shape[1:], dtype=np.float32
+            )
+            for unit_index in range(len(self.unit_ids)):
+                unit_waveforms = self.waveforms[
+                    self.unit_starts[unit_index] : self.unit_starts[unit_index + 1]
+                ]
+                if len(unit_waveforms) == 0:
+                    continue
+                if mode == "average":
+                    templates[unit_index] = np.mean(unit_waveforms, axis=0)
+                elif mode == "std":
+                    templates[unit_index] = np.std(unit_waveforms, axis=0)
+                else:
+                    raise ValueError(f"Unknown template mode: {mode}")
+            self._templates[mode] = templates
+        if unit_ids is None:
+            return self._templates[mode]
+        return self._templates[mode][self.sorting.ids_to_indices(unit_ids)]
+
+
+def extract_waveforms_in_memory(
+    recording, sorting, ms_buffer, max_spikes_per_unit=WAVEFORM_MAX_SPIKES_PER_UNIT
+) -> UnitWaveforms:
     """
-    # Save sorting results by exporting to Phy format
-    sorted_folder = Path(this_config["Sorting"]["sorted_folder"])
+    Extracts dense waveforms of a random subset of up to max_spikes_per_unit spikes of each
+    unit into a single array, reading the recording one chunk at a time. Spikes which exceed
+    the recording bounds are removed, and spikes too close to its edges are not sampled.
 
-    # get nt size from the sorting object, which is the width of the waveforms
-    sampling_frequency = this_sorting.get_sampling_frequency()
-    nt = this_config["KS"]["nt"]
-    ms_buffer = nt / sampling_frequency * 1000 / 2
-    print(
-        f"Worker {wid} extracting waveforms with nt={nt} at fs={sampling_frequency} Hz (ms_before=ms_after={np.round(ms_buffer, 3)} ms)."
-    )
+    Unlike si.extract_waveforms in memory mode, which allocates one shared memory buffer (and
+    so one open file) per unit, the number of open files does not grow with the number of
+    units, so many results can be extracted concurrently on any system.
 
-    try:
-        # Extract waveforms
-        we = await asyncio.to_thread(
-            si.extract_waveforms,
-            this_job["recording"],
-            this_sorting,
-            # waveforms_folder,
-            mode="memory",
-            ms_before=ms_buffer,
-            ms_after=ms_buffer,
-            # overwrite=True,
-            sparse=False,
-        )
-    except ValueError as e:
+    Parameters:
+    - recording: si.BaseRecording - The recording, with a single segment.
+    - sorting: si.BaseSorting - The sorting of the recording.
+    - ms_buffer: float - The duration of the waveforms before and after each spike in ms.
+    - max_spikes_per_unit: int - The maximum number of waveforms of each unit.
+
+    Returns:
+    - UnitWaveforms: The waveforms of all units.
+    """
+    sampling_frequency = recording.get_sampling_frequency()
+    nbefore = int(ms_buffer * sampling_frequency / 1000.0)
+    nafter = nbefore
+    num_frames = recording.get_num_frames()
+    num_units = len(sorting.unit_ids)
+
+    spikes = sorting.to_spike_vector()
+    num_excess_spikes = np.sum(spikes["sample_index"] >= num_frames)
+    if num_excess_spikes > 0:
         import spikeinterface.curation as scur
 
-        print("Error extracting waveforms:", e)
+        print(f"Removing {num_excess_spikes} spikes which exceed the recording bounds.")
+        sorting = scur.remove_excess_spikes(sorting, recording)
+        spikes = sorting.to_spike_vector()
+    spike_times = spikes["sample_index"].astype(np.int64)
+    spike_labels = spikes["unit_index"].astype(np.int64)
 
-        remove_excess_spikes_sorting = scur.remove_excess_spikes(
-            this_sorting, this_job["recording"]
+    # pick random spikes of each unit with a fixed seed, so rescoring is reproducible
+    rng = np.random.default_rng(0)
+    candidates = np.flatnonzero(
+        (spike_times >= nbefore) & (spike_times < num_frames - nafter)
+    )
+    candidates = candidates[
+        np.lexsort((rng.random(len(candidates)), spike_labels[candidates]))
+    ]
+    candidate_starts = np.searchsorted(spike_labels[candidates], np.arange(num_units))
+    rank = np.arange(len(candidates)) - candidate_starts[spike_labels[candidates]]
+    selected = candidates[rank < max_spikes_per_unit]
+    selected = selected[np.lexsort((spike_times[selected], spike_labels[selected]))]
+
+    waveforms = np.zeros(
+        (len(selected), nbefore + nafter, recording.get_num_channels()),
+        dtype=recording.get_dtype(),
+    )
+    # read the traces around the selected spikes of each chunk at once, in time order
+    chunk_frames = get_chunk_frames(sampling_frequency)
+    time_order = np.argsort(spike_times[selected], kind="stable")
+    selected_times = spike_times[selected][time_order]
+    chunk_bounds = np.flatnonzero(np.diff(selected_times // chunk_frames)) + 1
+    for chunk_order in np.split(time_order, chunk_bounds):
+        if len(chunk_order) == 0:
+            continue
+        chunk_times = spike_times[selected[chunk_order]]
+        start_frame = int(chunk_times[0]) - nbefore
+        traces = recording.get_traces(
+            start_frame=start_frame,
+            end_frame=int(chunk_times[-1]) + nafter,
+            segment_index=0,
         )
-        we = await asyncio.to_thread(
-            si.extract_waveforms,
-            this_job["recording"],
-            remove_excess_spikes_sorting,
-            # waveforms_folder,
-            mode="memory",
-            ms_before=ms_buffer,
-            ms_after=ms_buffer,
-            # overwrite=True,
-            sparse=False,
-        )
-    print(f"Worker {wid} finished extracting waveforms, computing quality metrics...")
-
-    # Compute quality metrics asynchronously
-    (
-        snr_scores,
+        offsets = chunk_times - start_frame
+        waveforms[chunk_order] = traces[
+            offsets[:, None] + np.arange(-nbefore, nafter)[None, :]
+        ]
+    return UnitWaveforms(
+        recording, sorting, waveforms, spike_labels[selected], nbefore, nafter
+    )
+
+
+def get_unit_fingerprints(sorting) -> np.ndarray:
+    """
+    Returns a 64-bit fingerprint of the spike times of each unit, in the order of the unit IDs.
+    Units keep their fingerprint as long as their spike train is unchanged, for example when
+    other units are merged or split during curation.
+    """
+    import hashlib
+
+    fingerprints = np.zeros(len(sorting.unit_ids), dtype=np.uint64)
+    for idx, unit_id in enumerate(sorting.unit_ids):
+        spike_train = sorting.get_unit_spike_train(unit_id, segment_index=0)
+        digest = hashlib.blake2b(
+            np.asarray(spike_train, dtype=np.int64).tobytes(), digest_size=8
+        ).digest()
+        fingerprints[idx] = int.from_bytes(digest, "little")
+    return fingerprints
+
+
+def get_metrics_context(recording, ms_buffer, scoring_method="waveforms") -> np.ndarray:
+    """
+    Returns the settings every unit metric depends on besides the unit's own spike train.
+    Cached metrics are only reused if these are unchanged.
+    """
+    context = [
+        recording.get_num_frames(),
+        recording.get_sampling_frequency(),
+        recording.get_num_channels(),
+        ms_buffer,
+        # metrics from templates are approximate, so they are never reused for waveform scoring
+        SCORING_METHODS.index(scoring_method),
+        WAVEFORM_MAX_SPIKES_PER_UNIT,
+    ]
+    return np.array(context, dtype=float)
+
+
+NOISE_LEVELS_SEED = 0  # seed of the random chunks used to estimate channel noise levels
+NOISE_LEVELS_FILENAME = "noise_levels.npy"
+QUANTIZATION_FILENAME = "quantization.npy"  # int16 gains and offsets of each channel
+
+
+def get_recording_noise_levels(recording, scaled: bool = False) -> np.ndarray:
+    """
+    Returns the MAD noise level of each channel of a recording. The levels are computed once from
+    random chunks with a fixed seed and stored as a channel property of the recording, so every
+    job sharing the recording reuses them instead of reading new chunks.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording.
+    - scaled: bool - Whether to return the levels in uV, if the recording has gains.
+
+    Returns:
+    - np.ndarray: The noise level of each channel.
+    """
+    noise_levels = recording.get_property("noise_level_mad_raw")
+    if noise_levels is None:
+        noise_levels = si.get_noise_levels(
+            recording, return_scaled=False, method="mad", seed=NOISE_LEVELS_SEED
+        )
+        recording.set_property("noise_level_mad_raw", noise_levels)
+    # the MAD scales with the gain and does not depend on the offset
+    gains = recording.get_property("gain_to_uV")
+    # handle recording types without scaling information (such as binary recordings)
+    if scaled and gains is not None:
+        return noise_levels * gains
+    return noise_levels
+
+
+def load_group_noise_levels(recording, noise_levels_path: Union[Path, None] = None):
+    """
+    Computes the noise levels of a channel group's preprocessed recording once, storing them
+    with the recording for all jobs of the group. If noise_levels_path is given, the levels are
+    saved to it and loaded from it when the preprocessed data is reused.
+    """
+    if noise_levels_path is not None and Path(noise_levels_path).exists():
+        recording.set_property("noise_level_mad_raw", np.load(noise_levels_path))
+        return
+    noise_levels = get_recording_noise_levels(recording)
+    if noise_levels_path is not None:
+        np.save(noise_levels_path, noise_levels)
+
+
+def compute_unit_metrics(we) -> dict:
+    """
+    Computes the quality metrics which the EMUsort score is built from, for all units of the
+    extracted waveforms, with the spikeinterface quality metrics.
+
+    Parameters:
+    - we: UnitWaveforms - The extracted waveforms of the sorting.
+
+    Returns:
+    - dict: Metric arrays keyed by "unit_ids" and each of UNIT_METRIC_COLUMNS.
+    """
+    from spikeinterface.core import (
+        get_template_extremum_amplitude,
+        get_template_extremum_channel,
+    )
+
+    def to_array(metric_dict):
+        return np.array([metric_dict[unit_id] for unit_id in we.unit_ids], dtype=float)
+
+    ## Type I errors (false positives)
+    rp_contamination, _ = compute_refrac_period_violations(
+        we,
+        refractory_period_ms=1,
+        censored_period_ms=0,
+    )
+    ## Type II errors (false negatives)
+    presence_ratios = compute_presence_ratios(
+        we, bin_duration_s=20.0, mean_fr_ratio_thresh=0.5
+    )
+    amplitude_cutoffs = compute_amplitude_cutoffs(
+        we, peak_sign="both", num_histogram_bins=32, amplitudes_bins_min_ratio=4
+    )
+    ## Firing rates, to check validity against known MU properties
+    firing_rates = compute_firing_rates(
+        we,
+    )
+    firing_ranges = compute_firing_ranges(we, bin_size_s=0.5)
+    ## ratio of largest peak to channel noise level, with its components
+    peak_amplitudes = get_template_extremum_amplitude(we, peak_sign="both")
+    extremum_channels = get_template_extremum_channel(
+        we, peak_sign="both", outputs="index"
+    )
+    # the noise levels extension of we holds the noise levels shared by all jobs of the group
+    snrs = compute_snrs(we, peak_sign="both")
+
+    return {
+        "unit_ids": np.asarray(we.unit_ids),
+        "num_spikes": to_array(we.sorting.count_num_spikes_per_unit()),
+        "rp_contamination": to_array(rp_contamination),
+        "presence_ratio": to_array(presence_ratios),
+        "amplitude_cutoff": to_array(amplitude_cutoffs),
+        "firing_rate": to_array(firing_rates),
+        "firing_range": to_array(firing_ranges),
+        "snr": to_array(snrs),
+        "peak_amplitude": to_array(peak_amplitudes),
+        "extremum_channel": to_array(extremum_channels),
+    }
+
+
+def count_refractory_violations(
+    spike_times: np.ndarray,
+    spike_labels: np.ndarray,
+    num_units: int,
+    refractory_frames: int,
+) -> np.ndarray:
+    """
+    Counts the pairs of spikes of each unit that are at most refractory_frames apart, as
+    compute_refrac_period_violations does without a censored period.
+    """
+    order = np.lexsort((spike_times, spike_labels))
+    spike_times = np.asarray(spike_times, dtype=np.int64)[order]
+    spike_labels = np.asarray(spike_labels, dtype=np.int64)[order]
+    num_violations = np.zeros(num_units, dtype=np.int64)
+    # compare each spike with the k-th next spike of its unit, until no pairs are close enough
+    for k in range(1, len(spike_times)):
+        is_violation = (spike_labels[k:] == spike_labels[:-k]) & (
+            spike_times[k:] - spike_times[:-k] <= refractory_frames
+        )
+        if not np.any(is_violation):
+            break
+        num_violations += np.bincount(
+            spike_labels[k:][is_violation], minlength=num_units
+        )
+    return num_violations
+
+
+def get_binned_spike_counts(
+    spike_times: np.ndarray,
+    spike_labels: np.ndarray,
+    num_units: int,
+    bin_frames: int,
+    num_frames: int,
+) -> np.ndarray:
+    """
+    Returns the number of spikes of each unit in consecutive bins of bin_frames, as
+    np.histogram with edges np.arange(0, num_frames + 1, bin_frames) for each unit.
+    """
+    num_bins = num_frames // bin_frames
+    bins = np.asarray(spike_times, dtype=np.int64) // bin_frames
+    # the last edge belongs to the last bin, like in np.histogram
+    bins[spike_times == num_bins * bin_frames] = num_bins - 1
+    is_binned = (bins >= 0) & (bins < num_bins)
+    return np.bincount(
+        np.asarray(spike_labels, dtype=np.int64)[is_binned] * num_bins
+        + bins[is_binned],
+        minlength=num_units * num_bins,
+    ).reshape(num_units, num_bins)
+
+
+def compute_amplitude_cutoff(
+    amplitudes: np.ndarray,
+    num_histogram_bins: int = 32,
+    histogram_smoothing_value: float = 3,
+    amplitudes_bins_min_ratio: float = 4,
+) -> float:
+    """
+    Estimates the fraction of spikes missing below the detection threshold from the smoothed
+    histogram of spike amplitudes (with positive peaks), like compute_amplitude_cutoffs.
+    """
+    from scipy.ndimage import gaussian_filter1d
+
+    if len(amplitudes) / num_histogram_bins < amplitudes_bins_min_ratio:
+        return np.nan
+    pdf, bin_edges = np.histogram(amplitudes, num_histogram_bins, density=True)
+    bin_size = np.mean(np.diff(bin_edges[:-1]))
+    pdf = gaussian_filter1d(pdf, histogram_smoothing_value)
+    peak_index = np.argmax(pdf)
+    # the missing tail is assumed to mirror the tail above the amplitude of the smallest spikes
+    G = np.argmin(np.abs(pdf[peak_index:] - pdf[0])) + peak_index
+    return min(np.sum(pdf[G:]) * bin_size, 0.5)
+
+
+def compute_spike_train_metrics(
+    spike_times: np.ndarray,
+    spike_labels: np.ndarray,
+    spike_amplitudes: np.ndarray,
+    num_units: int,
+    num_frames: int,
+    sampling_frequency: float,
+) -> dict:
+    """
+    Computes the unit metrics that only depend on spike times and amplitudes, with the same
+    settings as compute_unit_metrics but vectorized over all spikes with numpy.
+
+    Parameters:
+    - spike_times: np.ndarray - The frame of each spike.
+    - spike_labels: np.ndarray - The unit index (0 to num_units - 1) of each spike.
+    - spike_amplitudes: np.ndarray - The amplitude of each spike, with positive peaks.
+    - num_units: int - The number of units.
+    - num_frames: int - The number of frames in the recording.
+    - sampling_frequency: float - The sampling frequency of the recording in Hz.
+
+    Returns:
+    - dict: Metric arrays keyed by "num_spikes", "rp_contamination", "presence_ratio",
+      "amplitude_cutoff", "firing_rate" and "firing_range".
+    """
+    spike_labels = np.asarray(spike_labels, dtype=np.int64)
+    duration = num_frames / sampling_frequency
+    num_spikes = np.bincount(spike_labels, minlength=num_units).astype(float)
+
+    ## Type I errors (false positives), 1 ms refractory period without censored period
+    refractory_frames = int(round(1 * sampling_frequency * 1e-3))
+    num_violations = count_refractory_violations(
+        spike_times, spike_labels, num_units, refractory_frames
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        D = 1 - num_violations * num_frames / (num_spikes**2 * refractory_frames)
+    rp_contamination = np.where(D >= 0, 1 - np.sqrt(np.clip(D, 0, None)), 1.0)
+    rp_contamination[num_spikes == 0] = np.nan
+
+    ## Type II errors (false negatives), presence in 20 s bins
+    bin_duration_s = 20.0
+    if num_frames // int(bin_duration_s * sampling_frequency) > 0:
+        bin_counts = get_binned_spike_counts(
+            spike_times,
+            spike_labels,
+            num_units,
+            int(bin_duration_s * sampling_frequency),
+            num_frames,
+        )
+        bin_thresholds = np.floor(num_spikes / duration * bin_duration_s * 0.5)
+        presence_ratio = np.mean(bin_counts > bin_thresholds[:, None], axis=1)
+    else:
+        presence_ratio = np.full(num_units, np.nan)
+    amplitude_cutoff = np.array(
+        [
+            compute_amplitude_cutoff(spike_amplitudes[spike_labels == unit_idx])
+            for unit_idx in range(num_units)
+        ]
+    )
+
+    ## Firing rates, with the range between the 5th and 95th percentile of 0.5 s bins
+    bin_size_s = 0.5
+    if num_frames // int(bin_size_s * sampling_frequency) > 0:
+        bin_rates = (
+            get_binned_spike_counts(
+                spike_times,
+                spike_labels,
+                num_units,
+                int(bin_size_s * sampling_frequency),
+                num_frames,
+            )
+            / bin_size_s
+        )
+        firing_range = np.percentile(bin_rates, 95, axis=1) - np.percentile(
+            bin_rates, 5, axis=1
+        )
+    else:
+        firing_range = np.full(num_units, np.nan)
+
+    return {
+        "num_spikes": num_spikes,
+        "rp_contamination": rp_contamination,
+        "presence_ratio": presence_ratio,
+        "amplitude_cutoff": amplitude_cutoff,
+        "firing_rate": num_spikes / duration,
+        "firing_range": firing_range,
+    }
+
+
+def load_unwhitened_templates(sorter_output: Union[Path, str]) -> np.ndarray:
+    # templates are saved whitened, compare them to the data in data space
+    sorter_output = Path(sorter_output)
+    templates = np.load(sorter_output / "templates.npy").astype(np.float32)
+    if (sorter_output / "whitening_mat_inv.npy").exists():
+        templates = templates @ np.load(sorter_output / "whitening_mat_inv.npy").astype(
+            np.float32
+        )
+    return templates
+
+
+def compute_template_unit_metrics(
+    sorting, sorter_output: Union[Path, str], recording, nt0min=None
+) -> dict:
+    """
+    Computes the same unit metrics as compute_unit_metrics from the Kilosort outputs, without
+    extracting waveforms. As in Phy, each spike is modeled as its amplitude (amplitudes.npy)
+    times the unwhitened template of its spike template, so the template of a unit is the
+    amplitude-weighted mean of the templates of its spikes, which also works for units merged
+    or split in Phy. Spike amplitudes are read from these on the extremum channel of each unit,
+    and SNRs use the shared noise levels of the recording.
+
+    Parameters:
+    - sorting: si.BaseSorting - The sorting, with the cluster IDs of spike_clusters.npy as unit IDs.
+    - sorter_output: Union[Path, str] - The folder with the Kilosort/Phy files of the sorting.
+    - recording: si.BaseRecording - The recording the sorting was computed on.
+    - nt0min: int - The sample of each template at the spike time (default: as Kilosort).
+
+    Returns:
+    - dict: Metric arrays keyed by "unit_ids" and each of UNIT_METRIC_COLUMNS.
+    """
+    sorter_output = Path(sorter_output)
+    spike_times = np.load(sorter_output / "spike_times.npy").ravel().astype(np.int64)
+    spike_clusters = np.load(sorter_output / "spike_clusters.npy").ravel()
+    if (sorter_output / "spike_templates.npy").exists():
+        spike_templates = np.load(sorter_output / "spike_templates.npy").ravel()
+    else:
+        spike_templates = spike_clusters
+    amplitudes = np.load(sorter_output / "amplitudes.npy").ravel().astype(float)
+    templates = load_unwhitened_templates(sorter_output)
+    num_templates, nt, num_chans = templates.shape
+    if nt0min is None:
+        nt0min = int(20 * nt / 61)
+    num_frames = recording.get_num_frames()
+
+    # keep the spikes of units in the sorting which are within the recording bounds
+    unit_ids = np.asarray(sorting.unit_ids)
+    num_units = len(unit_ids)
+    unit_order = np.argsort(unit_ids)
+    positions = np.clip(
+        np.searchsorted(unit_ids[unit_order], spike_clusters), 0, num_units - 1
+    )
+    is_kept = (
+        (unit_ids[unit_order][positions] == spike_clusters)
+        & (spike_times >= 0)
+        & (spike_times < num_frames)
+    )
+    spike_times = spike_times[is_kept]
+    spike_labels = unit_order[positions[is_kept]]
+    spike_templates = spike_templates[is_kept].astype(np.int64)
+    amplitudes = amplitudes[is_kept]
+
+    # amplitude-weighted sum of the templates of each unit's spikes
+    template_weights = np.bincount(
+        spike_labels * num_templates + spike_templates,
+        weights=amplitudes,
+        minlength=num_units * num_templates,
+    ).reshape(num_units, num_templates)
+    num_spikes = np.bincount(spike_labels, minlength=num_units)
+    unit_templates = (template_weights @ templates.reshape(num_templates, -1)).reshape(
+        num_units, nt, num_chans
+    ) / np.maximum(num_spikes, 1)[:, None, None]
+    # largest absolute value of the template over time, as get_template_extremum_amplitude
+    channel_peaks = np.max(np.abs(unit_templates), axis=1)
+    extremum_channels = np.argmax(channel_peaks, axis=1)
+    peak_amplitudes = channel_peaks[np.arange(num_units), extremum_channels]
+    # same as compute_snrs, but with the noise levels shared by all jobs of the group
+    noise_levels = get_recording_noise_levels(recording)
+    snrs = peak_amplitudes / noise_levels[extremum_channels]
+
+    # amplitude of each spike at its spike time on the extremum channel of its unit, with
+    # the sign flipped for units whose template is negative there
+    peak_signs = np.where(
+        unit_templates[np.arange(num_units), nt0min, extremum_channels] < 0, -1, 1
+    )
+    spike_amplitudes = (
+        amplitudes
+        * templates[spike_templates, nt0min, extremum_channels[spike_labels]]
+        * peak_signs[spike_labels]
+    )
+    spike_train_metrics = compute_spike_train_metrics(
+        spike_times,
+        spike_labels,
+        spike_amplitudes,
+        num_units,
+        num_frames,
+        recording.get_sampling_frequency(),
+    )
+    return {
+        "unit_ids": unit_ids,
+        **spike_train_metrics,
+        "snr": snrs,
+        "peak_amplitude": peak_amplitudes.astype(float),
+        "extremum_channel": extremum_channels.astype(float),
+    }
+
+
+def save_unit_metrics(metrics_path: Path, metrics: dict, context: np.ndarray):
+    # one array per column, so single metrics can be loaded without the others
+    np.savez(metrics_path, context=context, **metrics)
+
+
+def load_unit_metrics(metrics_path: Path, context: np.ndarray) -> Union[dict, None]:
+    """
+    Loads previously saved unit metrics, or returns None if they do not exist or were computed
+    with different settings.
+    """
+    if not Path(metrics_path).exists():
+        return None
+    with np.load(metrics_path) as f:
+        if "context" not in f or not np.array_equal(f["context"], context):
+            return None
+        return {key: f[key] for key in f.files if key != "context"}
+
+
+def compute_waveform_summary(we, extremum_channels: np.ndarray) -> dict:
+    """
+    Summarizes the extracted waveforms of all units, so downstream tools can plot units without
+    reading recording.dat. The summary is saved compactly by save_waveform_summary.
+
+    Parameters:
+    - we: UnitWaveforms - The extracted waveforms of the sorting.
+    - extremum_channels: np.ndarray - The index of the extremum channel of each unit.
+
+    Returns:
+    - dict: Arrays keyed by "unit_ids", "templates_mean" and "templates_std" (units x samples x
+      channels), "waveforms" (a fixed subsample of spikes on the extremum channel, NaN-padded),
+      and "amplitude_hist" and "amplitude_bins" (histograms of the extremum channel amplitudes).
+    """
+    num_units = len(we.unit_ids)
+    nt = we.nbefore + we.nafter
+    rng = np.random.default_rng(0)
+    waveforms = np.full((num_units, WAVEFORM_SUMMARY_SPIKES, nt), np.nan)
+    amplitude_hist = np.zeros((num_units, WAVEFORM_SUMMARY_BINS))
+    amplitude_bins = np.zeros((num_units, WAVEFORM_SUMMARY_BINS + 1))
+    for idx, unit_id in enumerate(we.unit_ids):
+        unit_waveforms = we.get_waveforms(unit_id)[:, :, int(extremum_channels[idx])]
+        if len(unit_waveforms) == 0:
+            continue
+        subsample = np.sort(
+            rng.choice(
+                len(unit_waveforms),
+                min(WAVEFORM_SUMMARY_SPIKES, len(unit_waveforms)),
+                replace=False,
+            )
+        )
+        waveforms[idx, : len(subsample)] = unit_waveforms[subsample]
+        amplitude_hist[idx], amplitude_bins[idx] = np.histogram(
+            unit_waveforms[:, we.nbefore], bins=WAVEFORM_SUMMARY_BINS, density=True
+        )
+    return {
+        "unit_ids": np.asarray(we.unit_ids),
+        "templates_mean": we.get_all_templates(mode="average").astype(np.float32),
+        "templates_std": we.get_all_templates(mode="std").astype(np.float32),
+        "waveforms": waveforms.astype(np.float32),
+        "amplitude_hist": amplitude_hist.astype(np.float32),
+        "amplitude_bins": amplitude_bins.astype(np.float32),
+    }
+
+
+def save_waveform_summary(summary_path: Path, summary: dict, context: np.ndarray):
+    """
+    Saves a waveform summary with the columns in the units of the recording as float16, after
+    dividing each unit by a float32 scale (the largest absolute value of the unit in these
+    columns), so large amplitudes do not overflow and small units keep their precision. The
+    amplitude histograms, whose density values can exceed the float16 range, are saved as float32.
+    """
+    num_units = len(summary["unit_ids"])
+    scales = np.zeros(num_units, dtype=np.float32)
+    if num_units > 0:
+        for column in WAVEFORM_SUMMARY_SCALED_COLUMNS:
+            # fmax ignores the NaN padding of the waveforms
+            scales = np.fmax(
+                scales,
+                np.fmax.reduce(
+                    np.abs(summary[column]).reshape(num_units, -1), axis=1, initial=0
+                ),
+            )
+    scales[scales == 0] = 1
+    saved = dict(summary, scales=scales.astype(np.float32))
+    for column in WAVEFORM_SUMMARY_SCALED_COLUMNS:
+        saved[column] = (
+            summary[column] / scales.reshape((-1,) + (1,) * (summary[column].ndim - 1))
+        ).astype(np.float16)
+    saved["amplitude_hist"] = summary["amplitude_hist"].astype(np.float32)
+    np.savez(summary_path, context=context, **saved)
+
+
+def load_waveform_summary(summary_path: Path, context: np.ndarray) -> Union[dict, None]:
+    """
+    Loads a waveform summary saved by save_waveform_summary, with all columns as float32 in the
+    units of the recording. Returns None if it does not exist, was computed with different
+    settings, or was saved without unit scales by an older version.
+    """
+    summary = load_unit_metrics(summary_path, context)
+    if summary is None or "scales" not in summary:
+        return None
+    scales = summary.pop("scales")
+    for column in WAVEFORM_SUMMARY_SCALED_COLUMNS:
+        summary[column] = summary[column].astype(np.float32) * scales.reshape(
+            (-1,) + (1,) * (summary[column].ndim - 1)
+        )
+    return summary
+
+
+def merge_unit_rows(
+    unit_ids, fingerprints, cached: dict, cached_rows: dict, new: dict, columns: list
+) -> dict:
+    """
+    Combines per-unit arrays of unchanged units (cached, found by fingerprint) and of new or
+    changed units (new, found by unit id), in the order of unit_ids.
+    """
+    if len(unit_ids) == 0:
+        return {column: np.zeros(0) for column in columns}
+    merged = {}
+    if new is not None:
+        new_rows = {unit_id: row for row, unit_id in enumerate(new["unit_ids"])}
+    for column in columns:
+        merged[column] = np.stack(
+            [
+                (
+                    cached[column][cached_rows[fingerprint]]
+                    if fingerprint in cached_rows
+                    else new[column][new_rows[unit_id]]
+                )
+                for unit_id, fingerprint in zip(unit_ids, fingerprints)
+            ]
+        )
+    return merged
+
+
+def update_unit_metrics(
+    recording, sorting, metrics_path: Path, ms_buffer: float, wid=0
+) -> dict:
+    """
+    Computes the unit metrics of a sorting, reusing saved metrics of all units whose spike train
+    is unchanged (matched by fingerprint). Waveforms are only extracted for new or changed units,
+    such as those produced by merges and splits during manual curation in Phy. The updated
+    metrics are saved to metrics_path.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording the sorting was computed on.
+    - sorting: si.BaseSorting - The (possibly curated) sorting.
+    - metrics_path: Path - The path of the unit metrics file.
+    - ms_buffer: float - The waveform length before and after each spike in ms.
+    - wid: int - The worker ID used in printed messages.
+
+    Returns:
+    - dict: Metric arrays for all units of the sorting, in the order of sorting.unit_ids.
+    """
+    context = get_metrics_context(recording, ms_buffer)
+    fingerprints = get_unit_fingerprints(sorting)
+    summary_path = Path(metrics_path).parent / WAVEFORM_SUMMARY_FILENAME
+    cached_metrics = load_unit_metrics(metrics_path, context)
+    cached_summary = load_waveform_summary(summary_path, context)
+    cached_rows, cached_summary_rows = {}, {}
+    if cached_metrics is not None:
+        cached_rows = {
+            fingerprint: row
+            for row, fingerprint in enumerate(cached_metrics["fingerprints"])
+        }
+    if cached_summary is not None:
+        cached_summary_rows = {
+            fingerprint: row
+            for row, fingerprint in enumerate(cached_summary["fingerprints"])
+        }
+    # units without cached metrics or waveform summary need their waveforms extracted
+    changed_unit_ids = [
+        unit_id
+        for unit_id, fingerprint in zip(sorting.unit_ids, fingerprints)
+        if fingerprint not in cached_rows or fingerprint not in cached_summary_rows
+    ]
+    cached_rows = {
+        fingerprint: row
+        for fingerprint, row in cached_rows.items()
+        if fingerprint in cached_summary_rows
+    }
+    print(
+        f"Worker {wid} reusing metrics of {len(sorting.unit_ids) - len(changed_unit_ids)} units, "
+        f"computing metrics of {len(changed_unit_ids)} new or changed units..."
+    )
+    new_metrics = new_summary = None
+    if len(changed_unit_ids) > 0:
+        we = extract_waveforms_in_memory(
+            recording, sorting.select_units(changed_unit_ids), ms_buffer
+        )
+        new_metrics = compute_unit_metrics(we)
+        new_summary = compute_waveform_summary(we, new_metrics["extremum_channel"])
+
+    metrics = {
+        "unit_ids": np.asarray(sorting.unit_ids),
+        "fingerprints": fingerprints,
+        **merge_unit_rows(
+            sorting.unit_ids,
+            fingerprints,
+            cached_metrics,
+            cached_rows,
+            new_metrics,
+            UNIT_METRIC_COLUMNS,
+        ),
+    }
+    summary = {
+        "unit_ids": np.asarray(sorting.unit_ids),
+        "fingerprints": fingerprints,
+        **merge_unit_rows(
+            sorting.unit_ids,
+            fingerprints,
+            cached_summary,
+            cached_summary_rows,
+            new_summary,
+            WAVEFORM_SUMMARY_COLUMNS,
+        ),
+    }
+    save_unit_metrics(metrics_path, metrics, context)
+    save_waveform_summary(summary_path, summary, context)
+    return metrics
+
+
+def get_emusort_scores(metrics, wid):
+    """
+    Computes the EMUsort quality scores of each unit and the overall EMUsort score from the unit
+    metrics. Since only the metrics are cached, changes to this formula only require rerunning
+    this function.
+
+    Parameters:
+    - metrics: dict - The unit metrics, as returned by compute_unit_metrics or update_unit_metrics.
+    - wid: int - The worker ID used in the report.
+
+    Returns:
+    - tuple: (snr_scores, firing_rate_validity_scores, type_I_scores, type_II_scores,
+      emusort_scores, emusort_score, report)
+    """
+    ### Compute sorting quality metrics, Overall EMUsort score
+    ## Check Type I errors (false positives)
+    type_I_scores = 1 - metrics["rp_contamination"]
+
+    ## Check Type II errors (false negatives)
+    amplitude_Gaussianity_scores = 1 - metrics["amplitude_cutoff"]
+    denan_amplitude_Gaussianity_scores = np.nan_to_num(
+        amplitude_Gaussianity_scores,
+        nan=0,  # if nan, replace with 0 (bad score due to too few spikes)
+    )
+    type_II_scores = denan_amplitude_Gaussianity_scores * metrics["presence_ratio"]
+
+    ## Check Firing Rates Validity Against Known MU properties (200Hz sigmoid dropoff)
+    firing_rate_viol_scores = 1 / (1 + np.exp((metrics["firing_rate"] + 1e-8) - 200))
+    firing_range_viol_scores = 1 / (1 + np.exp((metrics["firing_range"] + 1e-8) - 200))
+    firing_rate_validity_scores = firing_rate_viol_scores * firing_range_viol_scores
+
+    # set sigmoid so that the score is 0.5 at 4
+    snr_scores = 1 - (1 / (1 + np.exp((metrics["snr"] - 4))))
+    # clip it 0 to 1 to prevent the plunge to negative infinity when the sd to snr ratio is > 1
+    clipped_snr_scores = np.clip(snr_scores, 0, 1)
+
+    # produce overall score, accounting for all quality metrics
+    emusort_scores = (
+        clipped_snr_scores
+        * firing_rate_validity_scores
+        * type_I_scores
+        * type_II_scores
+    )
+    emusort_score = np.nanmean(emusort_scores)
+
+    # get quality metric report string for this worker
+    report = (
+        "------------------------------------------------------------\n"
+        f" Worker {wid} Quality Scores Report:\n"
+        f" SNR scores:\n{clipped_snr_scores}\n"
+        f" Firing rate validity:\n{firing_rate_validity_scores}\n"
+        f" Type I error scores:\n{type_I_scores}\n"
+        f" Type II error scores:\n{type_II_scores}\n"
+        f" EMUsort scores:\n{emusort_scores}\n"
+        "------------------------------------------------------------\n"
+        f" Worker {wid} Overall EMUsort score: {emusort_score:.3f}\n"
+        "------------------------------------------------------------\n"
+    )
+    return (
+        clipped_snr_scores,
         firing_rate_validity_scores,
         type_I_scores,
         type_II_scores,
         emusort_scores,
         emusort_score,
         report,
-    ) = get_emusort_scores(we, wid)
+    )
+
+
+def add_results_to_config(
+    this_config,
+    snr_scores,
+    firing_rate_validity_scores,
+    type_I_scores,
+    type_II_scores,
+    emusort_scores,
+):
+    this_config["Results"] = {}
+    this_config["Results"]["snr_scores"] = snr_scores.tolist()
+    this_config["Results"][
+        "firing_rate_validity_scores"
+    ] = firing_rate_validity_scores.tolist()
+    this_config["Results"]["type_I_scores"] = type_I_scores.tolist()
+    this_config["Results"]["type_II_scores"] = type_II_scores.tolist()
+    this_config["Results"]["emusort_scores"] = emusort_scores.tolist()
+
+
+QUANTIZATION_MARGIN = 1.001  # int16 range relative to the signal range of each channel
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def _init_quantization_worker(recording, file_path, gains, offsets):
+    # the recording is serialized to a dict when sent to worker processes
+    if isinstance(recording, dict):
+        recording = si.load_extractor(recording)
+    worker_ctx = {"recording": recording, "gains": gains, "offsets": offsets}
+    if file_path is not None:
+        worker_ctx["quantized"] = np.memmap(
+            file_path,
+            dtype=np.int16,
+            mode="r+",
+            shape=(recording.get_num_frames(), recording.get_num_channels()),
+        )
+    return worker_ctx
+
+
+def _get_chunk_range(segment_index, start_frame, end_frame, worker_ctx):
+    traces = worker_ctx["recording"].get_traces(
+        segment_index=segment_index,
+        start_frame=start_frame,
+        end_frame=end_frame,
+        return_scaled=False,
+    )
+    return traces.min(axis=0), traces.max(axis=0)
+
+
+def _write_quantized_chunk(segment_index, start_frame, end_frame, worker_ctx):
+    gains, offsets = worker_ctx["gains"], worker_ctx["offsets"]
+    traces = (
+        worker_ctx["recording"]
+        .get_traces(
+            segment_index=segment_index,
+            start_frame=start_frame,
+            end_frame=end_frame,
+            return_scaled=False,
+        )
+        .astype(np.float32)
+    )
+    quantized = np.rint((traces - offsets) / gains)
+    clipped_samples = int(np.sum(np.abs(quantized) > INT16_MAX))
+    quantized = np.clip(quantized, -INT16_MAX, INT16_MAX)
+    # rounding error, at most half a step, plus the error of any clipped samples
+    max_error = np.max(np.abs(quantized * gains + offsets - traces), axis=0)
+    worker_ctx["quantized"][start_frame:end_frame] = quantized.astype(np.int16)
+    return max_error, clipped_samples
+
+
+def run_quantization_pass(
+    recording: si.BaseRecording,
+    func,
+    job_name: str,
+    file_path: Path = None,
+    gains: np.ndarray = None,
+    offsets: np.ndarray = None,
+    **job_kwargs,
+) -> list:
+    """
+    Runs one chunked pass over a recording with spikeinterface's ChunkRecordingExecutor, which
+    spreads the chunks over n_jobs workers as set by the job kwargs.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording to go over.
+    - func: callable - Function run on each chunk, returning a result for it.
+    - job_name: str - The name of the pass, shown in the progress bar.
+    - file_path: Path - The int16 binary file written by the workers, if any.
+    - gains: np.ndarray - The gain of each channel, if any.
+    - offsets: np.ndarray - The offset of each channel, if any.
+
+    Returns:
+    - list: The result of each chunk.
+    """
+    from spikeinterface.core.job_tools import ChunkRecordingExecutor, fix_job_kwargs
+
+    job_kwargs = fix_job_kwargs(job_kwargs)
+    # processes rebuild the recording from its dict, threads and the main process share it
+    worker_recording = recording if job_kwargs["n_jobs"] == 1 else recording.to_dict()
+    executor = ChunkRecordingExecutor(
+        recording,
+        func,
+        _init_quantization_worker,
+        (worker_recording, file_path, gains, offsets),
+        handle_returns=True,
+        job_name=job_name,
+        **job_kwargs,
+    )
+    return executor.run()
+
+
+def get_quantization_params(recording: si.BaseRecording, **job_kwargs) -> tuple:
+    """
+    Chooses the per-channel gain and offset to quantize a recording to int16, from the full range
+    of each channel over the whole recording (with QUANTIZATION_MARGIN for float rounding), such
+    that no sample is clipped. They are computed once and stored as channel properties of the
+    recording, so every job sharing the recording of a group reuses them instead of reading all
+    of its data again.
+
+    Returns:
+    - tuple: (gains, offsets), such that traces = int16_traces * gains + offsets.
+    """
+    gains = recording.get_property("quantization_gain")
+    offsets = recording.get_property("quantization_offset")
+    if gains is not None and offsets is not None:
+        return gains, offsets
+    chunk_ranges = run_quantization_pass(
+        recording, _get_chunk_range, "quantization range", **job_kwargs
+    )
+    lows = np.min([low for low, _ in chunk_ranges], axis=0).astype(np.float64)
+    highs = np.max([high for _, high in chunk_ranges], axis=0).astype(np.float64)
+    offsets = (highs + lows) / 2
+    gains = (highs - lows) / 2 * QUANTIZATION_MARGIN / INT16_MAX
+    # flat channels would otherwise have no gain
+    gains[gains <= 0] = 1.0
+    gains, offsets = gains.astype(np.float32), offsets.astype(np.float32)
+    recording.set_property("quantization_gain", gains)
+    recording.set_property("quantization_offset", offsets)
+    return gains, offsets
+
+
+def load_group_quantization_params(
+    recording, quantization_path: Union[Path, None] = None
+):
+    """
+    Computes the int16 quantization gains and offsets of a channel group's preprocessed recording
+    once, storing them with the recording for all jobs of the group. If quantization_path is
+    given, they are saved to it and loaded from it when the preprocessed data is reused.
+    """
+    if quantization_path is not None and Path(quantization_path).exists():
+        gains, offsets = np.load(quantization_path)
+        recording.set_property("quantization_gain", gains)
+        recording.set_property("quantization_offset", offsets)
+        return
+    gains, offsets = get_quantization_params(recording)
+    if quantization_path is not None:
+        np.save(quantization_path, np.stack([gains, offsets]))
+
+
+def write_quantized_recording(
+    recording: si.BaseRecording,
+    file_path: Path,
+    gains: np.ndarray,
+    offsets: np.ndarray,
+    **job_kwargs,
+) -> dict:
+    """
+    Writes a single-segment recording to a binary file as int16 in chunks spread over the job
+    kwargs' workers, rounding to the nearest step and clipping values outside the int16 range,
+    while measuring the error.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording to write.
+    - file_path: Path - The path of the binary file.
+    - gains: np.ndarray - The gain of each channel.
+    - offsets: np.ndarray - The offset of each channel.
+
+    Returns:
+    - dict: The "max_error" of each channel over all samples, including clipped ones, and the
+      number of "clipped_samples" which were out of range.
+    """
+    assert (
+        recording.get_num_segments() == 1
+    ), "Only single-segment recordings can be quantized"
+    num_bytes = recording.get_num_frames() * recording.get_num_channels() * 2
+    with open(file_path, "wb") as f:
+        f.truncate(num_bytes)
+    if num_bytes == 0:
+        return {
+            "max_error": np.zeros(recording.get_num_channels()),
+            "clipped_samples": 0,
+        }
+    chunk_stats = run_quantization_pass(
+        recording,
+        _write_quantized_chunk,
+        "write quantized recording",
+        file_path=file_path,
+        gains=gains,
+        offsets=offsets,
+        **job_kwargs,
+    )
+    return {
+        "max_error": np.max([max_error for max_error, _ in chunk_stats], axis=0),
+        "clipped_samples": sum(clipped for _, clipped in chunk_stats),
+    }
+
+
+def write_rec_and_params(
+    recording,
+    sorted_folder,
+    this_sorting,
+    this_config,
+    use_relative_path=True,
+    dtype=None,
+    quantize=False,
+    **job_kwargs,
+):
+    # save dat file
+    if dtype is None:
+        dtype = recording.get_dtype()
+
+    quantization_params = None
+    rec_path = sorted_folder / "recording.dat"
+    if quantize:
+        # half the size of float32, with the scaling saved in params.py
+        dtype = "int16"
+        gains, offsets = get_quantization_params(recording, **job_kwargs)
+        stats = write_quantized_recording(
+            recording, rec_path, gains, offsets, **job_kwargs
+        )
+        noise_levels = get_recording_noise_levels(recording)
+        relative_error = stats["max_error"] / noise_levels
+        print(
+            f"Quantized recording.dat to int16 with a maximum error of {np.max(relative_error):.2%} "
+            f"of the channel noise level, {stats['clipped_samples']} samples were clipped."
+        )
+        if stats["clipped_samples"] > 0:
+            print(
+                f"WARNING: {stats['clipped_samples']} samples of recording.dat were clipped to "
+                "the int16 range, set quantize_recording_dat: false to keep them exact."
+            )
+        quantization_params = (gains, offsets)
+    else:
+        write_binary_recording(
+            recording, file_paths=rec_path, dtype=dtype, **job_kwargs
+        )
+
+    dtype_str = np.dtype(dtype).name
+
+    # write params.py
+    # if exists delete
+    if (sorted_folder / "params.py").exists():
+        (sorted_folder / "params.py").unlink()
+        # create new
+        Path(sorted_folder / "params.py").touch()
+    with (sorted_folder / "params.py").open("w") as f:
+        if use_relative_path:
+            f.write(f"dat_path = r'recording.dat'\n")
+        else:
+            f.write(f"dat_path = r'{str(rec_path)}'\n")
+        f.write(f"n_channels_dat = {this_config['num_chans']}\n")
+        f.write(f"dtype = '{dtype_str}'\n")
+        if quantization_params is not None:
+            # data = recording.dat * quantization_gain + quantization_offset, per channel
+            f.write(f"quantization_gain = {quantization_params[0].tolist()}\n")
+            f.write(f"quantization_offset = {quantization_params[1].tolist()}\n")
+        f.write(f"offset = 0\n")
+        f.write(f"sample_rate = {this_sorting.get_sampling_frequency()}\n")
+        f.write(f"hp_filtered = {recording.is_filtered()}")
+
+
+async def extract_sorting_result(
+    this_sorting, this_config, this_job, wid, progress=None
+):
+    """
+    Asynchronous version of extract_sorting_result, offloading blocking I/O tasks to background threads.
+    """
+    # Save sorting results by exporting to Phy format
+    sorted_folder = Path(this_config["Sorting"]["sorted_folder"])
+
+    # get nt size from the sorting object, which is the width of the waveforms
+    sampling_frequency = this_sorting.get_sampling_frequency()
+    nt = this_config["KS"]["nt"]
+    ms_buffer = nt / sampling_frequency * 1000 / 2
+    recording = this_job["recording"]
+    scoring_method = this_config["SI"]["scoring_method"]
+    # may already be moved if this task is retried after running out of resources
+    sorter_output = sorted_folder / "sorter_output"
+    if not sorter_output.exists():
+        sorter_output = sorted_folder
+
+    if scoring_method == "templates":
+        print(f"Worker {wid} computing quality metrics from the Kilosort outputs...")
+        if progress is not None:
+            progress.set_state(wid, "scoring")
+        unit_metrics = await asyncio.to_thread(
+            compute_template_unit_metrics,
+            this_sorting,
+            sorter_output,
+            recording,
+            this_config["KS"].get("nt0min"),
+        )
+        waveform_summary = None
+    else:
+        print(
+            f"Worker {wid} extracting waveforms with nt={nt} at fs={sampling_frequency} Hz (ms_before=ms_after={np.round(ms_buffer, 3)} ms)."
+        )
+        if progress is not None:
+            progress.set_state(wid, "extracting")
+        we = await asyncio.to_thread(
+            extract_waveforms_in_memory, recording, this_sorting, ms_buffer
+        )
+        print(
+            f"Worker {wid} finished extracting waveforms, computing quality metrics..."
+        )
+        if progress is not None:
+            progress.set_state(wid, "scoring")
+
+        # Compute quality metrics
+        unit_metrics = compute_unit_metrics(we)
+        waveform_summary = compute_waveform_summary(
+            we, unit_metrics["extremum_channel"]
+        )
+        del we
+    if progress is not None:
+        progress.set_info(wid, num_units=len(unit_metrics["unit_ids"]))
+    unit_metrics["fingerprints"] = get_unit_fingerprints(this_sorting)
+    (
+        snr_scores,
+        firing_rate_validity_scores,
+        type_I_scores,
+        type_II_scores,
+        emusort_scores,
+        emusort_score,
+        report,
+    ) = get_emusort_scores(unit_metrics, wid)
+
+    # get channel noise levels, computed once for all workers of the group
+    emg_chan_noise_levels = get_recording_noise_levels(recording, scaled=True)
+
+    this_config["emg_chan_noise"] = emg_chan_noise_levels.tolist()
+    # add Results section to this_config
+    add_results_to_config(
+        this_config,
+        snr_scores,
+        firing_rate_validity_scores,
+        type_I_scores,
+        type_II_scores,
+        emusort_scores,
+    )
+    print(f"Worker {wid} exporting to Phy format...")
+    if progress is not None:
+        progress.set_state(wid, "exporting")
+
+    # Export to Phy format asynchronously
+    # await asyncio.to_thread(
+    #     export_to_phy,
+    #     we,
+    #     output_folder=phy_folder,
+    #     compute_pc_features=False,
+    #     copy_binary=True,
+    #     use_relative_path=True,
+    #     verbose=False,
+    # )
+    if sorter_output != sorted_folder:
+        movetree(sorter_output, sorted_folder)
+        shutil.rmtree(sorter_output, ignore_errors=True)
+
+    await asyncio.to_thread(
+        write_rec_and_params,
+        recording,
+        sorted_folder,
+        this_sorting,
+        this_config,
+        use_relative_path=True,
+        quantize=this_config["SI"]["quantize_recording_dat"],
+    )
+
+    print(
+        f"Worker {wid} finished exporting to Phy format, consolidating files into final folder..."
+    )
+
+    # Create timestamp with microsecond precision to prevent duplicate folder names
+    time_stamp_us = datetime.now().strftime("%Y%m%d_%H%M%S%f")
+
+    # build params_suffix as a string without trailing underscore
+    if this_config["Sorting"]["do_KS_param_sweep"] == 1:
+        param_strings = [
+            f"P{pid}_{this_config['KS'][param_key]}"
+            for pid, param_key in enumerate(
+                this_config["Sorting"]["KS_params_to_sweep"].keys()
+            )
+        ]
+        params_suffix = "_" + "_".join(param_strings) if param_strings else ""
+    else:
+        params_suffix = ""
+
+    sorted_folder = this_config["Sorting"]["sorted_folder"]
+    base_name = Path(sorted_folder).name.split("_wkr", 1)[0]
+
+    # construct filename string (assumes "sorted_" always present)
+    name = f"{base_name}{params_suffix}"
+    name = name.replace("sorted_", f"sorted_{time_stamp_us}_", 1)
+
+    if len(this_config["Group"]["emg_chan_list"]) == 1:
+        name = name.replace("_g0", "")
+
+    # remove unwanted chars and trailing commas/underscores
+    name = "".join(char for char in name if char not in " ()[]").rstrip(",_")
+
+    # append score and optional tag
+    name = f"{name}_SCORE_{emusort_score:.3f}"
+    if this_config["sort_type"] == "ks4":
+        name += "_KS4"
+
+    final_path = Path(sorted_folder).parent / name
+
+    # move and save
+    shutil.move(sorted_folder, final_path)
+    dump_yaml(final_path / f'{this_config["sort_type"]}_config.yaml', this_config)
+    np.save(final_path / "emg_chans_used.npy", this_config["emg_chans_used"])
+    if this_config.get("epochs"):
+        np.save(final_path / "epochs.npy", np.array(this_config["epochs"]))
+        np.save(
+            final_path / "spike_times_original.npy",
+            map_to_original_frames(
+                np.load(final_path / "spike_times.npy").ravel(), this_config["epochs"]
+            ),
+        )
+    if this_config.get("resampling"):
+        # spike times at the native sampling rate, of the original timebase with time_windows
+        spike_times = np.load(final_path / "spike_times.npy").ravel()
+        if this_config.get("epochs"):
+            spike_times = map_to_original_frames(spike_times, this_config["epochs"])
+        np.save(
+            final_path / "spike_times_native.npy",
+            map_to_native_frames(spike_times, this_config["resampling"]),
+        )
+    save_unit_metrics(
+        final_path / UNIT_METRICS_FILENAME,
+        unit_metrics,
+        get_metrics_context(recording, ms_buffer, scoring_method),
+    )
+    if waveform_summary is not None:
+        waveform_summary["fingerprints"] = unit_metrics["fingerprints"]
+        save_waveform_summary(
+            final_path / WAVEFORM_SUMMARY_FILENAME,
+            waveform_summary,
+            get_metrics_context(recording, ms_buffer),
+        )
+
+    if progress is not None:
+        progress.set_state(wid, "done")
+
+    phy_msg = f"\nTo view Worker {wid} result in Phy, run:\nphy template-gui {(final_path / 'params.py').as_posix()}\n"
+
+    return {
+        "report": report,
+        "phy_msg": phy_msg,
+        "result_folder": final_path,
+        "emusort_score": emusort_score,
+        "unit_metrics": unit_metrics,
+    }
+
+
+def get_time_windows(
+    num_frames: int,
+    sampling_frequency: float,
+    window_duration: float,
+    window_overlap: float,
+) -> list:
+    """
+    Splits a recording into overlapping time windows which can be sorted in parallel.
+
+    A remainder shorter than half a window is folded into the previous window, so every window
+    contains enough data for Kilosort to learn templates.
+
+    Parameters:
+    - num_frames: int - The number of frames in the recording.
+    - sampling_frequency: float - The sampling frequency of the recording in Hz.
+    - window_duration: float - The duration of each window in seconds.
+    - window_overlap: float - The overlap between consecutive windows in seconds.
+
+    Returns:
+    - list: A list of (start_frame, end_frame) tuples covering the whole recording.
+    """
+    window_frames = int(round(window_duration * sampling_frequency))
+    overlap_frames = int(round(window_overlap * sampling_frequency))
+    assert (
+        window_frames > 2 * overlap_frames
+    ), "window_overlap must be less than half of window_duration."
+
+    windows = []
+    start_frame = 0
+    while True:
+        end_frame = min(start_frame + window_frames, num_frames)
+        windows.append((start_frame, end_frame))
+        if end_frame >= num_frames:
+            break
+        start_frame = end_frame - overlap_frames
+    if len(windows) > 1 and windows[-1][1] - windows[-1][0] < window_frames / 2:
+        windows.pop()
+        windows[-1] = (windows[-1][0], num_frames)
+    return windows
+
+
+def load_window_sorting(sorter_output: Path, start_frame: int) -> dict:
+    """
+    Loads the Kilosort output of one time window, with spike times shifted to the timebase of
+    the full recording and templates unwhitened so they are comparable across windows.
+    """
+    spike_times = np.load(sorter_output / "spike_times.npy").ravel().astype(np.int64)
+    spike_clusters = np.load(sorter_output / "spike_clusters.npy").ravel()
+    if (sorter_output / "spike_templates.npy").exists():
+        spike_templates = np.load(sorter_output / "spike_templates.npy").ravel()
+    else:
+        spike_templates = spike_clusters
+    # each window has its own whitening matrix, so compare templates in data space
+    templates = np.load(sorter_output / "templates.npy") @ np.load(
+        sorter_output / "whitening_mat_inv.npy"
+    )
+    unit_ids = np.unique(spike_clusters)
+    # use the template most of the unit's spikes were assigned to
+    unit_templates = np.zeros((len(unit_ids), *templates.shape[1:]))
+    for idx, unit_id in enumerate(unit_ids):
+        unit_templates[idx] = templates[
+            np.bincount(spike_templates[spike_clusters == unit_id]).argmax()
+        ]
+    return {
+        "spike_times": spike_times + start_frame,
+        "spike_clusters": spike_clusters,
+        "spike_templates": spike_templates,
+        # each spike is its amplitude times the template of its spike template
+        "amplitudes": np.load(sorter_output / "amplitudes.npy").ravel(),
+        "templates": templates,
+        "unit_ids": unit_ids,
+        "unit_templates": unit_templates,
+    }
+
+
+def match_window_units(
+    window1: dict,
+    window2: dict,
+    overlap: tuple,
+    delta_frames: int,
+    min_template_similarity: float,
+    min_spike_agreement: float,
+) -> list:
+    """
+    Matches the units of two consecutive time windows using the cosine similarity of their
+    templates and the agreement of their spike times inside the overlapping region.
+
+    Parameters:
+    - window1: dict - The first window, as returned by load_window_sorting.
+    - window2: dict - The second window, as returned by load_window_sorting.
+    - overlap: tuple - The (start_frame, end_frame) of the overlapping region.
+    - delta_frames: int - The maximum time difference for two spikes to be coincident.
+    - min_template_similarity: float - The minimum template similarity of a matched pair.
+    - min_spike_agreement: float - The minimum spike agreement of a matched pair.
+
+    Returns:
+    - list: A list of (unit_index1, unit_index2) tuples, indexing into each window's unit_ids.
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    num_units1, num_units2 = len(window1["unit_ids"]), len(window2["unit_ids"])
+    if num_units1 == 0 or num_units2 == 0:
+        return []
+
+    flat_templates1 = window1["unit_templates"].reshape(num_units1, -1)
+    flat_templates2 = window2["unit_templates"].reshape(num_units2, -1)
+    template_similarity = (flat_templates1 @ flat_templates2.T) / (
+        np.linalg.norm(flat_templates1, axis=1)[:, None]
+        * np.linalg.norm(flat_templates2, axis=1)[None, :]
+        + 1e-12
+    )
+
+    def get_overlap_spikes(window):
+        # spike times in the overlap, sorted, with the index of their unit in unit_ids
+        in_overlap = (window["spike_times"] >= overlap[0]) & (
+            window["spike_times"] < overlap[1]
+        )
+        times = window["spike_times"][in_overlap]
+        labels = np.searchsorted(
+            window["unit_ids"], window["spike_clusters"][in_overlap]
+        )
+        order = np.argsort(times, kind="stable")
+        return times[order], labels[order]
+
+    times1, labels1 = get_overlap_spikes(window1)
+    times2, labels2 = get_overlap_spikes(window2)
+    # count the spikes of each unit of window1 with a spike of each unit of window2 within
+    # delta_frames, for all pairs of units at once
+    first = np.searchsorted(times2, times1 - delta_frames, side="left")
+    last = np.searchsorted(times2, times1 + delta_frames, side="right")
+    coincident_pairs = []
+    for k in range(int(np.max(last - first, initial=0))):
+        has_kth = first + k < last
+        coincident_pairs.append(
+            np.flatnonzero(has_kth) * num_units2 + labels2[first[has_kth] + k]
+        )
+    # each spike of window1 counts once per unit of window2
+    spike_unit_pairs = np.unique(np.concatenate([[]] + coincident_pairs)).astype(
+        np.int64
+    )
+    num_matches = np.bincount(
+        labels1[spike_unit_pairs // num_units2] * num_units2
+        + spike_unit_pairs % num_units2,
+        minlength=num_units1 * num_units2,
+    ).reshape(num_units1, num_units2)
+    num_total = (
+        np.bincount(labels1, minlength=num_units1)[:, None]
+        + np.bincount(labels2, minlength=num_units2)[None, :]
+        - num_matches
+    )
+    spike_agreement = np.divide(
+        num_matches,
+        num_total,
+        out=np.zeros((num_units1, num_units2)),
+        where=num_total > 0,
+    )
+
+    is_valid = (template_similarity >= min_template_similarity) & (
+        spike_agreement >= min_spike_agreement
+    )
+    rows, cols = linear_sum_assignment(-np.where(is_valid, spike_agreement, 0))
+    return [(i, j) for i, j in zip(rows, cols) if is_valid[i, j]]
+
+
+def merge_window_sortings(
+    sorter_outputs: list,
+    windows: list,
+    merged_output: Path,
+    this_config: dict,
+    num_frames: int,
+    sampling_frequency: float,
+) -> si.BaseSorting:
+    """
+    Merges the Kilosort outputs of overlapping time windows into a single sorting.
+
+    Units are matched between consecutive windows and matched units share one merged unit ID.
+    Spikes inside each overlap are taken from the earlier window up to the middle of the overlap,
+    and from the later window afterwards, so no spike is counted twice. The merged result is saved
+    in the usual Kilosort/Phy format, with unwhitened templates and identity whitening matrices.
+    As each window is whitened separately, the spike amplitudes of each window are rescaled to the
+    merged template of their unit, by projecting the spike's amplitude times its window template
+    onto it, so the amplitudes of a merged unit are on one scale across windows.
+
+    Parameters:
+    - sorter_outputs: list - The "sorter_output" folders of each window, in time order.
+    - windows: list - The (start_frame, end_frame) tuples of each window.
+    - merged_output: Path - The folder to save the merged Kilosort/Phy files to.
+    - this_config: dict - The configuration dictionary containing the matching thresholds.
+    - num_frames: int - The number of frames in the full recording.
+    - sampling_frequency: float - The sampling frequency of the recording in Hz.
+
+    Returns:
+    - si.BaseSorting: The merged sorting object.
+    """
+    delta_frames = int(round(0.4 * sampling_frequency / 1000))  # 0.4 ms
+    window_sortings = [
+        load_window_sorting(Path(sorter_output), start_frame)
+        for sorter_output, (start_frame, _) in zip(sorter_outputs, windows)
+    ]
+
+    # assign merged unit IDs, carrying them over to matched units of the next window
+    merged_unit_ids = [np.arange(len(window_sortings[0]["unit_ids"]))]
+    num_merged_units = len(merged_unit_ids[0])
+    for iWin in range(1, len(window_sortings)):
+        matches = match_window_units(
+            window_sortings[iWin - 1],
+            window_sortings[iWin],
+            (windows[iWin][0], windows[iWin - 1][1]),
+            delta_frames,
+            this_config["Sorting"]["window_template_similarity"],
+            this_config["Sorting"]["window_spike_agreement"],
+        )
+        these_unit_ids = -np.ones(len(window_sortings[iWin]["unit_ids"]), dtype=int)
+        for i, j in matches:
+            these_unit_ids[j] = merged_unit_ids[iWin - 1][i]
+        num_new_units = np.sum(these_unit_ids < 0)
+        these_unit_ids[these_unit_ids < 0] = np.arange(
+            num_merged_units, num_merged_units + num_new_units
+        )
+        num_merged_units += num_new_units
+        merged_unit_ids.append(these_unit_ids)
+        print(
+            f"Windows {iWin - 1} and {iWin}: matched {len(matches)} units, {num_new_units} new units."
+        )
+
+    # cut each overlap in the middle so every spike is kept from exactly one window
+    cut_frames = [0]
+    for iWin in range(1, len(windows)):
+        cut_frames.append((windows[iWin][0] + windows[iWin - 1][1]) // 2)
+    cut_frames.append(num_frames)
+
+    spike_times, spike_clusters, kept_spikes = [], [], []
+    merged_templates = np.zeros(
+        (num_merged_units, *window_sortings[0]["unit_templates"].shape[1:])
+    )
+    merged_spike_counts = np.zeros(num_merged_units)
+    for iWin, window in enumerate(window_sortings):
+        is_kept = (window["spike_times"] >= cut_frames[iWin]) & (
+            window["spike_times"] < cut_frames[iWin + 1]
+        )
+        unit_lookup = dict(zip(window["unit_ids"], merged_unit_ids[iWin]))
+        these_clusters = np.array(
+            [unit_lookup[unit_id] for unit_id in window["spike_clusters"][is_kept]],
+            dtype=np.int64,
+        )
+        spike_times.append(window["spike_times"][is_kept])
+        spike_clusters.append(these_clusters)
+        kept_spikes.append(is_kept)
+        # average templates of merged units, weighted by their number of kept spikes
+        these_counts = np.bincount(these_clusters, minlength=num_merged_units)
+        for idx, merged_unit_id in enumerate(merged_unit_ids[iWin]):
+            merged_templates[merged_unit_id] += (
+                these_counts[merged_unit_id] * window["unit_templates"][idx]
+            )
+            merged_spike_counts[merged_unit_id] += these_counts[merged_unit_id]
+
+    merged_templates = (
+        merged_templates / np.maximum(merged_spike_counts, 1)[:, None, None]
+    ).astype(np.float32)
+    merged_norms = np.sum(merged_templates.astype(np.float64) ** 2, axis=(1, 2))
+
+    # project each spike, amplitude times the template it was detected with, onto the merged
+    # template of its unit, with one scale per pair of window template and merged unit
+    amplitudes = []
+    for window, is_kept, these_clusters in zip(
+        window_sortings, kept_spikes, spike_clusters
+    ):
+        these_templates = window["spike_templates"][is_kept].astype(np.int64)
+        pairs, pair_index = np.unique(
+            these_templates * num_merged_units + these_clusters, return_inverse=True
+        )
+        pair_templates = window["templates"][pairs // num_merged_units]
+        pair_units = pairs % num_merged_units
+        pair_scales = np.sum(
+            pair_templates * merged_templates[pair_units], axis=(1, 2)
+        ) / np.maximum(merged_norms[pair_units], 1e-12)
+        amplitudes.append(
+            window["amplitudes"][is_kept] * pair_scales[pair_index.ravel()]
+        )
+
+    spike_times = np.concatenate(spike_times)
+    spike_clusters = np.concatenate(spike_clusters)
+    amplitudes = np.concatenate(amplitudes).astype(np.float32)
+    order = np.argsort(spike_times, kind="stable")
+    spike_times, spike_clusters, amplitudes = (
+        spike_times[order],
+        spike_clusters[order],
+        amplitudes[order],
+    )
+    flat_templates = merged_templates.reshape(num_merged_units, -1)
+    flat_templates = flat_templates / (
+        np.linalg.norm(flat_templates, axis=1)[:, None] + 1e-12
+    )
+    num_chans = merged_templates.shape[2]
+
+    merged_output.mkdir(parents=True, exist_ok=True)
+    for aux_file in ["channel_map.npy", "channel_positions.npy", "ops.npy"]:
+        if (Path(sorter_outputs[0]) / aux_file).exists():
+            shutil.copyfile(
+                Path(sorter_outputs[0]) / aux_file, merged_output / aux_file
+            )
+    np.save(merged_output / "spike_times.npy", spike_times)
+    np.save(merged_output / "spike_clusters.npy", spike_clusters.astype(np.int32))
+    np.save(merged_output / "spike_templates.npy", spike_clusters.astype(np.int32))
+    np.save(merged_output / "amplitudes.npy", amplitudes)
+    np.save(merged_output / "templates.npy", merged_templates)
+    np.save(merged_output / "whitening_mat.npy", np.eye(num_chans, dtype=np.float32))
+    np.save(
+        merged_output / "whitening_mat_inv.npy", np.eye(num_chans, dtype=np.float32)
+    )
+    np.save(
+        merged_output / "similar_templates.npy",
+        (flat_templates @ flat_templates.T).astype(np.float32),
+    )
+    print(f"Merged {len(windows)} windows into {len(np.unique(spike_clusters))} units.")
+
+    return si.NumpySorting.from_times_labels(
+        [spike_times], [spike_clusters], sampling_frequency
+    )
+
+
+# rough resource model used to throttle concurrency, deliberately on the conservative side
+KS_JOB_BASE_BYTES = 2 * 1024**3  # python, torch and Kilosort state of each sorting job
+ASSUMED_SPIKE_RATE = 200  # detected spikes per second per threshold, for feature memory
+SWEEP_MAX_WAITING_RESULTS = 2  # sorted results waiting for extraction per parallel Kilosort job before new sorts wait
+
+
+def get_memory_budget(this_config: dict) -> int:
+    """
+    Returns the RAM budget in bytes for concurrent sorting and extraction tasks. Uses
+    ram_budget_GB from the SI section if set, otherwise 80% of the available physical memory.
+    """
+    if this_config["SI"]["ram_budget_GB"]:
+        return int(this_config["SI"]["ram_budget_GB"] * 1024**3)
+    try:
+        if platform.system() == "Linux":
+            available_pages = os.sysconf("SC_AVPHYS_PAGES")
+        else:
+            available_pages = os.sysconf("SC_PHYS_PAGES")
+        return int(0.8 * available_pages * os.sysconf("SC_PAGE_SIZE"))
+    except (AttributeError, ValueError, OSError):
+        # os.sysconf is unavailable on Windows, so do not limit by memory
+        return np.iinfo(np.int64).max
+
+
+def estimate_KS_job_resources(duration: float, num_chans: int, ks_config: dict) -> int:
+    """
+    Estimates the host memory (in bytes) needed by one Kilosort job, from the duration and
+    channel count of the recording and the detection settings.
+    """
+    Th_single_ch = ks_config["Th_single_ch"]
+    num_thresholds = len(Th_single_ch) if isinstance(Th_single_ch, list) else 1
+    expected_spikes = duration * ASSUMED_SPIKE_RATE * num_thresholds
+    # spike features are held for all detected spikes, batches are held in a few copies
+    feature_bytes = (
+        expected_spikes
+        * min(ks_config["nearest_chans"], num_chans)
+        * ks_config["n_pcs"]
+        * 4
+    )
+    batch_bytes = 8 * ks_config["batch_size"] * num_chans * 4
+    return int(KS_JOB_BASE_BYTES + feature_bytes + batch_bytes)
+
+
+def get_chunk_frames(sampling_frequency: float) -> int:
+    # number of frames in each chunk, from the chunk_duration of the SI section
+    chunk_duration = si.get_global_job_kwargs().get("chunk_duration", "1s")
+    if isinstance(chunk_duration, str):
+        if chunk_duration.endswith("ms"):
+            chunk_duration = float(chunk_duration[:-2]) / 1000
+        else:
+            chunk_duration = float(chunk_duration.rstrip("s"))
+    return int(chunk_duration * sampling_frequency)
+
+
+def estimate_extraction_resources(
+    num_chans: int, sampling_frequency: float, num_units: int, nt: int
+) -> int:
+    """
+    Estimates the memory (in bytes) needed by one extraction task, from the channel count of
+    the recording, the number of units found and the waveform width.
+    """
+    # waveforms of all units are held in a single array
+    waveform_bytes = num_units * WAVEFORM_MAX_SPIKES_PER_UNIT * nt * num_chans * 4
+    # chunks are read with filter margins and copied while writing recording.dat
+    chunk_bytes = 4 * get_chunk_frames(sampling_frequency) * num_chans * 4
+    return int(waveform_bytes + chunk_bytes)
+
+
+def get_safe_concurrency(
+    requested: int,
+    task_bytes: int,
+    memory_budget: int,
+    task_name: str = "tasks",
+) -> int:
+    """
+    Returns the largest number of concurrent tasks, up to the requested number, which fits
+    the memory budget and the number of CPUs (at least 1).
+    """
+    fits_memory = memory_budget // max(task_bytes, 1)
+    num_cpus = os.cpu_count() or 1
+    safe_concurrency = int(max(1, min(requested, fits_memory, num_cpus)))
+    if safe_concurrency < requested:
+        print(
+            f"Running {safe_concurrency} instead of {requested} concurrent {task_name} to stay within "
+            f"{memory_budget / 1024**3:.1f} GB of RAM and {num_cpus} CPUs "
+            f"(estimated {task_bytes / 1024**3:.2f} GB each)."
+        )
+    return safe_concurrency
+
+
+# messages of resource errors which were re-raised as another exception type, e.g., the
+# SpikeSortingError of run_sorter, which only keeps the trace of the original error as text
+RESOURCE_ERROR_MESSAGES = [
+    "MemoryError",
+    "out of memory",  # e.g., torch.cuda.OutOfMemoryError
+    "Cannot allocate memory",
+    "Too many open files",
+]
+
+
+def is_resource_error(e: BaseException) -> bool:
+    """
+    Checks whether an exception, or any exception it was raised from, was caused by running
+    out of memory or open files, or by a worker process being killed (usually by the
+    out-of-memory killer).
+    """
+    import errno
+    from concurrent.futures.process import BrokenProcessPool
+
+    while e is not None:
+        if isinstance(e, (MemoryError, BrokenProcessPool)):
+            return True
+        if isinstance(e, OSError) and e.errno in (
+            errno.EMFILE,
+            errno.ENFILE,
+            errno.ENOMEM,
+        ):
+            return True
+        if any(message in str(e) for message in RESOURCE_ERROR_MESSAGES):
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+
+async def extract_concurrently(
+    sortings, jobs, these_configs, max_concurrent_tasks=5, progress=None
+):
+    """
+    Extracts the sorting results concurrently, admitting new tasks only while their estimated
+    memory fits the budget. Tasks which run out of memory are retried with lower concurrency
+    instead of failing the whole sweep.
+
+    The sortings, jobs and configurations are dictionaries keyed by worker id, and the entries of
+    each worker are removed as soon as its result is written, so they can be garbage collected.
+    Returns the messages of each worker in order.
+    """
+    print("Extracting sorting results asynchronously...")
+    wids = list(sortings)
+    memory_budget = get_memory_budget(these_configs[wids[0]])
+    task_bytes = {
+        wid: estimate_extraction_resources(
+            jobs[wid]["recording"].get_num_channels(),
+            jobs[wid]["recording"].get_sampling_frequency(),
+            sortings[wid].get_num_units(),
+            these_configs[wid]["KS"]["nt"],
+        )
+        for wid in wids
+    }
+    concurrency_limit = get_safe_concurrency(
+        max_concurrent_tasks,
+        max(task_bytes.values()),
+        memory_budget,
+        task_name="extraction tasks",
+    )
+
+    msgs = {}
+    num_attempts = dict.fromkeys(wids, 0)
+    pending = list(wids)
+    running = {}
+    while pending or running:
+        # admit tasks in order while they fit, always allowing at least one to run
+        while pending and len(running) < concurrency_limit:
+            wid = pending[0]
+            used_bytes = sum(task_bytes[i] for i in running.values())
+            if running and used_bytes + task_bytes[wid] > memory_budget:
+                break
+            pending.pop(0)
+            num_attempts[wid] += 1
+            task = asyncio.create_task(
+                extract_sorting_result(
+                    sortings[wid],
+                    these_configs[wid],
+                    jobs[wid],
+                    wid,
+                    progress=progress,
+                )
+            )
+            running[task] = wid
+
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            wid = running.pop(task)
+            try:
+                msgs[wid] = task.result()
+            except Exception as e:
+                if is_resource_error(e) and num_attempts[wid] < 3:
+                    # back off: lower the concurrency and retry this task later
+                    concurrency_limit = max(
+                        1, min(concurrency_limit, len(running) + 1) // 2
+                    )
+                    pending.insert(0, wid)
+                    print(
+                        f"Worker {wid} ran out of resources during extraction ({e}), "
+                        f"retrying with at most {concurrency_limit} concurrent tasks..."
+                    )
+                    continue
+                for other_task in running:
+                    other_task.cancel()
+                if progress is not None:
+                    progress.set_state(wid, "failed")
+                raise Exception(
+                    f"Error in parallel extraction of Worker {wid}, try reducing ram_budget_GB or max_concurrent_tasks in 'SI' section of emu_config.yaml next time. ..."
+                ) from e
+            # release the sorting and recording of this worker
+            del sortings[wid], jobs[wid], these_configs[wid]
+            print(
+                "------------------------------------------------------------\n"
+                f"Extraction done for Worker {wid} ({len(msgs)}/{len(wids)}). Yay!\n"
+                "------------------------------------------------------------\n"
+            )
+    return [msgs[wid] for wid in wids]
+
+
+class SweepProgress:
+    """
+    Tracks the state of each job of a sorting sweep (queued, sorting, sorted, extracting,
+    scoring, exporting, done or failed) and how long each state took.
+
+    Kilosort jobs run in separate processes, so they report their state by writing small state
+    files, which are polled by a background thread. The thread also writes a continuously updated
+    status file "emusort_status.json" to the output folder and prints a compact summary with the
+    measured throughput and the ETA of the sweep. When the sweep stops, the sorting time of each
+    job is appended to the runtime history of the output folder.
+
+    Jobs are registered with add_job when they are scheduled, so the tracker does not hold the
+    recordings or configurations of jobs which have not started yet.
+
+    Parameters:
+    - output_folder: Union[Path, str] - The folder to write the status file to.
+    - name: str - The name of the sweep shown in the summary.
+    - num_jobs: int - The total number of sorting jobs.
+    - n_jobs: int - The number of Kilosort jobs running in parallel.
+    - this_config: dict - The configuration dictionary, for the SI section settings.
+    """
+
+    ACTIVE_STATES = ["sorting", "extracting", "scoring", "exporting"]
+
+    def __init__(self, output_folder, name, num_jobs, n_jobs, this_config):
+        self.status_path = Path(output_folder) / "emusort_status.json"
+        self.state_folder = Path(output_folder) / ".emusort_progress"
+        self.name = name
+        self.n_jobs = n_jobs
+        self.max_concurrent_tasks = this_config["SI"]["max_concurrent_tasks"]
+        self.interval = this_config["SI"]["progress_interval"]
+        self.start_time = time.time()
+        self.jobs = [
+            {
+                "wid": wid,
+                "state": "queued",
+                "state_since": self.start_time,
+                "durations": {},
+            }
+            for wid in range(num_jobs)
+        ]
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def get_state_path(self, wid: int) -> Path:
+        # state file which the Kilosort process of this job writes to
+        return self.state_folder / f"wkr{wid}.json"
+
+    def set_state(self, wid: int, state: str, timestamp: float = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            job = self.jobs[wid]
+            if job["state"] == state:
+                return
+            if job["state"] in self.ACTIVE_STATES:
+                job["durations"][job["state"]] = (
+                    job["durations"].get(job["state"], 0)
+                    + timestamp
+                    - job["state_since"]
+                )
+            job["state"] = state
+            job["state_since"] = timestamp
+
+    def add_job(self, wid: int, recording: si.BaseRecording, ks_config: dict):
+        # record the data and parameters of a job once it is scheduled
+        self.set_info(
+            wid,
+            num_samples=recording.get_num_frames(),
+            num_chans=recording.get_num_channels(),
+            sampling_frequency=recording.get_sampling_frequency(),
+            KS=path_to_str_recursive(dict(ks_config)),
+        )
+
+    def set_info(self, wid: int, **info):
+        # additional information about a job, e.g., the number of units it found
+        with self._lock:
+            self.jobs[wid].update(info)
+
+    def poll_sorting_states(self):
+        # pick up state changes reported by the Kilosort processes
+        for job in self.jobs:
+            if job["state"] not in ("queued", "sorting"):
+                continue
+            try:
+                worker_state = json.loads(self.get_state_path(job["wid"]).read_text())
+            except (OSError, ValueError):
+                continue
+            self.set_state(job["wid"], worker_state["state"], worker_state["time"])
+
+    def get_summary(self) -> dict:
+        with self._lock:
+            now = time.time()
+            counts = {}
+            for job in self.jobs:
+                counts[job["state"]] = counts.get(job["state"], 0) + 1
+            sorted_jobs = [job for job in self.jobs if "sorting" in job["durations"]]
+            extracted_jobs = [job for job in self.jobs if job["state"] == "done"]
+            mean_sort_time = (
+                np.mean([job["durations"]["sorting"] for job in sorted_jobs])
+                if sorted_jobs
+                else None
+            )
+            mean_extract_time = (
+                np.mean(
+                    [
+                        sum(
+                            job["durations"].get(state, 0)
+                            for state in self.ACTIVE_STATES[1:]
+                        )
+                        for job in extracted_jobs
+                    ]
+                )
+                if extracted_jobs
+                else None
+            )
+            samples_per_s = (
+                sum(job["num_samples"] for job in sorted_jobs)
+                / sum(job["durations"]["sorting"] for job in sorted_jobs)
+                if sorted_jobs
+                else None
+            )
+            # the remaining work of each job, divided by the number of parallel workers
+            eta = None
+            if mean_sort_time is not None:
+                remaining_sort_time = sum(
+                    (
+                        mean_sort_time
+                        if job["state"] == "queued"
+                        else max(mean_sort_time - (now - job["state_since"]), 0)
+                    )
+                    for job in self.jobs
+                    if job["state"] in ("queued", "sorting")
+                )
+                num_not_extracted = (
+                    len(self.jobs) - len(extracted_jobs) - counts.get("failed", 0)
+                )
+                remaining_extract_time = num_not_extracted * (
+                    mean_extract_time if mean_extract_time is not None else 0
+                )
+                eta = remaining_sort_time / self.n_jobs + remaining_extract_time / max(
+                    1, min(self.max_concurrent_tasks, num_not_extracted)
+                )
+            return {
+                "name": self.name,
+                "updated": datetime.now().isoformat(timespec="seconds"),
+                "elapsed_s": now - self.start_time,
+                "eta_s": eta,
+                "num_jobs": len(self.jobs),
+                "num_parallel_jobs": self.n_jobs,
+                "counts": counts,
+                "samples_per_s_per_job": samples_per_s,
+                "mean_sort_time_s": mean_sort_time,
+                "mean_extract_time_s": mean_extract_time,
+                "jobs": deepcopy(self.jobs),
+            }
+
+    def write_status(self) -> dict:
+        summary = self.get_summary()
+        # write to a temporary file first, so readers never see a partial file
+        tmp_path = self.status_path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(summary, indent=2, default=float))
+        os.replace(tmp_path, self.status_path)
+        return summary
+
+    def print_summary(self, summary: dict):
+        def fmt_seconds(seconds):
+            if seconds is None:
+                return "unknown"
+            return strfdelta(
+                timedelta(seconds=int(seconds)),
+                "{days}d {hours}h {minutes:02d}m {seconds:02d}s",
+            )
+
+        counts = summary["counts"]
+        num_extracting = sum(counts.get(state, 0) for state in self.ACTIVE_STATES[1:])
+        rate = summary["samples_per_s_per_job"]
+        print(
+            f"[{summary['updated']}] {summary['name']}: "
+            f"{counts.get('done', 0)}/{summary['num_jobs']} done, "
+            f"{counts.get('sorting', 0)} sorting, {num_extracting} extracting, "
+            f"{counts.get('failed', 0)} failed | "
+            f"{'unknown' if rate is None else f'{rate / 1e3:.1f}k'} samples/s per job | "
+            f"elapsed {fmt_seconds(summary['elapsed_s'])} | ETA {fmt_seconds(summary['eta_s'])}"
+        )
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.poll_sorting_states()
+            self.print_summary(self.write_status())
+
+    def start(self):
+        self.state_folder.mkdir(parents=True, exist_ok=True)
+        self.write_status()
+        if self.interval and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.poll_sorting_states()
+        self.print_summary(self.write_status())
+        shutil.rmtree(self.state_folder, ignore_errors=True)
+        # sorting times of this run improve the runtime predictions of later runs
+        append_runtime_history(self.status_path.parent, self.jobs)
+
+
+KS_STAGE_FOLDER = (
+    ".emusort_KS_stages"  # Kilosort stages shared by the jobs of a running sweep
+)
+# Kilosort settings which feed the high-pass filter, whitening matrix and channel delays
+KS_PREPROCESSING_PARAMS = [
+    "n_chan_bin",
+    "fs",
+    "batch_size",
+    "nt",
+    "nt0min",
+    "do_CAR",
+    "invert_sign",
+    "tmin",
+    "tmax",
+    "artifact_threshold",
+    "shift",
+    "scale",
+    "nskip",
+    "whitening_range",
+    "remove_chan_delays",
+]
+# Kilosort settings which feed the universal templates learned from the data
+KS_TEMPLATE_PARAMS = KS_PREPROCESSING_PARAMS + [
+    "Th_single_ch",
+    "n_pcs",
+    "n_templates",
+    "remove_spike_outliers",
+    "hdbscan_min_cluster_size",
+]
+KS_STAGE_LOCK_TIMEOUT = (
+    60  # seconds without a heartbeat before a stage lock is presumed dead
+)
+KS_STAGE_VERSIONS = ("4.0.",)  # Kilosort versions whose stage functions are cached
+# parameters of the wrapped Kilosort stage functions, checked before they are wrapped
+KS_STAGE_SIGNATURES = {
+    "compute_preprocessing": ["ops", "device", "tic0", "file_object"],
+    "extract_wPCA_wTEMP": [
+        "ops",
+        "bfile",
+        "nt",
+        "twav_min",
+        "Th_single_ch",
+        "nskip",
+        "device",
+    ],
+}
+
+
+class KilosortStageCache:
+    """
+    Shares the Kilosort stages which do not depend on the swept detection and clustering
+    parameters across the jobs of a sweep: the preprocessing stage (high-pass filter, whitening
+    matrix and channel delays) and the universal templates learned from the spikes crossing
+    Th_single_ch. Each stage result is saved to the cache folder under a hash of the Kilosort
+    settings which feed it, so jobs which agree up to a stage compute it once and branch after
+    it. Spike detection with Th_universal and Th_learned, clustering, and the acg_threshold and
+    ccg_threshold checks still run in every job.
+
+    While used as a context manager, the stage functions of Kilosort are wrapped, so run_sorter
+    writes the same sorter output folder as without the cache. The first job to reach a stage
+    computes it while holding a lock file, and jobs which need the same stage wait for its result,
+    or take over if the lock is not renewed for KS_STAGE_LOCK_TIMEOUT seconds. The random state is
+    restored after the universal templates are learned, so the later stages of a job do not depend
+    on whether it computed the templates or loaded them.
+
+    The wrapped functions are internal to Kilosort, so the cache is only used if the installed
+    Kilosort version is in KS_STAGE_VERSIONS and the functions take the parameters listed in
+    KS_STAGE_SIGNATURES. Otherwise, a warning is printed and the stages run in every job. The
+    stage results hold only tensors and numbers, so they are loaded with weights_only=True.
+
+    Parameters:
+    - cache_folder: Union[Path, str] - The folder of the stage results, shared by the jobs.
+    """
+
+    def __init__(self, cache_folder):
+        self.cache_folder = Path(cache_folder)
+        self._originals = None
+
+    def get_stage_path(self, stage: str, settings: dict, params: list) -> Path:
+        key = json.dumps(
+            {param: settings.get(param) for param in params},
+            sort_keys=True,
+            default=str,
+        )
+        return (
+            self.cache_folder
+            / f"{stage}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.pt"
+        )
+
+    def get_or_compute(self, stage_path: Path, compute, device):
+        import torch
+
+        lock_path = stage_path.with_suffix(".lock")
+        while not stage_path.exists():
+            try:
+                # creating the lock file is atomic, so only one job computes each stage
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                try:
+                    if time.time() - lock_path.stat().st_mtime > KS_STAGE_LOCK_TIMEOUT:
+                        lock_path.unlink()  # the job computing this stage died
+                except FileNotFoundError:
+                    pass
+                time.sleep(1)
+                continue
+
+            stop_event = threading.Event()
+
+            def renew_lock():
+                while not stop_event.wait(KS_STAGE_LOCK_TIMEOUT / 4):
+                    try:
+                        os.utime(lock_path)
+                    except FileNotFoundError:
+                        return
+
+            thread = threading.Thread(target=renew_lock, daemon=True)
+            thread.start()
+            try:
+                result = compute()
+                # write to a temporary file first, so other jobs never load a partial file
+                tmp_path = stage_path.with_suffix(".pt.tmp")
+                torch.save(result, tmp_path)
+                os.replace(tmp_path, stage_path)
+                return result
+            finally:
+                stop_event.set()
+                thread.join()
+                lock_path.unlink(missing_ok=True)
+        return torch.load(stage_path, map_location=device, weights_only=True)
+
+    @staticmethod
+    def get_unsupported_reason(functions: dict) -> Union[str, None]:
+        """
+        Checks whether the installed Kilosort matches the stage functions the cache wraps.
+
+        Parameters:
+        - functions: dict - The Kilosort stage functions, keyed by their name.
+
+        Returns:
+        - str or None - Why the cache cannot be used, or None if it can.
+        """
+        from importlib.metadata import PackageNotFoundError, version
+
+        try:
+            kilosort_version = version("kilosort")
+        except PackageNotFoundError:
+            kilosort_version = "unknown"
+        if not kilosort_version.startswith(KS_STAGE_VERSIONS):
+            return (
+                f"Kilosort version {kilosort_version} is not one of {KS_STAGE_VERSIONS}"
+            )
+        for name, params in KS_STAGE_SIGNATURES.items():
+            found = list(inspect.signature(functions[name]).parameters)
+            if found != params:
+                return f"Kilosort {name} takes {found} instead of {params}"
+        return None
+
+    def __enter__(self):
+        import kilosort.run_kilosort as run_kilosort
+        import kilosort.spikedetect as spikedetect
+
+        reason = self.get_unsupported_reason(
+            {
+                "compute_preprocessing": run_kilosort.compute_preprocessing,
+                "extract_wPCA_wTEMP": spikedetect.extract_wPCA_wTEMP,
+            }
+        )
+        if reason is not None:
+            print(f"WARNING: Not sharing Kilosort stages across jobs: {reason}")
+            return self
+
+        compute_preprocessing = run_kilosort.compute_preprocessing
+        extract_wPCA_wTEMP = spikedetect.extract_wPCA_wTEMP
+
+        def cached_compute_preprocessing(ops, device, *args, **kwargs):
+            def compute():
+                ops_before = dict(ops)
+                new_ops = compute_preprocessing(ops, device, *args, **kwargs)
+                # only the entries added or replaced by the stage are shared
+                return {
+                    key: value
+                    for key, value in new_ops.items()
+                    if key not in ops_before or ops_before[key] is not value
+                }
+
+            stage_path = self.get_stage_path(
+                "preprocessing", ops["settings"], KS_PREPROCESSING_PARAMS
+            )
+            ops.update(self.get_or_compute(stage_path, compute, device))
+            return ops
+
+        def cached_extract_wPCA_wTEMP(ops, *args, **kwargs):
+            def compute():
+                random_state = np.random.get_state()
+                try:
+                    return extract_wPCA_wTEMP(ops, *args, **kwargs)
+                finally:
+                    np.random.set_state(random_state)
+
+            stage_path = self.get_stage_path(
+                "templates", ops["settings"], KS_TEMPLATE_PARAMS
+            )
+            return self.get_or_compute(stage_path, compute, ops["torch_device"])
+
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self._originals = (compute_preprocessing, extract_wPCA_wTEMP)
+        # run_sorter imports compute_preprocessing when it runs, and spike detection looks up
+        # extract_wPCA_wTEMP in its module, so both pick up the wrapped stages
+        run_kilosort.compute_preprocessing = cached_compute_preprocessing
+        spikedetect.extract_wPCA_wTEMP = cached_extract_wPCA_wTEMP
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._originals is None:
+            return
+        import kilosort.run_kilosort as run_kilosort
+        import kilosort.spikedetect as spikedetect
+
+        run_kilosort.compute_preprocessing, spikedetect.extract_wPCA_wTEMP = (
+            self._originals
+        )
+        self._originals = None
+
+
+def run_sorter_job(job: dict, state_path: Union[Path, None] = None):
+    """
+    Runs a single sorting job, reporting when it starts and finishes sorting to state_path so
+    the progress of jobs running in other processes can be tracked. If the job has a
+    KS_stage_folder, the Kilosort stages it shares with other jobs are taken from there (see
+    KilosortStageCache).
+    """
+
+    def write_state(state):
+        if state_path is not None:
+            Path(state_path).write_text(
+                json.dumps({"state": state, "time": time.time()})
+            )
+
+    job = dict(job)
+    stage_folder = job.pop("KS_stage_folder", None)
+    write_state("sorting")
+    if stage_folder is not None:
+        with KilosortStageCache(stage_folder):
+            ss.run_sorter(**job, with_output=False)
+    else:
+        ss.run_sorter(**job, with_output=False)
+    write_state("sorted")
+
+
+def run_sorter_jobs_with_backoff(jobs: dict, n_jobs: int, progress=None):
+    """
+    Runs the sorting jobs in parallel with joblib. If a job fails because the machine ran out
+    of memory or open files, the unfinished jobs are rerun with half as many parallel jobs,
+    until a failure with a single job is raised. Any other error is raised immediately, since
+    rerunning the jobs would only fail again.
+
+    Parameters:
+    - jobs: dict - The job parameters of each sorting job, keyed by worker id.
+    - n_jobs: int - The number of jobs to run in parallel.
+    - progress: SweepProgress - The progress tracker of the jobs, if any.
+    """
+    from joblib import Parallel, delayed
+
+    remaining_wids = list(jobs)
+    while remaining_wids:
+        try:
+            Parallel(n_jobs=n_jobs)(
+                delayed(run_sorter_job)(
+                    jobs[wid],
+                    progress.get_state_path(wid) if progress is not None else None,
+                )
+                for wid in remaining_wids
+            )
+            remaining_wids = []
+        except Exception as e:
+            remaining_wids = [
+                wid
+                for wid in remaining_wids
+                if not (
+                    Path(jobs[wid]["output_folder"])
+                    / "sorter_output"
+                    / "spike_times.npy"
+                ).exists()
+            ]
+            if not is_resource_error(e) or n_jobs == 1 or not remaining_wids:
+                if progress is not None:
+                    for wid in remaining_wids:
+                        progress.set_state(wid, "failed")
+                raise
+            n_jobs = max(1, n_jobs // 2)
+            print(
+                f"Sorting failed ({e}), rerunning {len(remaining_wids)} unfinished jobs with {n_jobs} parallel jobs..."
+            )
+            for wid in remaining_wids:
+                shutil.rmtree(jobs[wid]["output_folder"], ignore_errors=True)
+                if progress is not None:
+                    progress.get_state_path(wid).unlink(missing_ok=True)
+                    progress.set_state(wid, "queued")
+
+
+async def sort_and_extract_streaming(
+    scheduled_jobs,
+    num_jobs: int,
+    job_bytes: int,
+    n_jobs: int,
+    max_concurrent_tasks: int,
+    memory_budget: int,
+    progress=None,
+) -> tuple:
+    """
+    Sorts the scheduled jobs in one pool of n_jobs Kilosort processes, and extracts each result
+    as soon as its sort finishes, so sorting and extraction overlap.
+
+    Jobs are only pulled from scheduled_jobs when a Kilosort process is free, and new sorts are
+    held back while SWEEP_MAX_WAITING_RESULTS results per Kilosort process wait to be extracted,
+    so the number of jobs, sortings and recordings alive at once stays bounded. Sorts and
+    extraction tasks are admitted while their estimated memory fits the budget together, always
+    allowing at least one to run. Sorts or extraction tasks which run out of resources are
+    retried up to 3 times with lower concurrency, and any other error stops the sweep.
+
+    Parameters:
+    - scheduled_jobs: iterator - Yields the (wid, job, this_config) of each job, in the order to
+      start them.
+    - num_jobs: int - The number of jobs scheduled_jobs yields.
+    - job_bytes: int - The estimated memory of each Kilosort job.
+    - n_jobs: int - The number of Kilosort jobs to run in parallel.
+    - max_concurrent_tasks: int - The maximum number of extraction tasks running at once.
+    - memory_budget: int - The RAM budget in bytes of all running sorts and extraction tasks.
+    - progress: SweepProgress - The progress tracker of the jobs, if any.
+
+    Returns:
+    - tuple: The result of each job as returned by extract_sorting_result, keyed by worker id,
+      and the seconds until the last sort finished.
+    """
+    from joblib.externals.loky import get_reusable_executor
+
+    start_time = time.time()
+    sort_seconds = 0
+    sort_limit = n_jobs
+    extract_limit = max(1, min(max_concurrent_tasks, os.cpu_count() or 1))
+    jobs, these_configs, sortings, task_bytes = {}, {}, {}, {}
+    sort_attempts, extract_attempts = {}, {}
+    sorts_to_retry, waiting = [], []
+    sorting_tasks, extraction_tasks = {}, {}
+    msgs = {}
+    executor = None
+
+    def get_used_bytes():
+        return job_bytes * len(sorting_tasks) + sum(
+            task_bytes[wid] for wid in extraction_tasks.values()
+        )
+
+    try:
+        while True:
+            # start sorts while a Kilosort process is free and few results wait for extraction
+            while (
+                len(sorting_tasks) < sort_limit
+                and len(waiting) < SWEEP_MAX_WAITING_RESULTS * n_jobs
+                and (
+                    not (sorting_tasks or extraction_tasks)
+                    or get_used_bytes() + job_bytes <= memory_budget
+                )
+            ):
+                if sorts_to_retry:
+                    wid = sorts_to_retry.pop(0)
+                else:
+                    scheduled = next(scheduled_jobs, None)
+                    if scheduled is None:
+                        break
+                    wid, job, this_config = scheduled
+                    jobs[wid], these_configs[wid] = job, this_config
+                    sort_attempts[wid] = extract_attempts[wid] = 0
+                    if progress is not None:
+                        progress.add_job(wid, job["recording"], this_config["KS"])
+                sort_attempts[wid] += 1
+                # a new pool is started if a Kilosort process was killed
+                executor = get_reusable_executor(max_workers=n_jobs)
+                future = executor.submit(
+                    run_sorter_job,
+                    jobs[wid],
+                    progress.get_state_path(wid) if progress is not None else None,
+                )
+                sorting_tasks[asyncio.wrap_future(future)] = wid
+
+            # extract sorted results in the order they finished
+            while waiting and len(extraction_tasks) < extract_limit:
+                wid = waiting[0]
+                if (
+                    extraction_tasks
+                    and get_used_bytes() + task_bytes[wid] > memory_budget
+                ):
+                    break
+                waiting.pop(0)
+                extract_attempts[wid] += 1
+                task = asyncio.create_task(
+                    extract_sorting_result(
+                        sortings[wid],
+                        these_configs[wid],
+                        jobs[wid],
+                        wid,
+                        progress=progress,
+                    )
+                )
+                extraction_tasks[task] = wid
+
+            if not (sorting_tasks or extraction_tasks):
+                break
+            done, _ = await asyncio.wait(
+                [*sorting_tasks, *extraction_tasks],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task in sorting_tasks:
+                    wid = sorting_tasks.pop(task)
+                    try:
+                        task.result()
+                    except Exception as e:
+                        if is_resource_error(e) and sort_attempts[wid] < 3:
+                            # back off: lower the concurrency and sort this job again next
+                            sort_limit = max(
+                                1, min(sort_limit, len(sorting_tasks) + 1) // 2
+                            )
+                            sorts_to_retry.insert(0, wid)
+                            shutil.rmtree(
+                                jobs[wid]["output_folder"], ignore_errors=True
+                            )
+                            if progress is not None:
+                                progress.get_state_path(wid).unlink(missing_ok=True)
+                                progress.set_state(wid, "queued")
+                            print(
+                                f"Worker {wid} ran out of resources during sorting ({e}), "
+                                f"retrying with at most {sort_limit} parallel jobs..."
+                            )
+                            continue
+                        if progress is not None:
+                            progress.set_state(wid, "failed")
+                        raise
+                    sort_seconds = time.time() - start_time
+                    if progress is not None:
+                        progress.poll_sorting_states()
+                    sortings[wid] = ss.read_sorter_folder(jobs[wid]["output_folder"])
+                    task_bytes[wid] = estimate_extraction_resources(
+                        jobs[wid]["recording"].get_num_channels(),
+                        jobs[wid]["recording"].get_sampling_frequency(),
+                        sortings[wid].get_num_units(),
+                        these_configs[wid]["KS"]["nt"],
+                    )
+                    waiting.append(wid)
+                    continue
+
+                wid = extraction_tasks.pop(task)
+                try:
+                    msgs[wid] = task.result()
+                except Exception as e:
+                    if is_resource_error(e) and extract_attempts[wid] < 3:
+                        # back off: lower the concurrency and retry this task next
+                        extract_limit = max(
+                            1, min(extract_limit, len(extraction_tasks) + 1) // 2
+                        )
+                        waiting.insert(0, wid)
+                        print(
+                            f"Worker {wid} ran out of resources during extraction ({e}), "
+                            f"retrying with at most {extract_limit} concurrent tasks..."
+                        )
+                        continue
+                    if progress is not None:
+                        progress.set_state(wid, "failed")
+                    raise Exception(
+                        f"Error in parallel extraction of Worker {wid}, try reducing ram_budget_GB or max_concurrent_tasks in 'SI' section of emu_config.yaml next time. ..."
+                    ) from e
+                # release the sorting and recording of this worker
+                del sortings[wid], jobs[wid], these_configs[wid], task_bytes[wid]
+                print(
+                    "------------------------------------------------------------\n"
+                    f"Extraction done for Worker {wid} ({len(msgs)}/{num_jobs}). Yay!\n"
+                    "------------------------------------------------------------\n"
+                )
+    except BaseException:
+        for task in [*sorting_tasks, *extraction_tasks]:
+            task.cancel()
+        # stop the Kilosort processes which are still sorting
+        if executor is not None and sorting_tasks:
+            executor.shutdown(wait=False, kill_workers=True)
+        raise
+    return msgs, sort_seconds
+
+
+def run_KS_sorting(
+    num_jobs: int, make_job, base_config: dict, job_params: Union[list, None] = None
+):
+    """
+    Run Kilosort4 spike sorting jobs and save the results.
+
+    Jobs are materialized by make_job only when a Kilosort process is free to sort them, each
+    result is extracted as soon as its sort finishes while the next jobs are sorted, and each
+    sorting is released once its result is written, so memory use and setup time do not grow
+    with the size of a parameter sweep (see sort_and_extract_streaming).
+
+    The runtime of each job is predicted from its parameters, the recording size and the runtime
+    history of the output folder, and jobs are started longest first, so expensive parameter
+    combinations do not leave a long tail of a single job at the end of the sweep.
+
+    The number of parallel Kilosort jobs is limited by the estimated memory of each job. If a job
+    fails by running out of memory or open files, it is rerun with half as many parallel jobs.
+
+    If cache_KS_stages is set in the SI section, the Kilosort stages which do not depend on the
+    swept parameters are computed once and shared by the jobs (see KilosortStageCache).
+
+    Parameters:
+    - num_jobs: int - The number of sorting jobs.
+    - make_job: callable - Function which returns the (job, this_config) of a worker id.
+    - base_config: dict - The configuration dictionary shared by all jobs.
+    - job_params: Union[list, None] - The swept Kilosort parameters of each job, used to predict
+      their runtimes (default: the KS section settings for all jobs).
+
+    Returns:
+    - list: The result of each sorting job, as returned by extract_sorting_result.
+    """
+
+    ## make_job returns jobs of below structure:
+    # job = {
+    #     "sorter_name": "kilosort4",
+    #     "recording": preproc_recording,
+    #     "output_folder": this_config["Sorting"]["sorted_folder"],
+    #     **this_config["KS"],
+    # }
+
+    first_job, first_config = make_job(0)
+    job_bytes = estimate_KS_job_resources(
+        first_job["recording"].get_total_duration(),
+        first_job["recording"].get_num_channels(),
+        first_config["KS"],
+    )
+    n_jobs = get_safe_concurrency(
+        base_config["Sorting"]["num_KS_jobs"],
+        job_bytes,
+        get_memory_budget(base_config),
+        task_name="Kilosort jobs",
+    )
+
+    sorted_folder = Path(first_config["Sorting"]["sorted_folder"])
+    progress = SweepProgress(
+        sorted_folder.parent,
+        sorted_folder.name.split("_wkr", 1)[0],
+        num_jobs,
+        n_jobs,
+        base_config,
+    )
+
+    # predict the runtime of each job, and start the longest jobs first
+    predicted_sort_s, num_past_jobs = predict_job_sort_seconds(
+        sorted_folder.parent,
+        first_job["recording"],
+        base_config["KS"],
+        job_params if job_params is not None else [{}] * num_jobs,
+    )
+    job_order = get_job_order(predicted_sort_s)
+    for wid in range(num_jobs):
+        progress.set_info(wid, predicted_sort_s=predicted_sort_s[wid])
+    if num_jobs > 1:
+        predicted_makespan = get_makespan(
+            [predicted_sort_s[wid] for wid in job_order], n_jobs
+        )
+        print(
+            f"Starting jobs in order of predicted runtime, longest first (from {num_past_jobs} past jobs): "
+            f"{sum(predicted_sort_s) / 60:.1f} min of sorting in total, predicted to take "
+            f"{predicted_makespan / 60:.1f} min with {n_jobs} parallel jobs."
+        )
+
+    # Kilosort stages which jobs agree on are computed once, see KilosortStageCache
+    stage_folder = None
+    if num_jobs > 1 and base_config["SI"]["cache_KS_stages"]:
+        stage_folder = sorted_folder.parent / KS_STAGE_FOLDER / progress.name
+
+    def scheduled_jobs():
+        # jobs are only made when a Kilosort process is free to sort them
+        nonlocal first_job, first_config
+        for wid in job_order:
+            if wid == 0:
+                job, this_config = first_job, first_config
+                first_job = first_config = None
+            else:
+                job, this_config = make_job(wid)
+            if stage_folder is not None:
+                job["KS_stage_folder"] = stage_folder
+            yield wid, job, this_config
+
+    progress.start()
+    try:
+        msgs, sort_seconds = asyncio.run(
+            sort_and_extract_streaming(
+                scheduled_jobs(),
+                num_jobs,
+                job_bytes,
+                n_jobs,
+                base_config["SI"]["max_concurrent_tasks"],
+                get_memory_budget(base_config),
+                progress=progress,
+            )
+        )
+    finally:
+        progress.stop()
+        if stage_folder is not None:
+            shutil.rmtree(stage_folder, ignore_errors=True)
+    report_runtime_predictions(progress.jobs, sort_seconds, n_jobs)
+    return [msgs[wid] for wid in range(num_jobs)]
+
+
+def run_windowed_KS_sorting(this_job, this_config, windows):
+    """
+    Run Kilosort4 spike sorting on overlapping time windows of a recording in parallel, then
+    merge the units across windows and save the result like a single sorting job.
+
+    Parameters:
+    - this_job: dict - The job parameters for sorting the full recording.
+    - this_config: dict - The configuration parameters for sorting the full recording.
+    - windows: list - The (start_frame, end_frame) tuples of each window.
+
+    Returns:
+    - list: The result of the merged sorting, as returned by extract_sorting_result.
+    """
+    recording = this_job["recording"]
+    zfill_amount = len(str(len(windows)))
+    window_job_list = []
+    for iWin, (start_frame, end_frame) in enumerate(windows):
+        window_folder = (
+            this_config["Sorting"]["sorted_folder"]
+            + "_win"
+            + str(iWin).zfill(zfill_amount)
+        )
+        if Path(window_folder).exists():
+            shutil.rmtree(window_folder, ignore_errors=True)
+        window_job = {
+            **this_job,
+            "recording": recording.frame_slice(
+                start_frame=start_frame, end_frame=end_frame
+            ),
+            "output_folder": window_folder,
+        }
+        # distribute the windows across all chosen GPUs
+        if str(this_job["torch_device"]).startswith("cuda"):
+            window_job["torch_device"] = "cuda:" + str(
+                this_config["Sorting"]["GPU_to_use"][
+                    iWin % len(this_config["Sorting"]["GPU_to_use"])
+                ]
+            )
+        window_job_list.append(window_job)
+
+    print(f"Sorting {len(windows)} time windows in parallel...")
+    job_bytes = estimate_KS_job_resources(
+        window_job_list[0]["recording"].get_total_duration(),
+        window_job_list[0]["recording"].get_num_channels(),
+        this_config["KS"],
+    )
+    n_jobs = get_safe_concurrency(
+        this_config["Sorting"]["num_KS_jobs"],
+        job_bytes,
+        get_memory_budget(this_config),
+        task_name="Kilosort jobs",
+    )
+    progress = SweepProgress(
+        Path(this_config["Sorting"]["sorted_folder"]).parent,
+        Path(this_config["Sorting"]["sorted_folder"]).name.split("_wkr", 1)[0],
+        len(window_job_list),
+        n_jobs,
+        this_config,
+    )
+    for iWin, window_job in enumerate(window_job_list):
+        progress.add_job(iWin, window_job["recording"], this_config["KS"])
+    progress.start()
+    try:
+        run_sorter_jobs_with_backoff(
+            dict(enumerate(window_job_list)), n_jobs, progress=progress
+        )
+        progress.poll_sorting_states()
+        # the windows are extracted together after merging
+        for iWin in range(len(window_job_list)):
+            progress.set_state(iWin, "done")
+    finally:
+        progress.stop()
+
+    merged_sorting = merge_window_sortings(
+        [Path(job["output_folder"]) / "sorter_output" for job in window_job_list],
+        windows,
+        Path(this_config["Sorting"]["sorted_folder"]) / "sorter_output",
+        this_config,
+        recording.get_num_frames(),
+        recording.get_sampling_frequency(),
+    )
+    for job in window_job_list:
+        shutil.rmtree(job["output_folder"], ignore_errors=True)
+
+    msgs = asyncio.run(
+        extract_concurrently(
+            {0: merged_sorting}, {0: this_job}, {0: this_config}, max_concurrent_tasks=1
+        )
+    )
+    return msgs
+
+
+def read_params_py(params_path: Union[Path, str]) -> dict:
+    """
+    Reads the variables of a Phy params.py file without executing it.
+    """
+    import ast
+
+    params = {}
+    for node in ast.parse(Path(params_path).read_text()).body:
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            params[node.targets[0].id] = ast.literal_eval(node.value)
+    return params
+
+
+def load_result_folder(result_folder: Union[Path, str]) -> tuple:
+    """
+    Loads the recording and the (possibly curated) sorting of an existing result folder. The
+    recording is memory-mapped from the binary file named in params.py, and the sorting is built
+    from spike_times.npy and spike_clusters.npy, which Phy updates on merges and splits.
+
+    Parameters:
+    - result_folder: Union[Path, str] - The path to the result folder.
+
+    Returns:
+    - tuple: (recording, sorting, params), where params are the variables of params.py.
+    """
+    result_folder = Path(result_folder)
+    params = read_params_py(result_folder / "params.py")
+    dat_path = Path(params["dat_path"])
+    if not dat_path.is_absolute():
+        dat_path = result_folder / dat_path
+    recording = si.read_binary(
+        dat_path,
+        sampling_frequency=params["sample_rate"],
+        num_channels=params["n_channels_dat"],
+        dtype=params["dtype"],
+        file_offset=params.get("offset", 0),
+    )
+    if "quantization_gain" in params:
+        # restore the units of the preprocessed data from an int16 recording.dat
+        recording = spre.scale(
+            recording,
+            gain=np.array(params["quantization_gain"], dtype=np.float32),
+            offset=np.array(params["quantization_offset"], dtype=np.float32),
+            dtype="float32",
+        )
+    sorting = si.NumpySorting.from_times_labels(
+        [np.load(result_folder / "spike_times.npy").ravel()],
+        [np.load(result_folder / "spike_clusters.npy").ravel()],
+        params["sample_rate"],
+    )
+    return recording, sorting, params
+
+
+def rescore_result_folder(result_folder: Union[Path, str]) -> tuple:
+    """
+    Recomputes the EMUsort scores of an existing result folder without re-sorting. Metrics are
+    only recomputed for units whose spike times changed since they were last saved, the Results
+    section of the dumped configuration file is updated, and the score in the folder name is
+    replaced by the new score.
+
+    Parameters:
+    - result_folder: Union[Path, str] - The path to the result folder.
+
+    Returns:
+    - tuple: (new_result_folder, emusort_score, report)
+    """
+    import re
+
+    result_folder = Path(result_folder)
+    config_path = next(result_folder.glob("*_config.yaml"))
+    yaml = YAML()
+    this_config = yaml.load(config_path)
+
+    recording, sorting, _ = load_result_folder(result_folder)
+    ms_buffer = this_config["KS"]["nt"] / recording.get_sampling_frequency() * 1000 / 2
+    scoring_method = this_config["SI"].get("scoring_method", "waveforms")
+    if scoring_method == "templates":
+        # fast enough to recompute for all units
+        unit_metrics = compute_template_unit_metrics(
+            sorting, result_folder, recording, this_config["KS"].get("nt0min")
+        )
+        unit_metrics["fingerprints"] = get_unit_fingerprints(sorting)
+        save_unit_metrics(
+            result_folder / UNIT_METRICS_FILENAME,
+            unit_metrics,
+            get_metrics_context(recording, ms_buffer, scoring_method),
+        )
+    else:
+        unit_metrics = update_unit_metrics(
+            recording,
+            sorting,
+            result_folder / UNIT_METRICS_FILENAME,
+            ms_buffer,
+            wid=result_folder.name,
+        )
+    (
+        snr_scores,
+        firing_rate_validity_scores,
+        type_I_scores,
+        type_II_scores,
+        emusort_scores,
+        emusort_score,
+        report,
+    ) = get_emusort_scores(unit_metrics, result_folder.name)
+    add_results_to_config(
+        this_config,
+        snr_scores,
+        firing_rate_validity_scores,
+        type_I_scores,
+        type_II_scores,
+        emusort_scores,
+    )
+    dump_yaml(config_path, this_config)
+
+    new_name = re.sub(
+        r"_SCORE_(nan|-?\d+\.\d+)",
+        f"_SCORE_{emusort_score:.3f}",
+        result_folder.name,
+        count=1,
+    )
+    new_result_folder = result_folder.parent / new_name
+    if new_result_folder != result_folder:
+        shutil.move(result_folder, new_result_folder)
+    return new_result_folder, emusort_score, report
+
+
+def rescore_result_folders(result_folders: list, max_workers: int = 5) -> list:
+    """
+    Rescores many result folders in parallel processes, printing the results ranked by score.
+
+    Parameters:
+    - result_folders: list - The paths to the result folders.
+    - max_workers: int - The maximum number of folders to rescore at once.
+
+    Returns:
+    - list: (new_result_folder, emusort_score) tuples of all rescored folders, best first.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    print(f"Rescoring {len(result_folders)} result folders...")
+    rescored = []
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(max_workers, len(result_folders)))
+    ) as executor:
+        futures = {
+            executor.submit(rescore_result_folder, result_folder): result_folder
+            for result_folder in result_folders
+        }
+        for future in as_completed(futures):
+            try:
+                new_result_folder, emusort_score, report = future.result()
+            except Exception as e:
+                print(f"Could not rescore {futures[future]} because:\n{e}")
+                continue
+            print(report)
+            rescored.append((new_result_folder, emusort_score))
+
+    rescored.sort(key=lambda result: -np.nan_to_num(result[1], nan=-np.inf))
+    print("------------------------------------------------------------")
+    print(" Rescored results, ranked by EMUsort score:")
+    for new_result_folder, emusort_score in rescored:
+        print(f" {emusort_score:.3f}  {new_result_folder.as_posix()}")
+    print("------------------------------------------------------------")
+    return rescored
+
+
+def find_result_folders(output_folder: Union[Path, str]) -> list:
+    # result folders are the sorted_### folders which have been exported for Phy
+    return sorted(
+        folder
+        for folder in Path(output_folder).glob("sorted_*")
+        if (folder / "params.py").exists()
+    )
+
+
+COMPARE_DELTA_MS = 0.4  # maximum time difference of coincident spikes across results
+COMPARE_MATCH_AGREEMENT = 0.5  # minimum spike agreement of units matched across results
+COMPARE_EQUIVALENT_SIMILARITY = (
+    0.9  # minimum similarity of results considered equivalent
+)
+
+
+def compute_unit_agreement(
+    spike_times1: np.ndarray,
+    spike_clusters1: np.ndarray,
+    spike_times2: np.ndarray,
+    spike_clusters2: np.ndarray,
+    delta_frames: int,
+) -> tuple:
+    """
+    Computes the spike agreement of every pair of units of two sortings of the same recording,
+    i.e., the number of coincident spikes divided by the number of spikes of either unit. All
+    pairs are computed at once from the sorted spike vectors: each spike of the first sorting is
+    compared with the spikes of the second sorting at a fixed range of offsets from its
+    searchsorted position, which covers every spike within delta_frames.
+
+    Parameters:
+    - spike_times1: np.ndarray - The spike times of the first sorting.
+    - spike_clusters1: np.ndarray - The unit of each spike of the first sorting.
+    - spike_times2: np.ndarray - The spike times of the second sorting.
+    - spike_clusters2: np.ndarray - The unit of each spike of the second sorting.
+    - delta_frames: int - The maximum time difference for two spikes to be coincident.
+
+    Returns:
+    - tuple: (unit_ids1, unit_ids2, agreement), where agreement is a units1 x units2 matrix.
+    """
+    order1 = np.argsort(spike_times1, kind="stable")
+    order2 = np.argsort(spike_times2, kind="stable")
+    times1 = spike_times1[order1].astype(np.int64)
+    times2 = spike_times2[order2].astype(np.int64)
+    unit_ids1, labels1 = np.unique(spike_clusters1[order1], return_inverse=True)
+    unit_ids2, labels2 = np.unique(spike_clusters2[order2], return_inverse=True)
+    num_units1, num_units2 = len(unit_ids1), len(unit_ids2)
+    agreement = np.zeros((num_units1, num_units2))
+    if len(times1) == 0 or len(times2) == 0:
+        return unit_ids1, unit_ids2, agreement
+
+    # most spikes of the second sorting within any window of 2 * delta_frames
+    max_neighbors = int(
+        np.max(
+            np.searchsorted(times2, times2 + 2 * delta_frames, side="right")
+            - np.arange(len(times2))
+        )
+    )
+    first_idx = np.searchsorted(times2, times1 - delta_frames, side="left")
+    pair_codes = []
+    for offset in range(max_neighbors):
+        idx = first_idx + offset
+        valid = idx < len(times2)
+        valid[valid] = np.abs(times2[idx[valid]] - times1[valid]) <= delta_frames
+        spike_idx = np.flatnonzero(valid)
+        # code each (spike, unit) pair, so a spike is counted once per unit
+        pair_codes.append(spike_idx * num_units2 + labels2[idx[valid]])
+    pair_codes = np.unique(np.concatenate(pair_codes))
+    spike_idx, matched_labels2 = np.divmod(pair_codes, num_units2)
+    num_coincident = np.bincount(
+        labels1[spike_idx] * num_units2 + matched_labels2,
+        minlength=num_units1 * num_units2,
+    ).reshape(num_units1, num_units2)
+
+    num_spikes1 = np.bincount(labels1, minlength=num_units1)
+    num_spikes2 = np.bincount(labels2, minlength=num_units2)
+    num_total = num_spikes1[:, None] + num_spikes2[None, :] - num_coincident
+    agreement = num_coincident / np.maximum(num_total, 1)
+    return unit_ids1, unit_ids2, agreement
+
+
+def get_sorting_similarity(agreement: np.ndarray) -> float:
+    """
+    Summarizes how similar two sortings are, by matching their units one-to-one and averaging
+    the agreement of matched units over all units of both sortings (1 if all units are found
+    with identical spikes, 0 if no units are shared).
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    num_units1, num_units2 = agreement.shape
+    if num_units1 == 0 or num_units2 == 0:
+        return float(num_units1 == num_units2)
+    rows, cols = linear_sum_assignment(-agreement)
+    matched = agreement[rows, cols]
+    matched = matched[matched >= COMPARE_MATCH_AGREEMENT]
+    return 2 * float(np.sum(matched)) / (num_units1 + num_units2)
+
+
+def compare_result_folders(result_folders: list, output_path: Path) -> dict:
+    """
+    Compares the results of a sweep by matching units between every pair of results by spike
+    time coincidence. Saves the matrix of sorting similarities to output_path, and prints the
+    clusters of results which are equivalent, together with their swept parameters, so
+    redundant regions of the parameter space can be left out of future sweeps.
+
+    Parameters:
+    - result_folders: list - The paths to the result folders, which must sort the same recording.
+    - output_path: Path - The path of the .npz file to save the comparison to.
+
+    Returns:
+    - dict: The saved "result_folders", "similarity" matrix and equivalence "clusters".
+    """
+    from scipy.cluster.hierarchy import fcluster, linkage
+    from scipy.spatial.distance import squareform
+
+    result_folders = [Path(result_folder) for result_folder in result_folders]
+    print(f"Comparing {len(result_folders)} result folders...")
+    spike_trains = []
+    for result_folder in result_folders:
+        params = read_params_py(result_folder / "params.py")
+        spike_trains.append(
+            (
+                np.load(result_folder / "spike_times.npy").ravel(),
+                np.load(result_folder / "spike_clusters.npy").ravel(),
+                params["sample_rate"],
+            )
+        )
+    assert (
+        len({sample_rate for _, _, sample_rate in spike_trains}) == 1
+    ), "All compared results must have the same sampling rate."
+    delta_frames = int(round(COMPARE_DELTA_MS / 1000 * spike_trains[0][2]))
+
+    num_results = len(result_folders)
+    similarity = np.eye(num_results)
+    for i in range(num_results):
+        for j in range(i + 1, num_results):
+            _, _, agreement = compute_unit_agreement(
+                spike_trains[i][0],
+                spike_trains[i][1],
+                spike_trains[j][0],
+                spike_trains[j][1],
+                delta_frames,
+            )
+            similarity[i, j] = similarity[j, i] = get_sorting_similarity(agreement)
+
+    # results are equivalent if all pairs within a cluster are similar enough
+    if num_results > 1:
+        clusters = fcluster(
+            linkage(squareform(1 - similarity, checks=False), method="complete"),
+            t=1 - COMPARE_EQUIVALENT_SIMILARITY,
+            criterion="distance",
+        )
+    else:
+        clusters = np.ones(num_results, dtype=int)
+
+    def get_swept_params(result_folder):
+        config_paths = list(result_folder.glob("*_config.yaml"))
+        if not config_paths:
+            return {}
+        this_config = YAML().load(config_paths[0])
+        swept_keys = this_config["Sorting"]["KS_params_to_sweep"] or {}
+        return {key: this_config["KS"][key] for key in swept_keys}
+
+    print("------------------------------------------------------------")
+    print(
+        f" Results with pairwise similarity above {COMPARE_EQUIVALENT_SIMILARITY} are equivalent:"
+    )
+    for cluster_id in np.unique(clusters):
+        members = np.flatnonzero(clusters == cluster_id)
+        if len(members) < 2:
+            continue
+        print(f" Cluster {cluster_id} ({len(members)} results):")
+        for member in members:
+            params_str = ", ".join(
+                f"{key}={val}"
+                for key, val in get_swept_params(result_folders[member]).items()
+            )
+            print(f"   {result_folders[member].name}  {params_str}")
+    num_unique = len(np.unique(clusters))
+    print(f" {num_unique} distinct results among {num_results} compared")
+    print(f" Similarity matrix saved to {output_path}")
+    print("------------------------------------------------------------")
+
+    comparison = {
+        "result_folders": np.array([folder.as_posix() for folder in result_folders]),
+        "similarity": similarity,
+        "clusters": clusters,
+    }
+    np.savez(output_path, **comparison)
+    return comparison
+
+
+def compare_scoring_methods(result_folders: list, output_path: Path) -> dict:
+    """
+    Scores result folders both from extracted waveforms and from the Kilosort outputs, and
+    reports how closely the template-based metrics and scores match the waveform-based ones,
+    and how much faster they are. The comparison is saved as JSON to output_path.
+
+    Parameters:
+    - result_folders: list - The paths to the result folders.
+    - output_path: Path - The path of the .json file to save the comparison to.
+
+    Returns:
+    - dict: The "results" with the scores and scoring times of each result folder, the agreement
+      of each unit metric in "metrics", and the agreement of the unit and overall "scores".
+      "same_best_result" is None if all scores of either method are NaN.
+    """
+    from scipy.stats import pearsonr, spearmanr
+
+    def get_agreement(waveform_values, template_values):
+        waveform_values = np.asarray(waveform_values, dtype=float)
+        template_values = np.asarray(template_values, dtype=float)
+        is_finite = np.isfinite(waveform_values) & np.isfinite(template_values)
+        differences = np.abs(template_values - waveform_values)[is_finite]
+        correlation = np.nan
+        if np.sum(is_finite) > 2 and np.ptp(waveform_values[is_finite]) > 0:
+            correlation = pearsonr(
+                waveform_values[is_finite], template_values[is_finite]
+            )[0]
+        return {
+            "correlation": float(correlation),
+            "median_abs_difference": (
+                float(np.median(differences)) if len(differences) else np.nan
+            ),
+            "max_abs_difference": (
+                float(np.max(differences)) if len(differences) else np.nan
+            ),
+            "num_units": int(np.sum(is_finite)),
+        }
+
+    result_folders = [Path(result_folder) for result_folder in result_folders]
+    print(f"Scoring {len(result_folders)} result folders with both scoring methods...")
+    results = []
+    unit_metrics = {"waveforms": [], "templates": []}
+    unit_scores = {"waveforms": [], "templates": []}
+    for result_folder in result_folders:
+        this_config = YAML().load(next(result_folder.glob("*_config.yaml")))
+        recording, sorting, _ = load_result_folder(result_folder)
+        ms_buffer = (
+            this_config["KS"]["nt"] / recording.get_sampling_frequency() * 1000 / 2
+        )
+        # the noise levels are shared, so they do not count towards either method
+        get_recording_noise_levels(recording)
+
+        t0 = time.perf_counter()
+        we = extract_waveforms_in_memory(recording, sorting, ms_buffer)
+        waveform_metrics = compute_unit_metrics(we)
+        waveform_seconds = time.perf_counter() - t0
+        del we
+        t0 = time.perf_counter()
+        template_metrics = compute_template_unit_metrics(
+            sorting, result_folder, recording, this_config["KS"].get("nt0min")
+        )
+        template_seconds = time.perf_counter() - t0
+
+        scores = {}
+        for method, metrics in [
+            ("waveforms", waveform_metrics),
+            ("templates", template_metrics),
+        ]:
+            _, _, _, _, emusort_scores, emusort_score, _ = get_emusort_scores(
+                metrics, result_folder.name
+            )
+            unit_metrics[method].append(metrics)
+            unit_scores[method].append(emusort_scores)
+            scores[method] = float(emusort_score)
+        results.append(
+            {
+                "result_folder": result_folder.as_posix(),
+                "num_units": len(sorting.unit_ids),
+                "waveform_score": scores["waveforms"],
+                "template_score": scores["templates"],
+                "waveform_seconds": waveform_seconds,
+                "template_seconds": template_seconds,
+            }
+        )
+
+    metrics_agreement = {
+        column: get_agreement(
+            np.concatenate([metrics[column] for metrics in unit_metrics["waveforms"]]),
+            np.concatenate([metrics[column] for metrics in unit_metrics["templates"]]),
+        )
+        for column in UNIT_METRIC_COLUMNS
+        if column != "extremum_channel"
+    }
+    waveform_scores = np.array([result["waveform_score"] for result in results])
+    template_scores = np.array([result["template_score"] for result in results])
+    scores_agreement = {
+        "unit_scores": get_agreement(
+            np.concatenate(unit_scores["waveforms"]),
+            np.concatenate(unit_scores["templates"]),
+        ),
+        "result_scores": get_agreement(waveform_scores, template_scores),
+        # the ranking decides which result of a sweep is kept
+        "rank_correlation": (
+            float(spearmanr(waveform_scores, template_scores)[0])
+            if len(results) > 2
+            else np.nan
+        ),
+        # undetermined (None) if either method could not score any result
+        "same_best_result": (
+            bool(np.nanargmax(waveform_scores) == np.nanargmax(template_scores))
+            if np.any(np.isfinite(waveform_scores))
+            and np.any(np.isfinite(template_scores))
+            else None
+        ),
+        "same_extremum_channel": float(
+            np.mean(
+                np.concatenate(
+                    [
+                        metrics["extremum_channel"]
+                        for metrics in unit_metrics["waveforms"]
+                    ]
+                )
+                == np.concatenate(
+                    [
+                        metrics["extremum_channel"]
+                        for metrics in unit_metrics["templates"]
+                    ]
+                )
+            )
+        ),
+    }
+    for method, method_scores in [
+        ("waveforms", waveform_scores),
+        ("templates", template_scores),
+    ]:
+        if not np.any(np.isfinite(method_scores)):
+            print(
+                f"WARNING: No result could be scored from {method} (e.g., they have no units), "
+                "so the best results cannot be compared."
+            )
+    total_waveform_seconds = sum(result["waveform_seconds"] for result in results)
+    total_template_seconds = sum(result["template_seconds"] for result in results)
+
+    print("------------------------------------------------------------")
+    print(" Template-based vs waveform-based scoring:")
+    for result in results:
+        print(
+            f" {result['waveform_score']:.3f} vs {result['template_score']:.3f} "
+            f"({result['waveform_seconds']:.1f} s vs {result['template_seconds']:.1f} s)  "
+            f"{Path(result['result_folder']).name}"
+        )
+    print(" Agreement of unit metrics (correlation, median absolute difference):")
+    for column, agreement in {**metrics_agreement, **scores_agreement}.items():
+        if isinstance(agreement, dict):
+            print(
+                f"   {column}: {agreement['correlation']:.3f}, {agreement['median_abs_difference']:.3g}"
+            )
+    print(
+        f" Rank correlation of result scores: {scores_agreement['rank_correlation']:.3f}, "
+        f"same best result: {scores_agreement['same_best_result']}, "
+        f"same extremum channel: {scores_agreement['same_extremum_channel']:.1%} of units"
+    )
+    print(
+        f" Scoring time: {total_waveform_seconds:.1f} s from waveforms, {total_template_seconds:.1f} s "
+        f"from templates ({total_waveform_seconds / max(total_template_seconds, 1e-9):.1f}x faster)"
+    )
+    print(f" Comparison saved to {output_path}")
+    print("------------------------------------------------------------")
+
+    comparison = {
+        "results": results,
+        "metrics": metrics_agreement,
+        "scores": scores_agreement,
+    }
+    with open(output_path, "w") as f:
+        json.dump(comparison, f, indent=2)
+    return comparison
+
+
+PC_NUM_COMPONENTS = 3  # temporal principal components per channel, as in Kilosort
+PC_NUM_CHANNELS = 16  # channels with the largest template amplitudes kept per template
+TEMPLATE_FEATURE_NUM = 10  # most similar templates each spike is projected onto
+PC_TRAINING_SPIKES = 10000  # spikes used to fit the temporal principal components
+
+
+def get_result_score(result_folder: Union[Path, str]) -> float:
+    # the EMUsort score is stored in the name of each result folder
+    import re
+
+    match = re.search(r"_SCORE_(nan|-?\d+\.\d+)", Path(result_folder).name)
+    return float(match.group(1)) if match else np.nan
+
+
+def export_pc_features(
+    result_folder: Union[Path, str], max_batch_bytes: int = 256 * 1024**2
+) -> Path:
+    """
+    Computes the principal component and template features that Phy uses for its feature views,
+    and saves them as pc_features.npy, pc_feature_ind.npy, template_features.npy and
+    template_feature_ind.npy in the result folder. Waveforms are read from the memory-mapped
+    recording.dat in batches of spikes, so memory use is bounded by max_batch_bytes regardless of
+    the number of spikes, and the features are written to memory-mapped output files.
+
+    Parameters:
+    - result_folder: Union[Path, str] - The path to the result folder.
+    - max_batch_bytes: int - The maximum size of the waveforms read at once.
+
+    Returns:
+    - Path: The result folder.
+    """
+    result_folder = Path(result_folder)
+    params = read_params_py(result_folder / "params.py")
+    dat_path = Path(params["dat_path"])
+    if not dat_path.is_absolute():
+        dat_path = result_folder / dat_path
+    traces = np.memmap(
+        dat_path,
+        dtype=params["dtype"],
+        mode="r",
+        offset=params.get("offset", 0),
+    ).reshape(-1, params["n_channels_dat"])
+    num_frames, num_chans = traces.shape
+
+    spike_times = np.load(result_folder / "spike_times.npy").ravel().astype(np.int64)
+    if (result_folder / "spike_templates.npy").exists():
+        spike_templates = np.load(result_folder / "spike_templates.npy").ravel()
+    else:
+        spike_templates = np.load(result_folder / "spike_clusters.npy").ravel()
+    templates = load_unwhitened_templates(result_folder)
+    num_templates, nt, _ = templates.shape
+    # sample of each waveform at which Kilosort places the spike time
+    nt0min = int(20 * nt / 61)
+    config_paths = list(result_folder.glob("*_config.yaml"))
+    if config_paths:
+        nt0min = YAML().load(config_paths[0])["KS"].get("nt0min") or nt0min
+    offsets = np.arange(nt) - nt0min
+
+    # channels of each template, ordered by template amplitude
+    num_pc_chans = min(PC_NUM_CHANNELS, num_chans)
+    template_ptp = templates.max(axis=1) - templates.min(axis=1)
+    pc_feature_ind = np.argsort(-template_ptp, axis=1)[:, :num_pc_chans].astype(
+        np.uint32
+    )
+    # most similar templates of each template, including itself
+    num_template_features = min(TEMPLATE_FEATURE_NUM, num_templates)
+    flat_templates = templates.reshape(num_templates, -1)
+    template_norms = np.linalg.norm(flat_templates, axis=1)
+    template_norms[template_norms == 0] = 1
+    similarity = (flat_templates @ flat_templates.T) / np.outer(
+        template_norms, template_norms
+    )
+    np.fill_diagonal(similarity, np.inf)
+    template_feature_ind = np.argsort(-similarity, axis=1)[
+        :, :num_template_features
+    ].astype(np.uint32)
+
+    quantization_gain = np.array(params.get("quantization_gain", 1), dtype=np.float32)
+    quantization_offset = np.array(
+        params.get("quantization_offset", 0), dtype=np.float32
+    )
+
+    def read_waveforms(these_times):
+        # (num_spikes, nt, num_chans) waveforms, clipped at the edges of the recording
+        frames = np.clip(these_times[:, None] + offsets, 0, num_frames - 1)
+        return traces[frames] * quantization_gain + quantization_offset
+
+    # global temporal principal components from the peak channels of a spike subsample,
+    # zero-padded if there are fewer spikes than components (empty features without spikes)
+    num_pcs = PC_NUM_COMPONENTS
+    temporal_pcs = np.zeros((nt, num_pcs), dtype=np.float32)
+    if len(spike_times) > 0:
+        rng = np.random.default_rng(0)
+        training_idx = np.sort(
+            rng.choice(
+                len(spike_times),
+                min(PC_TRAINING_SPIKES, len(spike_times)),
+                replace=False,
+            )
+        )
+        training_waveforms = read_waveforms(spike_times[training_idx])
+        peak_chans = pc_feature_ind[spike_templates[training_idx], 0]
+        training_waveforms = training_waveforms[
+            np.arange(len(training_idx)), :, peak_chans
+        ]
+        _, _, Vt = np.linalg.svd(training_waveforms, full_matrices=False)
+        temporal_pcs[:, : min(num_pcs, len(Vt))] = Vt[:num_pcs].T  # (nt, num_pcs)
+
+    pc_features = np.lib.format.open_memmap(
+        result_folder / "pc_features.npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(spike_times), num_pcs, num_pc_chans),
+    )
+    template_features = np.lib.format.open_memmap(
+        result_folder / "template_features.npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(spike_times), num_template_features),
+    )
+    unit_templates = flat_templates / template_norms[:, None]
+    batch_size = max(1, max_batch_bytes // (nt * num_chans * 4))
+    for start in range(0, len(spike_times), batch_size):
+        stop = min(start + batch_size, len(spike_times))
+        waveforms = read_waveforms(spike_times[start:stop])
+        these_templates = spike_templates[start:stop]
+        these_chans = pc_feature_ind[these_templates]
+        batch_idx = np.arange(stop - start)[:, None]
+        # (num_spikes, nt, num_pc_chans) -> (num_spikes, num_pcs, num_pc_chans)
+        pc_features[start:stop] = np.einsum(
+            "stc,tp->spc",
+            waveforms.transpose(0, 2, 1)[batch_idx, these_chans].transpose(0, 2, 1),
+            temporal_pcs,
+        )
+        template_features[start:stop] = np.take_along_axis(
+            waveforms.reshape(stop - start, -1) @ unit_templates.T,
+            template_feature_ind[these_templates].astype(np.int64),
+            axis=1,
+        )
+    pc_features.flush()
+    template_features.flush()
+    del pc_features, template_features
+    np.save(result_folder / "pc_feature_ind.npy", pc_feature_ind)
+    np.save(result_folder / "template_feature_ind.npy", template_feature_ind)
+    return result_folder
+
+
+def export_result_folders(
+    result_folders: list,
+    top_k: Union[int, None] = None,
+    max_workers: int = 5,
+    memory_budget: Union[int, None] = None,
+) -> list:
+    """
+    Exports Phy features for the best result folders in parallel processes.
+
+    Parameters:
+    - result_folders: list - The paths to the result folders.
+    - top_k: Union[int, None] - Only export the top_k folders ranked by EMUsort score, or all if None.
+    - max_workers: int - The maximum number of folders to export at once.
+    - memory_budget: Union[int, None] - Memory in bytes shared by all exports, or None for 256 MB batches.
+
+    Returns:
+    - list: The paths of the exported result folders.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    result_folders = sorted(
+        result_folders,
+        key=lambda folder: -np.nan_to_num(get_result_score(folder), nan=-np.inf),
+    )
+    if top_k is not None:
+        result_folders = result_folders[:top_k]
+    if not result_folders:
+        print("No result folders to export.")
+        return []
+    num_workers = max(1, min(max_workers, len(result_folders)))
+    max_batch_bytes = 256 * 1024**2
+    if memory_budget is not None:
+        # each export holds a batch of waveforms plus a copy cast to float32
+        max_batch_bytes = min(max_batch_bytes, memory_budget // (2 * num_workers))
+
+    print(f"Exporting Phy features for {len(result_folders)} result folders...")
+    exported = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(
+                export_pc_features, result_folder, max_batch_bytes
+            ): result_folder
+            for result_folder in result_folders
+        }
+        for future in as_completed(futures):
+            try:
+                exported.append(future.result())
+            except Exception as e:
+                print(f"Could not export {futures[future]} because:\n{e}")
+                continue
+            print(f"Exported Phy features for {futures[future].as_posix()}")
+    return exported
+
+
+class WorkerParamsGrid:
+    """
+    Sequence of the swept Kilosort parameters of each sorting job, which are generated on demand
+    when indexed, so that sweeps with thousands of combinations never hold all of them in memory.
+
+    Parameters:
+    - param_grid: ParameterGrid - The grid of parameters, where linked parameters are grouped as gp# keys.
+    - linked_param_keys: list - The ordered parameter keys of each gp# group.
+    """
+
+    def __init__(self, param_grid: ParameterGrid, linked_param_keys: list):
+        self.param_grid = param_grid
+        self.linked_param_keys = linked_param_keys
+
+    def __len__(self) -> int:
+        return len(self.param_grid)
+
+    def __getitem__(self, wid: int) -> dict:
+        if not 0 <= wid < len(self):
+            raise IndexError(f"Worker {wid} is out of range for {len(self)} jobs")
+        worker_params = self.param_grid[int(wid)]
+        # now replace the gp# keys with the corresponding key-value pairs
+        for gid, linked_params_keys in enumerate(self.linked_param_keys):
+            for key, param_key in enumerate(linked_params_keys):
+                worker_params[param_key] = worker_params[f"gp{gid}"][key]
+            del worker_params[f"gp{gid}"]
+        return worker_params
+
+    def __iter__(self):
+        return (self[wid] for wid in range(len(self)))
+
+
+def get_worker_params_grid(full_config: dict) -> Union[WorkerParamsGrid, list]:
+    """
+    Validates the parameter sweep settings and expands them into the Kilosort parameters of each
+    sorting job, combining linked parameters by index and all other parameters as a full grid.
+
+    Parameters:
+    - full_config: dict - The configuration dictionary.
+
+    Returns:
+    - Union[WorkerParamsGrid, list]: The swept Kilosort parameters of each job ([{}] if no sweep is done).
+    """
+    ## do not overwrite KS section unless param sweep enabled
+    if full_config["Sorting"]["do_KS_param_sweep"] == 0:
+        return [{}]
+    # input verification
+    assert (
+        full_config["Sorting"]["KS_params_to_sweep"] is not None
+    ), "You must provide at least 1 parameter under KS_params_to_sweep if do_KS_param_sweep is True"
+
+    for key, val in full_config["Sorting"]["KS_params_to_sweep"].items():
+        try:
+            assert key in [
+                k for k, _ in full_config["KS"].items()
+            ], f"Keys in KS_params_to_sweep must be a parameter in the KS section, but {str(key)} was not found"
+            assert isinstance(
+                val, list
+            ), f"The values of each key in KS_params_to_sweep must be a list, but the value for {str(key)} was type {type(val)}. Try adding brackets"
+        except AssertionError as e:
+            raise AssertionError(
+                "Elements of KS_params_to_sweep must be key-value pairs, with valid keys from the KS section and a list of values for each key."
+            ) from e
+    # passed verification
+    KS_params_to_sweep = deepcopy(full_config["Sorting"]["KS_params_to_sweep"])
+    # keep track of original key order before separating out the linked parameters
+    KS_params_to_sweep_orig_keys = list(KS_params_to_sweep.keys())
+
+    if full_config["Sorting"]["linked_params_for_sweep"] is None:
+        linked_param_groups_list = []
+    else:
+        # input verification
+        try:
+            for lst in full_config["Sorting"]["linked_params_for_sweep"]:
+                assert isinstance(lst, list)
+                for kid, key in enumerate(lst):
+                    assert isinstance(
+                        key, str
+                    ), f"Elements in each list of linked_params_for_sweep must be strings, but {str(key)} was type {type(key)}"
+                    assert key in [
+                        k for k, _ in full_config["KS"].items()
+                    ], f"Elements in each list of linked_params_for_sweep must be a parameter in the KS section, but {key} was not."
+                    length_of_this_linked_param = len(KS_params_to_sweep[key])
+                    if kid > 0:
+                        assert (
+                            length_of_previous_linked_param
+                            == length_of_this_linked_param
+                        ), f"The length of linked parameters must be equal, but lengths {length_of_previous_linked_param} and {length_of_this_linked_param} were found."
+                    length_of_previous_linked_param = length_of_this_linked_param
+        except AssertionError as e:
+            raise AssertionError(
+                "Elements of linked_params_for_sweep must be lists of strings (parameter keys from the KS section). "
+                "Linked parameters must all be the same length."
+            ) from e
+        # passed verification
+        linked_param_groups_list = full_config["Sorting"]["linked_params_for_sweep"]
+
+    # set linked parameters as separate entries with a new parameter group key
+    # take the keys in the order specified in KS_params_to_sweep to preserve expected order
+    for gid, linked_params_keys in enumerate(linked_param_groups_list):
+        KS_params_to_sweep[f"gp{gid}"] = [
+            # list(gval) for gval in zip(*(params[k] for k in linked_params_list))
+            list(gval)
+            for gval in zip(
+                *(  # unpack values from dictionaries so they can be zipped
+                    KS_params_to_sweep[
+                        k
+                    ]  # make sure order is determined by KS_params_to_sweep
+                    for k in [
+                        key
+                        for key in KS_params_to_sweep_orig_keys
+                        if str(key) in linked_params_keys
+                    ]
+                )
+            )
+        ]
+        # get rid of the individual keys that are in separate groups now
+        for key in linked_params_keys:
+            del KS_params_to_sweep[key]
+    # make sure order of linked keys is determined by KS_params_to_sweep
+    linked_param_keys = [
+        [key for key in KS_params_to_sweep_orig_keys if str(key) in linked_params_keys]
+        for linked_params_keys in linked_param_groups_list
+    ]
+    return WorkerParamsGrid(ParameterGrid(KS_params_to_sweep), linked_param_keys)
+
+
+def make_sorting_job(
+    wid: int,
+    worker_params: dict,
+    full_config: dict,
+    preproc_recording: si.BaseRecording,
+    group_sorted_folder: Path,
+    sort_type: str,
+) -> tuple:
+    """
+    Creates the job parameters and configuration of a single sorting job, and clears its
+    temporary sorted folder.
+
+    Parameters:
+    - wid: int - The worker id of the job.
+    - worker_params: dict - The swept Kilosort parameters of this job.
+    - full_config: dict - The configuration dictionary.
+    - preproc_recording: si.BaseRecording - The preprocessed recording of this channel group.
+    - group_sorted_folder: Path - The base path of the sorted folders of this channel group.
+    - sort_type: str - "emu" or "ks4".
+
+    Returns:
+    - tuple: (job, this_config), the job parameters for run_sorter and its configuration.
+    """
+    # create new folder for each parallel job
+    zfill_amount = len(str(full_config["Sorting"]["num_KS_jobs"]))
+    tmp_sorted_folder = (
+        group_sorted_folder.as_posix() + "_wkr" + str(wid).zfill(zfill_amount)
+    )
+    if Path(tmp_sorted_folder).exists():
+        shutil.rmtree(tmp_sorted_folder, ignore_errors=True)
+    # create a new config file for each parallel job
+    this_config = deepcopy(full_config)
+    this_config["Sorting"]["sorted_folder"] = tmp_sorted_folder
+    if full_config["Sorting"]["do_KS_param_sweep"] == 1:
+        # overwrite keys only if parameter sweep is enabled
+        try:
+            for key in worker_params.keys():
+                this_config["KS"][key] = worker_params[key]
+        except KeyError as e:
+            print(
+                "Incorrect variable encountered in KS_params_to_sweep. Check the variables or ensure you're using the latest EMUsort release"
+            )
+            raise e
+
+    this_config["num_chans"] = preproc_recording.get_num_channels()
+    this_config["sort_type"] = sort_type
+    this_config["KS"]["nearest_chans"] = min(
+        this_config["num_chans"], this_config["KS"]["nearest_chans"]
+    )  # do not let nearest_chans exceed the number of channels
+    this_config["KS"]["nearest_templates"] = min(
+        this_config["num_chans"], this_config["KS"]["nearest_templates"]
+    )  # do not let nearest_templates exceed the number of channels
+    if this_config.get("resampling"):
+        # parameters in samples keep their duration at the resampled rate
+        adjust_KS_params_for_resampling(this_config["KS"], this_config["resampling"])
+    if this_config["KS"]["torch_device"] == "auto":
+        torch_device_id = str(
+            full_config["Sorting"]["GPU_to_use"][
+                wid % len(full_config["Sorting"]["GPU_to_use"])
+            ]
+        )
+        this_config["KS"]["torch_device"] = (
+            "cuda:" + torch_device_id if is_available() else "cpu"
+        )
+    if this_config["KS"]["torch_device"] == "cpu":
+        print(
+            f"Using CPU for Kilosort. Runtimes will be MUCH slower. If trying CUDA, make sure GPU(s) can be detected."
+        )
+    this_config["emg_chans_used"] = preproc_recording.get_channel_ids().tolist()
+
+    job = {
+        "sorter_name": "kilosort4",
+        "recording": preproc_recording,
+        "output_folder": this_config["Sorting"]["sorted_folder"],
+        **this_config["KS"],
+    }
+    return job, this_config
+
+
+QUEUE_MAX_ATTEMPTS = 3  # times a job is claimed before it is moved to failed
+QUEUE_STATES = ["pending", "claimed", "done", "failed"]
+
+
+def get_job_queue_folder(full_config: dict) -> Path:
+    # the job queue must be on storage shared by all machines running workers
+    if full_config["Sorting"]["job_queue_folder"]:
+        return Path(full_config["Sorting"]["job_queue_folder"]).expanduser().resolve()
+    return (
+        Path(
+            full_config["Sorting"]["output_folder"]
+            or full_config["Data"]["session_folder"]
+        )
+        .expanduser()
+        .resolve()
+        / "emusort_queue"
+    )
+
+
+def enqueue_sorting_jobs(
+    queue_folder: Path,
+    full_config: dict,
+    iChanGroup: int,
+    recording_folder: Path,
+    group_sorted_folder: Path,
+    num_jobs: int,
+    sort_type: str,
+    job_order: Union[list, None] = None,
+    clear_queue: bool = False,
+):
+    """
+    Writes the sorting jobs of a channel group to a job queue on shared storage, to be run by any
+    number of "emusort --worker" processes. Each job is a small JSON file which moves between the
+    pending, claimed, done and failed folders of the queue, and the configuration is frozen in the
+    queue folder so later edits of the session's config file do not affect queued jobs. Workers
+    claim the jobs of each group in the order of job_order, which is encoded in the file names.
+
+    The jobs of the previous sort are cleared from the queue when the first group is queued,
+    unless some of them are still claimed by workers, in which case the sort is refused unless
+    clear_queue is set.
+
+    Parameters:
+    - queue_folder: Path - The folder of the job queue.
+    - full_config: dict - The configuration dictionary.
+    - iChanGroup: int - The index of the channel group.
+    - recording_folder: Path - The folder of the cached preprocessed recording of this group.
+    - group_sorted_folder: Path - The base path of the sorted folders of this channel group.
+    - num_jobs: int - The number of sorting jobs of this group.
+    - sort_type: str - "emu" or "ks4".
+    - job_order: Union[list, None] - The worker ids in the order to run them (default: grid order).
+    - clear_queue: bool - Whether to clear the queue even if workers are running its jobs.
+    """
+    if iChanGroup == 0 and queue_folder.exists():
+        num_running = len(list((queue_folder / "claimed").glob("*.json")))
+        assert clear_queue or num_running == 0, (
+            f"{num_running} jobs of the previous sort are still running from {queue_folder}. "
+            "Wait for its workers to finish, or pass --clear-queue to discard its jobs."
+        )
+        print(f"Clearing jobs of the previous sort from {queue_folder}")
+        shutil.rmtree(queue_folder)
+    for state in QUEUE_STATES:
+        (queue_folder / state).mkdir(parents=True, exist_ok=True)
+    dump_yaml(queue_folder / "queue_config.yaml", full_config)
+    zfill_amount = len(str(num_jobs))
+    job_order = range(num_jobs) if job_order is None else job_order
+    for rank, wid in enumerate(job_order):
+        job_spec = {
+            "group": iChanGroup,
+            "wid": wid,
+            "recording_folder": str(recording_folder),
+            "group_sorted_folder": str(group_sorted_folder),
+            "sort_type": sort_type,
+            "attempts": 0,
+        }
+        job_name = f"g{iChanGroup}_{str(rank).zfill(zfill_amount)}_wkr{str(wid).zfill(zfill_amount)}.json"
+        # write under a temporary name, so workers never claim a partial file
+        tmp_path = queue_folder / "pending" / f".{job_name}.tmp"
+        tmp_path.write_text(json.dumps(job_spec))
+        os.replace(tmp_path, queue_folder / "pending" / job_name)
+    print(f"Queued {num_jobs} sorting jobs of group {iChanGroup} in {queue_folder}")
+
+
+def get_queue_counts(queue_folder: Path) -> dict:
+    return {
+        state: len(list((queue_folder / state).glob("*.json")))
+        for state in QUEUE_STATES
+    }
+
+
+def get_queued_job_name(job_path: Path) -> str:
+    # claimed job files are named <job name>@<claim>.json, the other states <job name>.json
+    return job_path.stem.split("@")[0] + ".json"
+
+
+def claim_queued_job(queue_folder: Path, worker_name: str) -> Union[Path, None]:
+    """
+    Claims the next pending job by renaming it into the claimed folder, which is atomic on local
+    and NFS file systems, so each job is claimed by exactly one worker. The claimed file is named
+    after the worker and a random claim id, so each claim has its own path, which only exists
+    while the claim holds. The modification time of the claimed file is the lease, renewed by the
+    worker while it runs the job.
+
+    Parameters:
+    - queue_folder: Path - The folder of the job queue.
+    - worker_name: str - The name of the claiming worker.
+
+    Returns:
+    - Union[Path, None]: The path of the claimed job file, or None if no job is pending.
+    """
+    import uuid
+
+    claim_id = f"{worker_name.replace(':', '_')}_{uuid.uuid4().hex[:8]}"
+    for pending_path in sorted((queue_folder / "pending").glob("*.json")):
+        claimed_path = queue_folder / "claimed" / f"{pending_path.stem}@{claim_id}.json"
+        try:
+            # renew the lease before the rename, so the claimed file is never stale
+            os.utime(pending_path)
+            os.rename(pending_path, claimed_path)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        return claimed_path
+    return None
+
+
+def release_claimed_job(
+    queue_folder: Path, claimed_path: Path, state: str, job_spec: dict
+) -> bool:
+    """
+    Moves a claimed job to the given state with its updated spec, if the claim still holds. The
+    claimed file is renamed first, which only succeeds for one of the worker and the workers
+    requeueing it, and the spec is then written at the destination under a temporary name, so
+    workers never claim a job before its spec is updated.
+
+    Parameters:
+    - queue_folder: Path - The folder of the job queue.
+    - claimed_path: Path - The path of the claimed job file.
+    - state: str - The state to move the job to, one of QUEUE_STATES.
+    - job_spec: dict - The updated spec of the job.
+
+    Returns:
+    - bool: Whether the job was moved, False if it was already moved by another worker.
+    """
+    moving_path = queue_folder / state / f".{claimed_path.name}.tmp"
+    try:
+        os.rename(claimed_path, moving_path)
+    except FileNotFoundError:
+        return False
+    moving_path.write_text(json.dumps(job_spec))
+    os.rename(moving_path, queue_folder / state / get_queued_job_name(claimed_path))
+    return True
+
+
+def get_queue_clock_path(queue_folder: Path) -> Path:
+    # file which this worker touches to read the clock of the storage holding the queue
+    return queue_folder / f".clock_{platform.node()}_{os.getpid()}"
+
+
+def get_queue_time(queue_folder: Path) -> float:
+    """
+    Returns the current time of the storage holding the queue folder, as the modification time of
+    a file this worker just touched. Leases are the modification times of the claimed job files,
+    set by the storage (e.g., the NFS server) when workers renew them, so comparing them with this
+    time instead of the local clock is not affected by clock differences between machines.
+    """
+    clock_path = get_queue_clock_path(queue_folder)
+    clock_path.touch()
+    return clock_path.stat().st_mtime
+
+
+def requeue_lost_jobs(queue_folder: Path, lease_duration: float) -> int:
+    """
+    Moves claimed jobs whose lease was not renewed for lease_duration seconds back to pending,
+    or to failed once they have been attempted QUEUE_MAX_ATTEMPTS times. The lost attempt is
+    counted here, so jobs which crash their workers before they can count it still fail.
+
+    Returns:
+    - int: The number of jobs which were requeued.
+    """
+    num_requeued = 0
+    queue_time = get_queue_time(queue_folder)
+    for claimed_path in (queue_folder / "claimed").glob("*.json"):
+        try:
+            if queue_time - claimed_path.stat().st_mtime < lease_duration:
+                continue
+            job_spec = json.loads(claimed_path.read_text())
+        except (FileNotFoundError, ValueError):
+            continue  # finished or requeued by another worker in the meantime
+        job_spec["attempts"] += 1
+        job_spec["error"] = f"Lease of claim {claimed_path.stem} expired"
+        state = "pending" if job_spec["attempts"] < QUEUE_MAX_ATTEMPTS else "failed"
+        if not release_claimed_job(queue_folder, claimed_path, state, job_spec):
+            continue
+        print(f"Job {claimed_path.stem} was lost by its worker, moved to {state}.")
+        num_requeued += state == "pending"
+    return num_requeued
+
+
+def run_queued_job(claimed_path: Path, full_config: dict, recordings: dict) -> dict:
+    """
+    Sorts and extracts a claimed job like a single job of run_KS_sorting.
+
+    Parameters:
+    - claimed_path: Path - The path of the claimed job file.
+    - full_config: dict - The frozen configuration of the queue.
+    - recordings: dict - Preprocessed recordings already loaded by this worker, keyed by folder.
+
+    Returns:
+    - dict: The result of the job, as returned by extract_sorting_result.
+    """
+    job_spec = json.loads(claimed_path.read_text())
+    if job_spec["recording_folder"] not in recordings:
+        recordings[job_spec["recording_folder"]] = si.load_extractor(
+            job_spec["recording_folder"]
+        )
+        load_group_noise_levels(
+            recordings[job_spec["recording_folder"]],
+            Path(job_spec["recording_folder"]).parent / NOISE_LEVELS_FILENAME,
+        )
+        if full_config["SI"]["quantize_recording_dat"]:
+            load_group_quantization_params(
+                recordings[job_spec["recording_folder"]],
+                Path(job_spec["recording_folder"]).parent / QUANTIZATION_FILENAME,
+            )
+    job, this_config = make_sorting_job(
+        job_spec["wid"],
+        get_worker_params_grid(full_config)[job_spec["wid"]],
+        full_config,
+        recordings[job_spec["recording_folder"]],
+        Path(job_spec["group_sorted_folder"]),
+        job_spec["sort_type"],
+    )
+    run_sorter_job(job)
+    sorting = ss.read_sorter_folder(job["output_folder"])
+    return asyncio.run(
+        extract_sorting_result(sorting, this_config, job, job_spec["wid"])
+    )
+
+
+def run_queue_worker(queue_folder: Path, lease_duration: float):
+    """
+    Claims and runs jobs from the job queue until no jobs are pending or claimed. Several workers
+    can run at once on the same or different machines sharing the queue folder. While a job runs,
+    a background thread renews its lease; jobs of workers which stopped renewing their lease are
+    retried by the other workers.
+
+    Parameters:
+    - queue_folder: Path - The folder of the job queue.
+    - lease_duration: float - Seconds without renewal after which a claimed job is considered lost.
+    """
+    worker_name = f"{platform.node()}:{os.getpid()}"
+    yaml = YAML()
+    full_config = yaml.load(queue_folder / "queue_config.yaml")
+    full_config["Data"]["session_folder"] = Path(full_config["Data"]["session_folder"])
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    recordings = {}
+    print(
+        f"Worker {worker_name} started on {queue_folder}: {get_queue_counts(queue_folder)}"
+    )
+
+    while True:
+        claimed_path = claim_queued_job(queue_folder, worker_name)
+        if claimed_path is None:
+            counts = get_queue_counts(queue_folder)
+            if counts["claimed"] == 0:
+                break
+            # wait for the jobs of other workers, and retry them if they are lost
+            if requeue_lost_jobs(queue_folder, lease_duration) == 0:
+                time.sleep(min(30, lease_duration / 4))
+            continue
+
+        # attempts are counted when they end, by this worker or by the one requeueing the job
+        job_spec = json.loads(claimed_path.read_text())
+        job_spec["worker"] = worker_name
+        print(
+            f"Worker {worker_name} running job {claimed_path.stem} (attempt {job_spec['attempts'] + 1})"
+        )
+
+        stop_event = threading.Event()
+
+        def renew_lease():
+            while not stop_event.wait(lease_duration / 4):
+                try:
+                    os.utime(claimed_path)
+                except FileNotFoundError:
+                    return  # the job was requeued by another worker
+
+        lease_thread = threading.Thread(target=renew_lease, daemon=True)
+        lease_thread.start()
+        try:
+            result = run_queued_job(claimed_path, full_config, recordings)
+            job_spec["attempts"] += 1
+            job_spec["report"] = result["report"]
+            job_spec["result_folder"] = result["result_folder"].as_posix()
+            state = "done"
+            print(result["report"])
+            print(result["phy_msg"])
+        except Exception as e:
+            job_spec["attempts"] += 1
+            job_spec["error"] = repr(e)
+            state = "pending" if job_spec["attempts"] < QUEUE_MAX_ATTEMPTS else "failed"
+            print(
+                f"Job {claimed_path.stem} failed on {worker_name}, moved to {state}:\n{e}"
+            )
+        finally:
+            stop_event.set()
+            lease_thread.join()
+        if not release_claimed_job(queue_folder, claimed_path, state, job_spec):
+            print(
+                f"Job {claimed_path.stem} was requeued while it ran, its lease expired."
+            )
+
+    get_queue_clock_path(queue_folder).unlink(missing_ok=True)
+    print(
+        f"Worker {worker_name} finished, no jobs left: {get_queue_counts(queue_folder)}"
+    )
+
+
+# throughput assumed by --plan when no previous runs are available for calibration
+DEFAULT_SORT_SECONDS_PER_SAMPLE = 1 / 2e6  # per sample per channel, Kilosort on a GPU
+DEFAULT_EXTRACT_SECONDS_PER_SAMPLE = 1 / 2e7  # per sample per channel
+DEFAULT_NUM_UNITS = 50
+
+
+def load_runtime_calibration(output_folder: Union[Path, str]) -> Union[dict, None]:
+    """
+    Measures the sorting and extraction time per sample and channel, and the mean number of units,
+    from the status file of the last run in the output folder. Returns None if there is none.
+    """
+    status_path = Path(output_folder) / "emusort_status.json"
+    if not status_path.exists():
+        return None
+    try:
+        jobs = json.loads(status_path.read_text())["jobs"]
+    except (OSError, ValueError, KeyError):
+        return None
+    sorted_jobs = [job for job in jobs if "sorting" in job["durations"]]
+    extracted_jobs = [job for job in jobs if job["state"] == "done"]
+    if not sorted_jobs:
+        return None
+    calibration = {
+        "sort_seconds_per_sample": sum(
+            job["durations"]["sorting"] for job in sorted_jobs
+        )
+        / sum(job["num_samples"] * job["num_chans"] for job in sorted_jobs),
+        "extract_seconds_per_sample": DEFAULT_EXTRACT_SECONDS_PER_SAMPLE,
+        "num_units": DEFAULT_NUM_UNITS,
+        "num_jobs": len(sorted_jobs),
+    }
+    if extracted_jobs:
+        calibration["extract_seconds_per_sample"] = sum(
+            sum(
+                job["durations"].get(state, 0)
+                for state in ["extracting", "scoring", "exporting"]
+            )
+            for job in extracted_jobs
+        ) / sum(job["num_samples"] * job["num_chans"] for job in extracted_jobs)
+    jobs_with_units = [job for job in jobs if "num_units" in job]
+    if jobs_with_units:
+        calibration["num_units"] = np.mean(
+            [job["num_units"] for job in jobs_with_units]
+        )
+    return calibration
+
+
+RUNTIME_HISTORY_FILENAME = "emusort_runtime_history.jsonl"
+RUNTIME_HISTORY_MAX_RECORDS = (
+    1000  # most recent sorting jobs used to fit the runtime model
+)
+# Kilosort parameters recorded with each job of the runtime history
+RUNTIME_MODEL_PARAMS = ["Th_single_ch", "Th_universal", "Th_learned"]
+# prior slopes of the log runtime per sample against the log number of thresholds, and the
+# logs of Th_universal and Th_learned relative to their defaults (lower thresholds detect
+# more spikes and learn more templates)
+RUNTIME_MODEL_PRIOR_SLOPES = [1.0, -1.0, -1.0]
+RUNTIME_MODEL_PRIOR_WEIGHT = 1.0  # weight of the prior, in number of past jobs
+
+
+def load_runtime_history(output_folder: Union[Path, str]) -> list:
+    """
+    Loads the most recent records of the runtime history of the output folder, one per sorting
+    job of previous runs. Returns an empty list if there is none.
+    """
+    history_path = Path(output_folder) / RUNTIME_HISTORY_FILENAME
+    if not history_path.exists():
+        return []
+    records = []
+    for line in history_path.read_text().splitlines()[-RUNTIME_HISTORY_MAX_RECORDS:]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # skip lines of a run which was interrupted while writing
+            continue
+    return records
+
+
+def append_runtime_history(output_folder: Union[Path, str], jobs: list):
+    """
+    Appends the sorting time, recording size and parameters of each sorted job of a
+    SweepProgress to the runtime history of the output folder.
+    """
+    timestamp = datetime.now().isoformat(timespec="seconds")
+    lines = [
+        json.dumps(
+            {
+                "time": timestamp,
+                "num_samples": job["num_samples"],
+                "num_chans": job["num_chans"],
+                "sampling_frequency": job["sampling_frequency"],
+                "KS": {
+                    key: job["KS"][key]
+                    for key in RUNTIME_MODEL_PARAMS
+                    if key in job["KS"]
+                },
+                "sort_s": job["durations"]["sorting"],
+                "predicted_sort_s": job.get("predicted_sort_s"),
+            },
+            default=float,
+        )
+        for job in jobs
+        if "sorting" in job["durations"] and job["state"] != "failed"
+    ]
+    if lines:
+        with (Path(output_folder) / RUNTIME_HISTORY_FILENAME).open("a") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def get_runtime_features(ks_config: dict) -> np.ndarray:
+    # constant, log number of thresholds, and log thresholds relative to the defaults
+    Th_single_ch = ks_config.get("Th_single_ch", 6)
+    num_thresholds = len(Th_single_ch) if isinstance(Th_single_ch, list) else 1
+    return np.array(
+        [
+            1.0,
+            np.log(num_thresholds),
+            np.log(max(float(ks_config.get("Th_universal", 9)), 0.1) / 9),
+            np.log(max(float(ks_config.get("Th_learned", 8)), 0.1) / 8),
+        ]
+    )
+
+
+def fit_runtime_model(
+    history: list, seconds_per_sample: float = DEFAULT_SORT_SECONDS_PER_SAMPLE
+) -> np.ndarray:
+    """
+    Fits a log-linear model of the Kilosort runtime per sample and channel to the runtime
+    history, as a ridge regression towards a prior. Without history, the prior predicts
+    seconds_per_sample for the default thresholds, scaled by the number of thresholds and
+    inversely with Th_universal and Th_learned. The more jobs the history holds, the more the
+    fit follows the measured runtimes.
+
+    Parameters:
+    - history: list - The records of the runtime history, as returned by load_runtime_history.
+    - seconds_per_sample: float - The prior sorting time per sample and channel.
+
+    Returns:
+    - np.ndarray: The coefficients of the model, for predict_sort_seconds.
+    """
+    prior = np.array([np.log(seconds_per_sample)] + RUNTIME_MODEL_PRIOR_SLOPES)
+    records = [
+        record
+        for record in history
+        if record.get("sort_s", 0) > 0
+        and record["num_samples"] * record["num_chans"] > 0
+    ]
+    if not records:
+        return prior
+    X = np.array([get_runtime_features(record["KS"]) for record in records])
+    y = np.log(
+        [
+            record["sort_s"] / (record["num_samples"] * record["num_chans"])
+            for record in records
+        ]
+    )
+    regularization = RUNTIME_MODEL_PRIOR_WEIGHT * np.eye(len(prior))
+    return np.linalg.solve(X.T @ X + regularization, X.T @ y + regularization @ prior)
+
+
+def predict_sort_seconds(
+    coefficients: np.ndarray, num_samples: int, num_chans: int, ks_config: dict
+) -> float:
+    # sorting time grows linearly with the amount of data
+    return float(
+        np.exp(get_runtime_features(ks_config) @ coefficients) * num_samples * num_chans
+    )
+
+
+def get_makespan(durations: list, n_jobs: int) -> float:
+    """
+    Returns the time until all jobs are done, if they are started in the given order by
+    n_jobs parallel workers, each starting the next job as soon as it is free.
+    """
+    import heapq
+
+    worker_free_times = [0.0] * max(1, min(n_jobs, len(durations)))
+    for duration in durations:
+        heapq.heappush(worker_free_times, heapq.heappop(worker_free_times) + duration)
+    return max(worker_free_times, default=0.0)
+
+
+def predict_job_sort_seconds(
+    output_folder: Union[Path, str],
+    recording: si.BaseRecording,
+    ks_config: dict,
+    job_params: list,
+) -> tuple:
+    """
+    Predicts the sorting time of each job of a sweep from its swept Kilosort parameters, the
+    size of the recording and the runtime history of the output folder.
+
+    Returns:
+    - tuple: The predicted seconds of each job, and the number of past jobs they are based on.
+    """
+    history = load_runtime_history(output_folder)
+    coefficients = fit_runtime_model(history)
+    predicted_sort_s = [
+        predict_sort_seconds(
+            coefficients,
+            recording.get_num_frames(),
+            recording.get_num_channels(),
+            {**ks_config, **params},
+        )
+        for params in job_params
+    ]
+    return predicted_sort_s, len(history)
+
+
+def get_job_order(predicted_sort_s: list) -> list:
+    # longest predicted runtime first, sorting is stable so equal predictions keep the grid order
+    return sorted(range(len(predicted_sort_s)), key=lambda wid: -predicted_sort_s[wid])
+
+
+def report_runtime_predictions(jobs: list, sort_seconds: float, n_jobs: int):
+    """
+    Prints how long sorting took compared to the total sorting time of the jobs divided by
+    the number of parallel jobs, and how well their runtimes were predicted.
+    """
+    sorted_jobs = [
+        job
+        for job in jobs
+        if "sorting" in job["durations"] and job.get("predicted_sort_s")
+    ]
+    if not sorted_jobs:
+        return
+    actual = np.array([job["durations"]["sorting"] for job in sorted_jobs])
+    predicted = np.array([job["predicted_sort_s"] for job in sorted_jobs])
+    relative_errors = np.abs(predicted - actual) / np.maximum(actual, 1e-9)
+    print(
+        f"Sorting took {sort_seconds / 60:.1f} min for {np.sum(actual) / 60:.1f} min of jobs, "
+        f"{np.sum(actual) / n_jobs / 60:.1f} min if perfectly balanced over {n_jobs} parallel jobs. "
+        f"Predicted job runtimes totaled {np.sum(predicted) / 60:.1f} min, with a median error of "
+        f"{np.median(relative_errors):.0%} per job."
+    )
+
+
+def plan_sorting(full_config: dict, recording: si.BaseRecording) -> dict:
+    """
+    Estimates the jobs, runtime, peak memory and bytes written of sorting with the current
+    configuration, without reading any samples or writing any files. Only the recording metadata
+    is inspected, and the estimates are calibrated by the status file of the previous run and the
+    runtime history in the output folder if they exist.
+
+    Parameters:
+    - full_config: dict - The configuration dictionary.
+    - recording: si.BaseRecording - The recording as returned by load_ephys_data.
+
+    Returns:
+    - dict: The estimated totals, also printed together with the job matrix of each group.
+    """
+    output_folder = Path(
+        full_config["Sorting"]["output_folder"] or full_config["Data"]["session_folder"]
+    ).expanduser()
+    calibration = load_runtime_calibration(output_folder)
+    if calibration is None:
+        print("No previous runs found in the output folder, using default throughput.")
+        calibration = {
+            "sort_seconds_per_sample": DEFAULT_SORT_SECONDS_PER_SAMPLE,
+            "extract_seconds_per_sample": DEFAULT_EXTRACT_SECONDS_PER_SAMPLE,
+            "num_units": DEFAULT_NUM_UNITS,
+        }
+    else:
+        print(
+            f"Calibrated throughput from {calibration['num_jobs']} jobs of the previous run in {output_folder}."
+        )
+    # sorting time of each job from its parameters, fitted to past jobs if there are any
+    runtime_history = load_runtime_history(output_folder)
+    runtime_coefficients = fit_runtime_model(
+        runtime_history, calibration["sort_seconds_per_sample"]
+    )
+    if runtime_history:
+        print(
+            f"Predicting sorting times from {len(runtime_history)} past jobs in {output_folder}."
+        )
+    memory_budget = get_memory_budget(full_config)
+    sampling_frequency = recording.get_sampling_frequency()
+    worker_params_list = get_worker_params_grid(full_config)
+
+    # frames which will be sorted, after selecting recordings and the time range
+    if full_config["Data"]["emg_recordings"][0] == "all":
+        emg_recordings_to_use = np.arange(recording.get_num_segments())
+    else:
+        emg_recordings_to_use = np.array(full_config["Data"]["emg_recordings"])
+    num_raw_frames = sum(
+        recording.get_num_frames(segment_index=int(i)) for i in emg_recordings_to_use
+    )
+    time_range = full_config["Data"]["time_range"]
+    if full_config["Data"]["time_windows"]:
+        epochs = get_time_window_epochs(
+            full_config["Data"],
+            [
+                recording.get_num_frames(segment_index=int(i))
+                for i in emg_recordings_to_use
+            ],
+            sampling_frequency,
+        )
+        num_frames = int(np.sum(epochs[:, 2] - epochs[:, 1]))
+        print(
+            f"{len(epochs)} epochs selected by time_windows, {num_frames / num_raw_frames:.1%} of the data."
+        )
+    elif time_range[0] == 0 and time_range[1] == 0:
+        num_frames = num_raw_frames
+    else:
+        num_frames = int(round((time_range[1] - time_range[0]) * sampling_frequency))
+    resampling = None
+    resample_rate = get_resample_rate(full_config["Data"], sampling_frequency)
+    if resample_rate is not None:
+        # every stage after filtering handles the resampled data
+        resampling = {
+            "native_sampling_frequency": sampling_frequency,
+            "sampling_frequency": resample_rate,
+        }
+        num_frames = int(round(num_frames * resample_rate / sampling_frequency))
+        print(f"Resampling from {sampling_frequency} Hz to {resample_rate} Hz.")
+        sampling_frequency = resample_rate
+    bytes_written = 0
+    if len(emg_recordings_to_use) > 1 and not full_config["Data"]["time_windows"]:
+        # concatenated raw data of all channels
+        bytes_written += (
+            num_raw_frames
+            * recording.get_num_channels()
+            * np.dtype(recording.get_dtype()).itemsize
+        )
+
+    total_cpu_seconds, total_wall_seconds, peak_memory = 0, 0, 0
+    for iChanGroup, emg_chan_list in enumerate(full_config["Group"]["emg_chan_list"]):
+        if emg_chan_list[0] == "all":
+            channel_ids = recording.get_channel_ids()
+            if full_config["Data"]["dataset_type"] == "openephys":
+                channel_ids = [ch for ch in channel_ids if "ADC" not in str(ch)]
+            num_chans = len(channel_ids)
+        else:
+            num_chans = len(emg_chan_list)
+        if full_config["Sorting"]["window_duration"] > 0:
+            windows = get_time_windows(
+                num_frames,
+                sampling_frequency,
+                full_config["Sorting"]["window_duration"],
+                full_config["Sorting"]["window_overlap"],
+            )
+            job_frames = [end_frame - start_frame for start_frame, end_frame in windows]
+            job_params = [{}] * len(windows)
+            num_results = 1
+        else:
+            job_frames = [num_frames] * len(worker_params_list)
+            job_params = worker_params_list
+            num_results = len(worker_params_list)
+
+        print(
+            "------------------------------------------------------------\n"
+            f" Group {iChanGroup}: up to {num_chans} channels, {num_frames / sampling_frequency:.1f} s "
+            f"({num_frames} samples at {sampling_frequency} Hz), {len(job_frames)} jobs\n"
+            "------------------------------------------------------------"
+        )
+        zfill_amount = len(str(len(job_frames)))
+        job_memory = []
+        sort_seconds = []
+        for wid, (these_frames, worker_params) in enumerate(
+            zip(job_frames, job_params)
+        ):
+            ks_config = {**full_config["KS"], **worker_params}
+            if resampling is not None:
+                adjust_KS_params_for_resampling(ks_config, resampling)
+            this_job_memory = estimate_KS_job_resources(
+                these_frames / sampling_frequency, num_chans, ks_config
+            )
+            job_memory.append(this_job_memory)
+            sort_seconds.append(
+                predict_sort_seconds(
+                    runtime_coefficients, these_frames, num_chans, ks_config
+                )
+            )
+            params_str = ", ".join(f"{key}={val}" for key, val in worker_params.items())
+            print(
+                f" wkr{str(wid).zfill(zfill_amount)}  {params_str or 'KS section settings'}  |  "
+                f"sort ~{sort_seconds[-1] / 60:.1f} min, ~{this_job_memory / 1024**3:.2f} GB"
+            )
+
+        n_jobs = get_safe_concurrency(
+            full_config["Sorting"]["num_KS_jobs"],
+            max(job_memory),
+            memory_budget,
+            task_name="Kilosort jobs",
+        )
+        extract_memory = estimate_extraction_resources(
+            num_chans,
+            sampling_frequency,
+            int(calibration["num_units"]),
+            ks_config["nt"],
+        )
+        num_concurrent_tasks = get_safe_concurrency(
+            min(full_config["SI"]["max_concurrent_tasks"], num_results),
+            extract_memory,
+            memory_budget,
+            task_name="extraction tasks",
+        )
+        extract_seconds = (
+            calibration["extract_seconds_per_sample"] * num_frames * num_chans
+        )
+        total_cpu_seconds += sum(sort_seconds) + num_results * extract_seconds
+        # jobs are started longest first, and each result is extracted while the next jobs are
+        # sorted, so only the last extraction adds to the sorting time unless extraction is slower
+        total_wall_seconds += max(
+            get_makespan(
+                [sort_seconds[wid] for wid in get_job_order(sort_seconds)], n_jobs
+            )
+            + extract_seconds,
+            np.ceil(num_results / num_concurrent_tasks) * extract_seconds,
+        )
+        peak_memory = max(
+            peak_memory,
+            n_jobs * max(job_memory),
+            num_concurrent_tasks * extract_memory,
+        )
+
+        # float32 data: cached preprocessed data, copies written for Kilosort
+        # when not cached, and recording.dat of each result
+        group_bytes = num_frames * num_chans * 4
+        if full_config["SI"]["cache_preprocessed_data"]:
+            bytes_written += group_bytes
+        else:
+            bytes_written += len(job_frames) * group_bytes
+        bytes_written += num_results * group_bytes
+        # Kilosort outputs (spike times, clusters, templates, amplitudes, features)
+        expected_spikes = (
+            num_frames / sampling_frequency * ASSUMED_SPIKE_RATE * len(job_frames)
+        )
+        bytes_written += int(expected_spikes * 32)
+
+    def fmt_seconds(seconds):
+        return strfdelta(
+            timedelta(seconds=int(seconds)), "{days}d {hours}h {minutes:02d}m"
+        )
+
+    plan = {
+        "cpu_seconds": total_cpu_seconds,
+        "wall_seconds": total_wall_seconds,
+        "peak_memory_bytes": peak_memory,
+        "bytes_written": bytes_written,
+    }
+    print(
+        "------------------------------------------------------------\n"
+        " Plan summary (estimates):\n"
+        f" Total job time: {fmt_seconds(total_cpu_seconds)}\n"
+        f" Wall time: {fmt_seconds(total_wall_seconds)}\n"
+        f" Peak memory: {peak_memory / 1024**3:.1f} GB (budget {memory_budget / 1024**3:.1f} GB)\n"
+        f" Data written: {bytes_written / 1024**3:.1f} GB to {output_folder}\n"
+        "------------------------------------------------------------"
+    )
+    return plan
+
+
+def fill_config_defaults(full_config: dict, template_config: dict) -> list:
+    """
+    Adds the settings of the template which are missing from a configuration, e.g., options added
+    by later EMUsort versions to an older configuration file. Only missing sections and the
+    missing settings of each section are filled in, so mappings chosen by the user, such as
+    KS_params_to_sweep, are kept as they are.
+
+    Returns:
+    - list: The names of the filled in sections and settings, as "Section.setting".
+    """
+    filled = []
+    for section, template_section in template_config.items():
+        if section not in full_config:
+            full_config[section] = deepcopy(template_section)
+            filled.append(section)
+        elif isinstance(template_section, dict) and isinstance(
+            full_config[section], dict
+        ):
+            for key, value in template_section.items():
+                if key not in full_config[section]:
+                    full_config[section][key] = deepcopy(value)
+                    filled.append(f"{section}.{key}")
+    return filled
+
+
+def load_config(
+    session_folder: Union[Path, str],
+    ks4: bool = False,
+    reset: bool = False,
+    edit: bool = False,
+    set_job_kwargs: bool = True,
+) -> dict:
+    """
+    Loads the configuration file of a session folder, creating it from the default template if
+    it does not exist, and prepares it for the other pipeline functions. Settings missing from
+    the file, e.g., because it was created by an older EMUsort version, take their value from the
+    default template.
+
+    Parameters:
+    - session_folder: Union[Path, str] - The path to the session folder.
+    - ks4: bool - Whether to use ks4_config.yaml to emulate Kilosort4 instead of emu_config.yaml.
+    - reset: bool - Whether to reset the configuration file to the default template.
+    - edit: bool - Whether to open the configuration file in the nano text editor first.
+    - set_job_kwargs: bool - Whether to set the global spikeinterface job kwargs (chunk_duration)
+      of the SI section, which applies to the whole process.
+
+    Returns:
+    - dict: The configuration dictionary.
+    """
+    # Set repo folder path
+    repo_folder_path = Path(__file__).parent.parent.parent
+    session_folder = Path(session_folder).expanduser().resolve()
+
+    # Generate, reset, or load config file
+    if ks4:
+        config_file_path = session_folder.joinpath("ks4_config.yaml")
+    else:
+        config_file_path = session_folder.joinpath("emu_config.yaml")
+    # if the config doesn't exist or user wants to reset, load the config template
+    if not config_file_path.exists() or reset:
+        print(f"Generating config file from default template: \n{config_file_path}\n")
+        create_config(repo_folder_path, session_folder, ks4=ks4)
+
+    # open text editor to validate or edit the configuration file if desired
+    if edit:
+        subprocess.run(["nano", config_file_path])
+
+    # Load the configuration file
+    yaml = YAML()
+    full_config = yaml.load(config_file_path)
+    filled = fill_config_defaults(
+        full_config,
+        yaml.load(
+            repo_folder_path
+            / "configs"
+            / f"config_template_{'ks4' if ks4 else 'emu'}.yaml"
+        ),
+    )
+    if filled:
+        print(
+            f"Using default values for settings missing from {config_file_path}: {', '.join(filled)}"
+        )
+
+    # Prepare common configuration file, accounting for section titles, Data, Sorting, and Group
+    full_config["Data"].update(
+        {
+            "repo_folder": repo_folder_path,
+            "session_folder": session_folder,
+        }
+    )
+    full_config["sort_type"] = "ks4" if ks4 else "emu"
+
+    if set_job_kwargs:
+        si.set_global_job_kwargs(
+            n_jobs=1,
+            chunk_duration=full_config["SI"]["chunk_duration"],
+        )
+
+    # below are checks of the configuration file to avoid downstream errors
+    assert full_config["KS"]["nblocks"] == False, "nblocks must be False for EMUsort"
+    assert (
+        full_config["KS"]["do_correction"] == False
+    ), "do_correction must be False for EMUsort"
+    # assert full_config["KS"]["do_CAR"] == False, "do_CAR must be False for EMUsort"
+    return full_config
+
+
+def stop_prefetch(recording: si.BaseRecording, label: str):
+    # stops reading ahead the raw data once the preprocessed data is saved, with its stats
+    if isinstance(recording, PrefetchRecording):
+        recording.stop_prefetch()
+        stats = recording.get_prefetch_stats()
+        print(
+            f"Read-ahead of {label}: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['unused']} of {stats['prefetched']} prefetched chunks unused "
+            f"(buffer of up to {stats['buffer_bytes'] / 1024**2:.0f} MB per segment)"
+        )
+
+
+def prepare_group_recording(
+    recording: si.BaseRecording, full_config: dict, iChanGroup: int
+) -> si.BaseRecording:
+    """
+    Preprocesses the recording of a channel group, caches it if cache_preprocessed_data is set,
+    and computes its channel noise levels once for all jobs of the group.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording as returned by load_ephys_data.
+    - full_config: dict - The configuration dictionary.
+    - iChanGroup: int - The index of the channel group.
+
+    Returns:
+    - si.BaseRecording: The preprocessed recording of the channel group.
+    """
+    preproc_recording = preprocess_ephys_data(recording, full_config, iChanGroup)
+    # filter once per group, so each sorting job reads the same preprocessed data
+    if full_config["SI"]["cache_preprocessed_data"]:
+        preproc_recording = cache_preprocessed_recording(
+            preproc_recording, full_config, iChanGroup
+        )
+        stop_prefetch(recording, f"group {iChanGroup}")
+        group_folder = (
+            Path(full_config["Data"]["session_folder"])
+            / "preprocessed_data"
+            / f"g{iChanGroup}"
+        )
+        load_group_noise_levels(preproc_recording, group_folder / NOISE_LEVELS_FILENAME)
+        if full_config["SI"]["quantize_recording_dat"]:
+            load_group_quantization_params(
+                preproc_recording, group_folder / QUANTIZATION_FILENAME
+            )
+    else:
+        # share the filtered chunks between the jobs of the group, which each read all data
+        if full_config["SI"]["chunk_cache_GB"]:
+            preproc_recording = ChunkCacheRecording(
+                preproc_recording,
+                max_bytes=int(full_config["SI"]["chunk_cache_GB"] * 1024**3),
+            )
+        load_group_noise_levels(preproc_recording)
+        if full_config["SI"]["quantize_recording_dat"]:
+            load_group_quantization_params(preproc_recording)
+    return preproc_recording
+
+
+def prepare_group_recordings(recording: si.BaseRecording, full_config: dict) -> list:
+    """
+    Preprocesses all channel groups and saves their preprocessed data in a single pass over the
+    raw data. The groups are saved in parallel threads which read the raw data through one
+    fan-out, so each raw chunk is read once with all channels and split between the groups,
+    instead of once per group. Groups whose preprocessed data is already cached are loaded.
+
+    Parameters:
+    - recording: si.BaseRecording - The recording as returned by load_ephys_data.
+    - full_config: dict - The configuration dictionary, with cache_preprocessed_data set.
+
+    Returns:
+    - list: The preprocessed recording of each channel group.
+    """
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+
+    num_groups = len(full_config["Group"]["emg_chan_list"])
+    fanout_name = uuid.uuid4().hex
+    # bad channels are detected group by group, with reads passing through the fan-out
+    lazy_recordings = [
+        preprocess_ephys_data(
+            recording, full_config, iChanGroup, fanout_name=fanout_name
+        )
+        for iChanGroup in range(num_groups)
+    ]
+    fanout = get_chunk_fanout(fanout_name)
+    fanout.set_consumers(range(num_groups))
+
+    def save_group(iChanGroup):
+        try:
+            return cache_preprocessed_recording(
+                lazy_recordings[iChanGroup], full_config, iChanGroup
+            )
+        finally:
+            fanout.remove_consumer(iChanGroup)
 
-    # get channel noise levels
-    try:
-        emg_chan_noise_levels = si.get_noise_levels(
-            we.recording, return_scaled=True, method="mad"
-        )
-    # handle the error for recording types without scaling information (such as binary recordings)
-    except ValueError:
-        emg_chan_noise_levels = si.get_noise_levels(
-            we.recording, return_scaled=False, method="mad"
+    print(f"Preprocessing {num_groups} channel groups in one pass over the raw data...")
+    with ThreadPoolExecutor(max_workers=num_groups) as executor:
+        preproc_recordings = list(executor.map(save_group, range(num_groups)))
+    stats = fanout.get_stats()
+    print(
+        f"Read {stats['reads']} raw chunks for all groups, {stats['shared']} reads were shared between groups."
+    )
+    stop_prefetch(recording, f"{num_groups} groups")
+
+    for iChanGroup, preproc_recording in enumerate(preproc_recordings):
+        group_folder = (
+            Path(full_config["Data"]["session_folder"])
+            / "preprocessed_data"
+            / f"g{iChanGroup}"
         )
+        load_group_noise_levels(preproc_recording, group_folder / NOISE_LEVELS_FILENAME)
+        if full_config["SI"]["quantize_recording_dat"]:
+            load_group_quantization_params(
+                preproc_recording, group_folder / QUANTIZATION_FILENAME
+            )
+    return preproc_recordings
 
-    this_config["emg_chan_noise"] = emg_chan_noise_levels.tolist()
-    # add Results section to this_config
-    this_config["Results"] = {}
-    this_config["Results"]["snr_scores"] = snr_scores.tolist()
-    this_config["Results"][
-        "firing_rate_validity_scores"
-    ] = firing_rate_validity_scores.tolist()
-    this_config["Results"]["type_I_scores"] = type_I_scores.tolist()
-    this_config["Results"]["type_II_scores"] = type_II_scores.tolist()
-    this_config["Results"]["emusort_scores"] = emusort_scores.tolist()
-    print(f"Worker {wid} exporting to Phy format...")
 
-    # Export to Phy format asynchronously
-    # await asyncio.to_thread(
-    #     export_to_phy,
-    #     we,
-    #     output_folder=phy_folder,
-    #     compute_pc_features=False,
-    #     copy_binary=True,
-    #     use_relative_path=True,
-    #     verbose=False,
-    # )
-    sorter_output = sorted_folder / "sorter_output"
-    movetree(sorter_output, sorted_folder)
-    shutil.rmtree(sorter_output, ignore_errors=True)
+def sort_group(
+    full_config: dict,
+    preproc_recording: si.BaseRecording,
+    iChanGroup: int,
+    clear_queue: bool = False,
+) -> list:
+    """
+    Runs the sorting jobs of a channel group (a single sort, a parameter sweep, or windowed
+    sorting), and extracts, scores and saves their results.
 
-    await asyncio.to_thread(
-        write_rec_and_params,
-        we,
-        sorted_folder,
-        this_sorting,
-        this_config,
-        use_relative_path=True,
-    )
+    Parameters:
+    - full_config: dict - The configuration dictionary, with a resolved output folder.
+    - preproc_recording: si.BaseRecording - The preprocessed recording of the channel group.
+    - iChanGroup: int - The index of the channel group.
+    - clear_queue: bool - Whether to clear the job queue even if workers are running its jobs.
 
-    print(
-        f"Worker {wid} finished exporting to Phy format, consolidating files into final folder..."
+    Returns:
+    - list: The result of each sorting job, as returned by extract_sorting_result, or an empty
+      list if the jobs were written to the job queue.
+    """
+    grp_zfill_amount = len(str(len(full_config["Group"]["emg_chan_list"])))
+    this_group_sorted_folder = (
+        Path(full_config["Sorting"]["output_folder"])
+        / f'sorted_g{str(iChanGroup).zfill(grp_zfill_amount)}_{Path(full_config["Data"]["session_folder"]).name}'
     )
+    print(f"Recording information: {preproc_recording}")
+
+    worker_params_grid = get_worker_params_grid(full_config)
+    total_KS_jobs = len(worker_params_grid)
+
+    # ensure proper configuration for parallel jobs
+    do_windowed_sort = full_config["Sorting"]["window_duration"] > 0
+    if do_windowed_sort:
+        assert (
+            full_config["Sorting"]["do_KS_param_sweep"] == 0
+        ), "Windowed sorting cannot be combined with a parameter sweep. Set window_duration to 0 if do_KS_param_sweep is True."
+    if full_config["Sorting"]["num_KS_jobs"] > 1:
+        assert (
+            full_config["Sorting"]["do_KS_param_sweep"] == 1 or do_windowed_sort
+        ), "Parallel jobs can only be used when do_KS_param_sweep is set to True or window_duration is above 0. Set num_KS_jobs to 1 otherwise."
+
+    # jobs and their config files are only created when they are scheduled
+    def make_job(wid):
+        return make_sorting_job(
+            wid,
+            worker_params_grid[wid],
+            full_config,
+            preproc_recording,
+            this_group_sorted_folder,
+            full_config["sort_type"],
+        )
 
-    # Create timestamp with microsecond precision to prevent duplicate folder names
-    time_stamp_us = datetime.now().strftime("%Y%m%d_%H%M%S%f")
+    assert (
+        full_config["SI"]["scoring_method"] in SCORING_METHODS
+    ), f"scoring_method must be one of {SCORING_METHODS}."
+
+    if full_config["Sorting"]["engine"] == "queue":
+        assert (
+            not do_windowed_sort
+        ), "Windowed sorting cannot be run with the 'queue' engine. Set window_duration to 0 or engine to 'joblib'."
+        assert full_config["SI"][
+            "cache_preprocessed_data"
+        ], "The 'queue' engine requires cache_preprocessed_data to be True, so workers can load the preprocessed data."
+        enqueue_sorting_jobs(
+            get_job_queue_folder(full_config),
+            full_config,
+            iChanGroup,
+            Path(full_config["Data"]["session_folder"])
+            / "preprocessed_data"
+            / f"g{iChanGroup}"
+            / "recording",
+            this_group_sorted_folder,
+            total_KS_jobs,
+            full_config["sort_type"],
+            # workers claim the longest jobs first, as in run_KS_sorting
+            job_order=get_job_order(
+                predict_job_sort_seconds(
+                    full_config["Sorting"]["output_folder"],
+                    preproc_recording,
+                    full_config["KS"],
+                    worker_params_grid,
+                )[0]
+            ),
+            clear_queue=clear_queue,
+        )
+        return []
+
+    print("Starting sorting jobs...")
+    if do_windowed_sort:
+        windows = get_time_windows(
+            preproc_recording.get_num_frames(),
+            preproc_recording.get_sampling_frequency(),
+            full_config["Sorting"]["window_duration"],
+            full_config["Sorting"]["window_overlap"],
+        )
+        results = run_windowed_KS_sorting(*make_job(0), windows)
+    else:
+        results = run_KS_sorting(
+            total_KS_jobs, make_job, full_config, job_params=worker_params_grid
+        )
 
-    # build params_suffix as a string without trailing underscore
-    if this_config["Sorting"]["do_KS_param_sweep"] == 1:
-        param_strings = [
-            f"P{pid}_{this_config['KS'][param_key]}"
-            for pid, param_key in enumerate(
-                this_config["Sorting"]["KS_params_to_sweep"].keys()
-            )
-        ]
-        params_suffix = "_" + "_".join(param_strings) if param_strings else ""
+    if isinstance(preproc_recording, ChunkCacheRecording):
+        stats = preproc_recording.get_cache_stats()
+        print(
+            f"Chunk cache of group {iChanGroup}: {stats['hits']} hits ({stats['hit_bytes'] / 1024**3:.2f} GB "
+            f"not recomputed), {stats['misses']} misses, {stats['evictions']} evictions"
+        )
+    return results
+
+
+def run_sort(
+    full_config: dict,
+    recording: Union[si.BaseRecording, None] = None,
+    clear_queue: bool = False,
+) -> list:
+    """
+    Preprocesses and sorts every channel group of a session, like "emusort --sort". An already
+    loaded recording can be passed to avoid loading the data again.
+
+    Parameters:
+    - full_config: dict - The configuration dictionary, as returned by load_config.
+    - recording: Union[si.BaseRecording, None] - The recording as returned by load_ephys_data.
+    - clear_queue: bool - Whether to clear the job queue of the 'queue' engine even if workers
+      are running its jobs.
+
+    Returns:
+    - list: The result of each sorting job of all groups, as returned by extract_sorting_result.
+    """
+    # load data from the session folder
+    if recording is None:
+        recording = load_ephys_data(full_config)
+    # Setting GPU ordering for parallel jobs to match nvidia-smi and nvitop
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    # ensure that the output folder is set to the session folder if not specified
+    if full_config["Sorting"]["output_folder"] is None:
+        full_config["Sorting"]["output_folder"] = Path(
+            full_config["Data"]["session_folder"]
+        )
     else:
-        params_suffix = ""
+        # ensure that the output folder is a valid path
+        full_config["Sorting"]["output_folder"] = (
+            Path(full_config["Sorting"]["output_folder"]).expanduser().resolve()
+        )
+        full_config["Sorting"]["output_folder"].mkdir(parents=True, exist_ok=True)
 
-    sorted_folder = this_config["Sorting"]["sorted_folder"]
-    base_name = Path(sorted_folder).name.split("_wkr", 1)[0]
+    num_groups = len(full_config["Group"]["emg_chan_list"])
+    # read the raw data once for all groups when their preprocessed data is saved
+    if full_config["SI"]["cache_preprocessed_data"] and num_groups > 1:
+        preproc_recordings = prepare_group_recordings(recording, full_config)
+    else:
+        preproc_recordings = None
 
-    # construct filename string (assumes "sorted_" always present)
-    name = f"{base_name}{params_suffix}"
-    name = name.replace("sorted_", f"sorted_{time_stamp_us}_", 1)
+    results = []
+    # loop through each group of EMG channels to sort independently
+    for iChanGroup in range(num_groups):
+        if preproc_recordings is not None:
+            preproc_recording = preproc_recordings[iChanGroup]
+        else:
+            preproc_recording = prepare_group_recording(
+                recording, full_config, iChanGroup
+            )
+        results += sort_group(
+            full_config, preproc_recording, iChanGroup, clear_queue=clear_queue
+        )
+    return results
 
-    if len(this_config["Group"]["emg_chan_list"]) == 1:
-        name = name.replace("_g0", "")
 
-    # remove unwanted chars and trailing commas/underscores
-    name = "".join(char for char in name if char not in " ()[]").rstrip(",_")
+def score_sorting(
+    recording: si.BaseRecording,
+    sorting: si.BaseSorting,
+    nt: int,
+    wid=0,
+    sorter_output: Union[Path, str, None] = None,
+) -> dict:
+    """
+    Computes the unit metrics and EMUsort scores of a sorting of an already loaded recording,
+    without writing any files.
 
-    # append score and optional tag
-    name = f"{name}_SCORE_{emusort_score:.3f}"
-    if this_config["sort_type"] == "ks4":
-        name += "_KS4"
+    Parameters:
+    - recording: si.BaseRecording - The (preprocessed) recording the sorting was computed on.
+    - sorting: si.BaseSorting - The sorting.
+    - nt: int - The number of samples of each waveform, as the nt Kilosort parameter.
+    - wid: int - The worker ID used in printed messages.
+    - sorter_output: Union[Path, str, None] - If given, the folder with the Kilosort outputs of
+      the sorting, which the metrics are computed from instead of extracted waveforms.
 
-    final_path = Path(sorted_folder).parent / name
+    Returns:
+    - dict: The "unit_metrics", the "emusort_scores" of each unit, the overall "emusort_score"
+      and the printed "report".
+    """
+    if sorter_output is not None:
+        unit_metrics = compute_template_unit_metrics(sorting, sorter_output, recording)
+    else:
+        ms_buffer = nt / recording.get_sampling_frequency() * 1000 / 2
+        we = extract_waveforms_in_memory(recording, sorting, ms_buffer)
+        unit_metrics = compute_unit_metrics(we)
+    unit_metrics["fingerprints"] = get_unit_fingerprints(sorting)
+    _, _, _, _, emusort_scores, emusort_score, report = get_emusort_scores(
+        unit_metrics, wid
+    )
+    return {
+        "unit_metrics": unit_metrics,
+        "emusort_scores": emusort_scores,
+        "emusort_score": emusort_score,
+        "report": report,
+    }
 
-    # move and save
-    shutil.move(sorted_folder, final_path)
-    dump_yaml(final_path / f'{this_config["sort_type"]}_config.yaml', this_config)
-    np.save(final_path / "emg_chans_used.npy", this_config["emg_chans_used"])
 
-    phy_msg = f"\nTo view Worker {wid} result in Phy, run:\nphy template-gui {(final_path / 'params.py').as_posix()}\n"
+SERVER_MAX_CACHED_RECORDINGS = 4  # loaded sessions kept in memory by the sort server
+SERVER_MAX_FINISHED_JOBS = 100  # finished jobs kept by the sort server
 
-    return [report, phy_msg]
 
+class SortServer:
+    """
+    Local sort server which keeps Python, torch, spikeinterface and loaded recordings resident
+    between requests, so repeated sorts do not pay the startup cost of the emusort command.
 
-async def extract_concurrently(
-    sortings, job_list, these_configs, max_concurrent_tasks=5
-):
-    print("Extracting sorting results asynchronously...")
-    # Create a task for each worker job
-    tasks = []
-    for wid, sorting in enumerate(sortings):
-        task = extract_sorting_result(sorting, these_configs[wid], job_list[wid], wid)
-        tasks.append(task)
-
-    # Chunk tasks into smaller batches to avoid "too many open files" error
-    msgs = []
-    # loop = asyncio.get_event_loop()
-    # with ProcessPoolExecutor(
-    #     np.ceil(len(tasks) / max_concurrent_tasks).astype(int)
-    # ) as executor:
-    for i in range(0, len(tasks), max_concurrent_tasks):
+    Requests are JSON posted to http://127.0.0.1:<port>:
+    - POST /sort {"folder": ..., "ks4": false} sorts a session folder like "emusort --sort".
+    - POST /rescore {"folder": ..., "results": [...]} rescores result folders like "--rescore".
+    Both return a job id right away, or the finished job if "wait" is true. GET /jobs lists the
+    queued, running and the SERVER_MAX_FINISHED_JOBS most recently finished jobs, and
+    GET /jobs/<id> returns the state and results of one job.
+
+    Sorts run one at a time, in order, since they set process-wide state (the spikeinterface job
+    kwargs of their configuration and the CUDA device order) and share the GPUs. Up to
+    max_concurrent_requests rescore jobs run at once, alongside a sort, and do not change the
+    process-wide state.
+
+    Parameters:
+    - port: int - The port to listen on, on localhost only.
+    - max_concurrent_requests: int - The maximum number of rescore jobs which run at once.
+    """
+
+    def __init__(self, port: int, max_concurrent_requests: int = 1):
+        from collections import OrderedDict
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.port = port
+        self.executors = {
+            "sort": ThreadPoolExecutor(max_workers=1),
+            "rescore": ThreadPoolExecutor(max_workers=max_concurrent_requests),
+        }
+        self.jobs = OrderedDict()  # oldest first
+        self.num_submitted = 0
+        self.recordings = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+
+    def get_recording(self, full_config: dict) -> si.BaseRecording:
+        # reuse the recording of a session if it is loaded with the same Data settings
+        key = json.dumps(
+            path_to_str_recursive(dict(full_config["Data"])), sort_keys=True
+        )
+        with self._lock:
+            if key in self.recordings:
+                self.recordings.move_to_end(key)
+                return self.recordings[key]
+        recording = load_ephys_data(full_config)
+        with self._lock:
+            self.recordings[key] = recording
+            while len(self.recordings) > SERVER_MAX_CACHED_RECORDINGS:
+                _, evicted = self.recordings.popitem(last=False)
+                if isinstance(evicted, PrefetchRecording):
+                    evicted.stop_prefetch()
+        return recording
+
+    def run_job(self, job_id: str, kind: str, request: dict):
+        job = self.jobs[job_id]
+        job.update(
+            state="running", started=datetime.now().isoformat(timespec="seconds")
+        )
         try:
-            # Run the current batch concurrently
-            batch = [
-                asyncio.create_task(task)
-                for task in tasks[i : i + max_concurrent_tasks]
-            ]
-            msgs.append(await asyncio.gather(*batch))
-            # Run the current batch concurrently, submitting to ProcessPoolExecutor
-            # msgs.append(
-            #     loop.run_in_executor(
-            #         executor,
-            #         asyncio.gather,
-            #         *[tasks[j] for j in range(i, i + max_concurrent_tasks)],
-            #     )
-            # )
+            full_config = load_config(
+                request["folder"],
+                ks4=request.get("ks4", False),
+                set_job_kwargs=kind == "sort",
+            )
+            if kind == "sort":
+                results = run_sort(full_config, self.get_recording(full_config))
+                job["results"] = [
+                    {
+                        "result_folder": result["result_folder"].as_posix(),
+                        "emusort_score": float(result["emusort_score"]),
+                        "report": result["report"],
+                    }
+                    for result in results
+                ]
+            else:
+                if request.get("results"):
+                    result_folders = [Path(folder) for folder in request["results"]]
+                else:
+                    result_folders = find_result_folders(
+                        Path(
+                            full_config["Sorting"]["output_folder"]
+                            or full_config["Data"]["session_folder"]
+                        ).expanduser()
+                    )
+                rescored = rescore_result_folders(
+                    result_folders,
+                    max_workers=full_config["SI"]["max_concurrent_tasks"],
+                )
+                job["results"] = [
+                    {"result_folder": folder.as_posix(), "emusort_score": float(score)}
+                    for folder, score in rescored
+                ]
+            job["state"] = "done"
         except Exception as e:
-            raise Exception(
-                f"Error in parallel extraction of batch {i//max_concurrent_tasks + 1}/{np.ceil(len(tasks)/max_concurrent_tasks).astype(int)}, try reducing max_concurrent_tasks in 'SI' section of emu_config.yaml next time. ..."
-            ) from e
-        print(
-            "------------------------------------------------------------\n"
-            f"All tasks done for worker batch {i//max_concurrent_tasks + 1}/{np.ceil(len(tasks)/max_concurrent_tasks).astype(int)}. Yay!\n"
-            "------------------------------------------------------------\n"
-        )
-    # Flatten the list of messages
-    msgs = [msg for sublist in msgs for msg in sublist]
-    return msgs
+            job.update(state="failed", error=repr(e))
+            print(f"Server job {job_id} failed:\n{e}")
+        job["finished"] = datetime.now().isoformat(timespec="seconds")
+
+    def submit(self, kind: str, request: dict) -> str:
+        assert isinstance(request, dict), "Requests must be JSON objects"
+        assert "folder" in request, "Requests must include the session 'folder'"
+        with self._lock:
+            job_id = str(self.num_submitted)
+            self.num_submitted += 1
+            self.jobs[job_id] = {
+                "id": job_id,
+                "kind": kind,
+                "folder": request["folder"],
+                "state": "queued",
+                "submitted": datetime.now().isoformat(timespec="seconds"),
+            }
+            self.jobs[job_id]["future"] = self.executors[kind].submit(
+                self.run_job, job_id, kind, request
+            )
+            # forget the oldest finished jobs
+            finished_ids = [
+                finished_id
+                for finished_id, job in self.jobs.items()
+                if job["state"] in ("done", "failed")
+            ]
+            for finished_id in finished_ids[:-SERVER_MAX_FINISHED_JOBS]:
+                del self.jobs[finished_id]
+        return job_id
+
+    @staticmethod
+    def describe_job(job: dict) -> dict:
+        return {key: val for key, val in job.items() if key != "future"}
+
+    def list_jobs(self) -> list:
+        with self._lock:
+            return [self.describe_job(job) for job in self.jobs.values()]
+
+    def serve_forever(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_json(self, status, body):
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                job = server.jobs.get(parts[1]) if len(parts) == 2 else None
+                if parts == ["jobs"]:
+                    self.send_json(200, server.list_jobs())
+                elif parts[0] == "jobs" and job is not None:
+                    self.send_json(200, server.describe_job(job))
+                else:
+                    self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+            def do_POST(self):
+                kind = self.path.strip("/")
+                if kind not in ("sort", "rescore"):
+                    self.send_json(404, {"error": f"Unknown path {self.path}"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                    job = server.jobs[server.submit(kind, request)]
+                except (AssertionError, ValueError) as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+                # keep the job, which may be dropped from the list once finished
+                if request.get("wait"):
+                    job["future"].result()
+                    self.send_json(200, server.describe_job(job))
+                else:
+                    self.send_json(202, server.describe_job(job))
 
+            def log_message(self, format, *args):
+                pass  # requests are reported by the jobs themselves
 
-def run_KS_sorting(job_list, these_configs):
+        # only accept requests from this machine
+        httpd = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        print(f"EMUsort server listening on http://127.0.0.1:{self.port}")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down the EMUsort server...")
+        finally:
+            httpd.server_close()
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+
+
+def get_selected_result_folders(
+    args: argparse.Namespace,
+    output_folder: Path,
+    rescored: Union[list, None] = None,
+) -> list:
     """
-    Run Kilosort4 spike sorting on the specified recordings and save the results.
+    Returns the result folders selected on the command line: the folders just rescored (which
+    rescoring renames), else those given with --results, else all result folders in the output
+    folder.
 
     Parameters:
-    - job_list: list - A list of dictionaries containing the job parameters for each sorting job.
-    - these_configs: list - A list of dictionaries containing the configuration parameters for each sorting job.
+    - args: argparse.Namespace - The parsed command line arguments.
+    - output_folder: Path - The output folder of the session.
+    - rescored: Union[list, None] - The (result_folder, score) pairs of rescore_result_folders.
 
     Returns:
-    - None
-    """
-
-    ## job_list is of below structure:
-    # job_list = [
-    #     {
-    #         "sorter_name": "kilosort4",
-    #         "recording": recording_list[i],
-    #         "output_folder": these_configs[i]["Sorting"]["sorted_folder"],
-    #         **this_config["KS"],
-    #     }
-
-    # Run spike sorting
-    sortings = ss.run_sorter_jobs(
-        job_list=job_list,
-        engine="joblib",
-        engine_kwargs={"n_jobs": these_configs[0]["Sorting"]["num_KS_jobs"]},
-        return_output=True,
-    )
-
-    # Now extract and write the sorting results to each sorted_folder
-    # try:
-    #     # do this in parallel using Pool
-    #     with Pool(these_configs[0]["Sorting"]["num_KS_jobs"]) as pool:
-    #         msgs = pool.starmap(
-    #             extract_sorting_result,
-    #             zip(sortings, these_configs, job_list, range(len(sortings))),
-    #         )
-    # except OSError:
-    msgs = asyncio.run(
-        extract_concurrently(
-            sortings,
-            job_list,
-            these_configs,
-            max_concurrent_tasks=these_configs[0]["SI"]["max_concurrent_tasks"],
-        )
-    )
-    return msgs
+    - list: The paths to the result folders.
+    """
+    if rescored is not None:
+        return [new_result_folder for new_result_folder, _ in rescored]
+    if args.results:
+        return [
+            Path(result_folder).expanduser().resolve() for result_folder in args.results
+        ]
+    return find_result_folders(output_folder)
 
 
 def main():
@@ -945,8 +6586,7 @@ def main():
     parser.add_argument(
         "-f",
         "--folder",
-        help="Required parameter that provides the path to the session folder where the dataset is stored",
-        required=True,
+        help="Required parameter that provides the path to the session folder where the dataset is stored (except with --serve)",
     )
     parser.add_argument(
         "-c",
@@ -972,311 +6612,142 @@ def main():
         help="Run EMUsort emulating Kilosort4 by using the ks4_config.yaml configuration file",
     )
 
-    args = parser.parse_args()
-
-    # Set repo folder path
-    repo_folder_path = Path(__file__).parent.parent.parent
-
-    # Generate, reset, or load config file
-    if args.ks4:
-        config_file_path = (
-            Path(args.folder).expanduser().resolve().joinpath("ks4_config.yaml")
-        )
-    else:
-        config_file_path = (
-            Path(args.folder).expanduser().resolve().joinpath("emu_config.yaml")
-        )
-    # if the config doesn't exist or user wants to reset, load the config template
-    if not config_file_path.exists() or args.reset_config:
-        print(f"Generating config file from default template: \n{config_file_path}\n")
-        create_config(
-            repo_folder_path,
-            Path(args.folder).expanduser().resolve(),
-            ks4=args.ks4,
-        )
-
-    # open text editor to validate or edit the configuration file if desired
-    if args.config:
-        subprocess.run(["nano", config_file_path])
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Run sorting jobs from the job queue of the session until it is empty (see the 'queue' engine in the Sorting section). Any number of workers can run at once on machines sharing the queue folder",
+    )
+    parser.add_argument(
+        "--clear-queue",
+        action="store_true",
+        help="With --sort and the 'queue' engine, clear the jobs of the previous sort from the job queue even if workers are still running some of them",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run a local sort server on http://127.0.0.1:<port>, which keeps libraries and loaded data in memory and accepts sort and rescore requests for any session folder",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port of the sort server started with --serve (default: 8765)",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=1,
+        help="Number of rescore requests the sort server started with --serve runs at once, sort requests always run one at a time (default: 1)",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Dry run that validates the configuration and prints the jobs of each group with estimates of runtime, peak memory and disk usage, without sorting",
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help="Recompute the EMUsort scores of existing result folders without re-sorting, e.g., after curation in Phy or changes to the scoring. Rescores all sorted_### folders in the output folder, unless --results is given",
+    )
+    parser.add_argument(
+        "--export-pcs",
+        action="store_true",
+        help="Compute the principal component and template features used by Phy for existing result folders. Exports all sorted_### folders in the output folder, unless --results or --top-k is given",
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Match units between every pair of existing result folders by spike time coincidence, and report the clusters of parameter settings that give equivalent results. Compares all sorted_### folders in the output folder, unless --results is given",
+    )
+    parser.add_argument(
+        "--compare-scoring",
+        action="store_true",
+        help="Score existing result folders both from extracted waveforms and from the Kilosort outputs (see scoring_method in the SI section), and report how closely the scores agree and the time each takes. Uses all sorted_### folders in the output folder, unless --results is given",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        help="Only export the given number of result folders with the highest EMUsort scores with --export-pcs",
+    )
+    parser.add_argument(
+        "--results",
+        nargs="+",
+        help="Paths to specific result folders to use with --rescore, --export-pcs, --compare or --compare-scoring",
+    )
 
-    # Load the configuration file
-    yaml = YAML()
-    full_config = yaml.load(config_file_path)
+    args = parser.parse_args()
 
-    # Prepare common configuration file, accounting for section titles, Data, Sorting, and Group
-    full_config["Data"].update(
-        {
-            "repo_folder": repo_folder_path,
-            "session_folder": Path(args.folder).expanduser().resolve(),
-        }
-    )
+    if args.serve:
+        SortServer(args.port, args.max_requests).serve_forever()
+        return
+    if args.folder is None:
+        parser.error("the following arguments are required: --folder/-f")
 
-    si.set_global_job_kwargs(
-        n_jobs=1,
-        chunk_duration=full_config["SI"]["chunk_duration"],
+    full_config = load_config(
+        args.folder, ks4=args.ks4, reset=args.reset_config, edit=args.config
     )
 
-    # below are checks of the configuration file to avoid downstream errors
-    assert full_config["KS"]["nblocks"] == False, "nblocks must be False for EMUsort"
-    assert (
-        full_config["KS"]["do_correction"] == False
-    ), "do_correction must be False for EMUsort"
-    # assert full_config["KS"]["do_CAR"] == False, "do_CAR must be False for EMUsort"
+    # Estimate the cost of sorting before committing to it
+    if args.plan:
+        plan_sorting(full_config, load_ephys_data(full_config))
 
     # EMG Preprocessing and Spike Sorting
     if args.sort:
 
-        # load data from the session folder
-        recording = load_ephys_data(full_config)
-        # Setting GPU ordering for parallel jobs to match nvidia-smi and nvitop
-        os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-        # ensure that the output folder is set to the session folder if not specified
-        if full_config["Sorting"]["output_folder"] is None:
-            full_config["Sorting"]["output_folder"] = Path(
-                full_config["Data"]["session_folder"]
-            )
-        else:
-            # ensure that the output folder is a valid path
-            full_config["Sorting"]["output_folder"] = (
-                Path(full_config["Sorting"]["output_folder"]).expanduser().resolve()
-            )
-            full_config["Sorting"]["output_folder"].mkdir(parents=True, exist_ok=True)
-
-        # loop through each group of EMG channels to sort independently
-        for iChanGroup, emg_chan_list in enumerate(
-            full_config["Group"]["emg_chan_list"]
-        ):
-            preproc_recording = preprocess_ephys_data(
-                recording, full_config, iChanGroup
-            )
-            grp_zfill_amount = len(str(len(full_config["Group"]["emg_chan_list"])))
-            this_group_sorted_folder = (
-                Path(full_config["Sorting"]["output_folder"])
-                / f'sorted_g{str(iChanGroup).zfill(grp_zfill_amount)}_{Path(full_config["Data"]["session_folder"]).name}'
-            )
-            print(f"Recording information: {preproc_recording}")
-
-            ## do not overwrite KS section unless param sweep enabled
-            if full_config["Sorting"]["do_KS_param_sweep"] == 0:
-                total_KS_jobs = 1
-            else:
-                # input verification
-                assert (
-                    full_config["Sorting"]["KS_params_to_sweep"] is not None
-                ), "You must provide at least 1 parameter under KS_params_to_sweep if do_KS_param_sweep is True"
-
-                for key, val in full_config["Sorting"]["KS_params_to_sweep"].items():
-                    try:
-                        assert key in [
-                            k for k, _ in full_config["KS"].items()
-                        ], f"Keys in KS_params_to_sweep must be a parameter in the KS section, but {str(key)} was not found"
-                        assert isinstance(
-                            val, list
-                        ), f"The values of each key in KS_params_to_sweep must be a list, but the value for {str(key)} was type {type(val)}. Try adding brackets"
-                    except AssertionError as e:
-                        raise AssertionError(
-                            "Elements of KS_params_to_sweep must be key-value pairs, with valid keys from the KS section and a list of values for each key."
-                        ) from e
-                # passed verification
-                KS_params_to_sweep = deepcopy(
-                    full_config["Sorting"]["KS_params_to_sweep"]
-                )
-                # keep track of original key order before separating out the linked parameters
-                KS_params_to_sweep_orig_keys = list(KS_params_to_sweep.keys())
-
-                if full_config["Sorting"]["linked_params_for_sweep"] is None:
-                    linked_param_groups_list = []
-                else:
-                    # input verification
-                    try:
-                        for lst in full_config["Sorting"]["linked_params_for_sweep"]:
-                            assert isinstance(lst, list)
-                            for kid, key in enumerate(lst):
-                                assert isinstance(
-                                    key, str
-                                ), f"Elements in each list of linked_params_for_sweep must be strings, but {str(key)} was type {type(key)}"
-                                assert key in [
-                                    k for k, _ in full_config["KS"].items()
-                                ], f"Elements in each list of linked_params_for_sweep must be a parameter in the KS section, but {key} was not."
-                                length_of_this_linked_param = len(
-                                    KS_params_to_sweep[key]
-                                )
-                                if kid > 0:
-                                    assert (
-                                        length_of_previous_linked_param
-                                        == length_of_this_linked_param
-                                    ), f"The length of linked parameters must be equal, but lengths {length_of_previous_linked_param} and {length_of_this_linked_param} were found."
-                                length_of_previous_linked_param = (
-                                    length_of_this_linked_param
-                                )
-                    except AssertionError as e:
-                        raise AssertionError(
-                            "Elements of linked_params_for_sweep must be lists of strings (parameter keys from the KS section). "
-                            "Linked parameters must all be the same length."
-                        ) from e
-                    # passed verification
-                    linked_param_groups_list = full_config["Sorting"][
-                        "linked_params_for_sweep"
-                    ]
+        results = run_sort(full_config, clear_queue=args.clear_queue)
 
-                # set linked parameters as separate entries with a new parameter group key
-                # take the keys in the order specified in KS_params_to_sweep to preserve expected order
-                for gid, linked_params_keys in enumerate(linked_param_groups_list):
-                    KS_params_to_sweep[f"gp{gid}"] = [
-                        # list(gval) for gval in zip(*(params[k] for k in linked_params_list))
-                        list(gval)
-                        for gval in zip(
-                            *(  # unpack values from dictionaries so they can be zipped
-                                KS_params_to_sweep[
-                                    k
-                                ]  # make sure order is determined by KS_params_to_sweep
-                                for k in [
-                                    key
-                                    for key in KS_params_to_sweep_orig_keys
-                                    if str(key) in linked_params_keys
-                                ]
-                            )
-                        )
-                    ]
-                    # get rid of the individual keys that are in separate groups now
-                    for key in linked_params_keys:
-                        del KS_params_to_sweep[key]
-                worker_params_list = list(
-                    ParameterGrid(KS_params_to_sweep)
-                )  # get iterator of all possible param combinations
-                # now replace the gp# keys in each dictionary with the corresponding key-value pairs
-                for wid, worker_params in enumerate(worker_params_list):
-                    for gid, linked_params_keys in enumerate(linked_param_groups_list):
-                        # make sure order is determined by KS_params_to_sweep
-                        for key, param_key in enumerate(
-                            [
-                                key
-                                for key in KS_params_to_sweep_orig_keys
-                                if str(key) in linked_params_keys
-                            ]
-                        ):
-                            worker_params[param_key] = worker_params[f"gp{gid}"][key]
-                        del worker_params[f"gp{gid}"]
-                        worker_params_list[wid] = worker_params
-                total_KS_jobs = len(worker_params_list)
-
-            worker_ids = np.arange(total_KS_jobs)
-            torch_device_ids = [
-                str(
-                    full_config["Sorting"]["GPU_to_use"][
-                        wid % len(full_config["Sorting"]["GPU_to_use"])
-                    ]
-                )
-                for wid in worker_ids
-            ]
-            # ensure proper configuration for parallel jobs
-            if full_config["Sorting"]["num_KS_jobs"] > 1:
-                assert (
-                    full_config["Sorting"]["do_KS_param_sweep"] == 1
-                ), "Parallel jobs can only be used when do_KS_param_sweep is set to True. Set num_KS_jobs to 1 if do_KS_param_sweep is False."
-            # create new folder for each parallel job to store results temporarily
-            these_configs = []
-            recording_list = []
-            # loop through each parallel job and create separate config files for each
-            for wid in worker_ids:
-                # create new folder for each parallel job
-                zfill_amount = len(str(full_config["Sorting"]["num_KS_jobs"]))
-                tmp_sorted_folder = (
-                    this_group_sorted_folder.as_posix()
-                    + "_wkr"
-                    + str(wid).zfill(zfill_amount)
-                )
-                if Path(tmp_sorted_folder).exists():
-                    shutil.rmtree(tmp_sorted_folder, ignore_errors=True)
-                # Path(tmp_sorted_folder).mkdir(parents=True, exist_ok=True)
-                recording_list.append(preproc_recording)
-                # create a new config file for each parallel job
-                this_config = deepcopy(full_config)
-                this_config["Sorting"]["sorted_folder"] = tmp_sorted_folder
-                if full_config["Sorting"]["do_KS_param_sweep"] == 1:
-                    # overwrite keys only if parameter sweep is enabled
-                    keys = worker_params_list[wid].keys()
-                    try:
-                        for key in keys:
-                            this_config["KS"][key] = worker_params_list[wid][key]
-                    except KeyError as e:
-                        print(
-                            "Incorrect variable encountered in KS_params_to_sweep. Check the variables or ensure you're using the latest EMUsort release"
-                        )
-                        raise e
-
-                this_config["num_chans"] = preproc_recording.get_num_channels()
-                this_config["sort_type"] = "ks4" if args.ks4 else "emu"
-                this_config["KS"]["nearest_chans"] = min(
-                    this_config["num_chans"], this_config["KS"]["nearest_chans"]
-                )  # do not let nearest_chans exceed the number of channels
-                this_config["KS"]["nearest_templates"] = min(
-                    this_config["num_chans"], this_config["KS"]["nearest_templates"]
-                )  # do not let nearest_templates exceed the number of channels
-                if this_config["KS"]["torch_device"] == "auto":
-                    this_config["KS"]["torch_device"] = (
-                        "cuda:" + torch_device_ids[wid] if is_available() else "cpu"
-                    )
-                if this_config["KS"]["torch_device"] == "cpu":
-                    print(
-                        f"Using CPU for Kilosort. Runtimes will be MUCH slower. If trying CUDA, make sure GPU(s) can be detected."
-                    )
-                this_config["emg_chans_used"] = (
-                    preproc_recording.get_channel_ids().tolist()
-                )
+        # Now print the results in order
+        for result in results:
+            print(result["report"])
+        for result in results:
+            print(result["phy_msg"])
 
-                these_configs.append(this_config)
+        if full_config["Sorting"]["engine"] == "queue" and not args.worker:
+            print(
+                f"Jobs are queued in {get_job_queue_folder(full_config)}, start workers with:\n"
+                f"emusort --worker --folder {Path(full_config['Data']['session_folder']).as_posix()}"
+            )
 
-            job_list = [
-                {
-                    "sorter_name": "kilosort4",
-                    "recording": recording_list[wid],
-                    "output_folder": these_configs[wid]["Sorting"]["sorted_folder"],
-                    **these_configs[wid]["KS"],
-                }
-                for wid in range(total_KS_jobs)
-            ]
+    # Run jobs from the job queue, e.g., on other machines sharing the session folder
+    if args.worker:
+        run_queue_worker(
+            get_job_queue_folder(full_config),
+            full_config["Sorting"]["job_lease_duration"],
+        )
 
-            # update the max resource limits to fix the "Too many open files" error during
-            # asynchronous writes at the end of sorting. This change allows higher values
-            # to be set for the max_concurrent_tasks value in the emu_config.yaml file
-            if platform.system() in ("Linux", "Darwin"):
-                try:
-                    import resource
+    # Rescore existing results without re-sorting
+    output_folder = Path(
+        full_config["Sorting"]["output_folder"] or full_config["Data"]["session_folder"]
+    ).expanduser()
+    rescored = None
+    if args.rescore:
+        rescored = rescore_result_folders(
+            get_selected_result_folders(args, output_folder),
+            max_workers=full_config["SI"]["max_concurrent_tasks"],
+        )
 
-                    # Based on SI implementation, we need 1 permitted open file per cluster, per sort
-                    # 1000 should be well above the upper limit of clusters identified in each sort
-                    overestimated_num_resources_needed = int(
-                        round(1000 * this_config["SI"]["max_concurrent_tasks"])
-                    )
-                    original_resource_limits = resource.getrlimit(resource.RLIMIT_NOFILE)
-                    if original_resource_limits[0] < overestimated_num_resources_needed:
-                        resource.setrlimit(
-                            resource.RLIMIT_NOFILE,
-                            (
-                                overestimated_num_resources_needed,
-                                overestimated_num_resources_needed,
-                            ),
-                        )
-                        updated_resource_limits = resource.getrlimit(resource.RLIMIT_NOFILE)
-                        print(
-                            f"Updated resource limit from {original_resource_limits[0]} to {updated_resource_limits[0]}"
-                        )
-                except Exception as e:
-                    print(f"Could not set the new resource limits because:\n{e}")
-                    print(
-                        "You may need lower max_concurrent_tasks in emu_config.yaml,"
-                        " if 'Too many open files' error occurs during saving of results"
-                    )
+    # Find redundant parameter settings by comparing the results with each other
+    if args.compare:
+        compare_result_folders(
+            get_selected_result_folders(args, output_folder, rescored),
+            output_folder / "emusort_comparison.npz",
+        )
 
-            print("Starting sorting jobs...")
-            msgs = run_KS_sorting(job_list, these_configs)
+    # Check how well the fast template-based scoring agrees with the waveform-based scoring
+    if args.compare_scoring:
+        compare_scoring_methods(
+            get_selected_result_folders(args, output_folder, rescored),
+            output_folder / "emusort_scoring_comparison.json",
+        )
 
-            # Now print the results in order
-            for msg in msgs:
-                print(msg[0])
-            for msg in msgs:
-                print(msg[1])
+    # Export Phy features of selected results, after rescoring so the ranking is current
+    if args.export_pcs:
+        export_result_folders(
+            get_selected_result_folders(args, output_folder, rescored),
+            top_k=args.top_k,
+            max_workers=full_config["SI"]["max_concurrent_tasks"],
+            memory_budget=get_memory_budget(full_config),
+        )
 
     # Print status and time elapsed
     print("Pipeline finished! You've earned a break.")
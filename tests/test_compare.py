@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from emusort.emusort import compute_unit_agreement, get_sorting_similarity
+
+
+def brute_force_agreement(times1, clusters1, times2, clusters2, delta_frames):
+    # reference implementation, comparing every spike with every other spike
+    unit_ids1, unit_ids2 = np.unique(clusters1), np.unique(clusters2)
+    agreement = np.zeros((len(unit_ids1), len(unit_ids2)))
+    for i, unit1 in enumerate(unit_ids1):
+        for j, unit2 in enumerate(unit_ids2):
+            unit_times1 = times1[clusters1 == unit1]
+            unit_times2 = times2[clusters2 == unit2]
+            matches = sum(
+                np.any(np.abs(unit_times2 - t) <= delta_frames) for t in unit_times1
+            )
+            total = len(unit_times1) + len(unit_times2) - matches
+            agreement[i, j] = matches / total if total > 0 else 0
+    return unit_ids1, unit_ids2, agreement
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_unit_agreement_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    # unsorted spike times with dense bursts, so spikes have several neighbors
+    times1 = rng.integers(0, 2000, 300)
+    clusters1 = rng.choice([1, 4, 7], 300)
+    times2 = np.concatenate([times1[:150] + rng.integers(-3, 4, 150), times1[:50]])
+    clusters2 = rng.choice([0, 2], 200)
+    result = compute_unit_agreement(times1, clusters1, times2, clusters2, 2)
+    expected = brute_force_agreement(times1, clusters1, times2, clusters2, 2)
+    for values, expected_values in zip(result, expected):
+        np.testing.assert_allclose(values, expected_values)
+
+
+def test_unit_agreement_of_identical_sortings():
+    times = np.array([10, 50, 51, 300])
+    clusters = np.array([0, 1, 0, 1])
+    _, _, agreement = compute_unit_agreement(times, clusters, times, clusters, 0)
+    np.testing.assert_array_equal(agreement, np.eye(2))
+    assert get_sorting_similarity(agreement) == 1.0
+
+
+def test_unit_agreement_without_spikes():
+    times = np.array([10, 50])
+    clusters = np.array([3, 5])
+    empty = np.zeros(0, dtype=np.int64)
+    unit_ids1, unit_ids2, agreement = compute_unit_agreement(
+        times, clusters, empty, empty, 2
+    )
+    np.testing.assert_array_equal(unit_ids1, [3, 5])
+    assert len(unit_ids2) == 0
+    assert agreement.shape == (2, 0)
+    assert get_sorting_similarity(agreement) == 0.0
+    assert get_sorting_similarity(np.zeros((0, 0))) == 1.0
+
+
+def test_sorting_similarity_ignores_poor_matches():
+    agreement = np.array([[0.9, 0.0], [0.0, 0.01]])
+    assert get_sorting_similarity(agreement) == pytest.approx(0.9 / 2)
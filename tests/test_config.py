@@ -0,0 +1,46 @@
+from emusort.emusort import fill_config_defaults
+
+
+def make_template():
+    return {
+        "Data": {"emg_recordings": [0], "time_range": [0, 0]},
+        "Sorting": {
+            "num_KS_jobs": 1,
+            "KS_params_to_sweep": {"Th_universal": [9, 10], "nblocks": [0, 1]},
+        },
+        "KS": {"Th_universal": 9, "nblocks": 0},
+    }
+
+
+def test_fill_config_defaults_adds_missing_settings():
+    full_config = {
+        "Data": {"emg_recordings": [1, 2]},
+        "Sorting": {"num_KS_jobs": 4},
+    }
+    filled = fill_config_defaults(full_config, make_template())
+    assert filled == ["Data.time_range", "Sorting.KS_params_to_sweep", "KS"]
+    assert full_config == {
+        "Data": {"emg_recordings": [1, 2], "time_range": [0, 0]},
+        "Sorting": {
+            "num_KS_jobs": 4,
+            "KS_params_to_sweep": {"Th_universal": [9, 10], "nblocks": [0, 1]},
+        },
+        "KS": {"Th_universal": 9, "nblocks": 0},
+    }
+
+
+def test_fill_config_defaults_keeps_user_mappings():
+    # a sweep over fewer parameters than the template's must not be extended
+    full_config = make_template()
+    full_config["Sorting"]["KS_params_to_sweep"] = {"Th_learned": [7, 8]}
+    assert fill_config_defaults(full_config, make_template()) == []
+    assert full_config["Sorting"]["KS_params_to_sweep"] == {"Th_learned": [7, 8]}
+
+
+def test_fill_config_defaults_copies_values():
+    template = make_template()
+    full_config = {}
+    fill_config_defaults(full_config, template)
+    full_config["Data"]["emg_recordings"].append(3)
+    full_config["Sorting"]["KS_params_to_sweep"]["nblocks"].append(2)
+    assert template == make_template()
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from emusort.emusort import get_time_window_epochs, map_to_original_frames
+
+
+def make_data_config(time_windows, padding=0, session_folder=""):
+    return {
+        "time_windows": time_windows,
+        "time_window_padding": padding,
+        "session_folder": session_folder,
+    }
+
+
+def test_epochs_from_listed_windows():
+    epochs = get_time_window_epochs(
+        make_data_config([[1, 2], [4, 4.5]]), [10_000], 1000
+    )
+    np.testing.assert_array_equal(
+        epochs, [[0, 1000, 2000, 1000, 0], [0, 4000, 4500, 4000, 1000]]
+    )
+
+
+def test_epochs_are_padded_merged_and_clipped():
+    # the padded windows overlap, and the first and last reach past the recording
+    epochs = get_time_window_epochs(
+        make_data_config([[8, 9.8], [0.2, 1], [1.5, 2]], padding=0.5), [10_000], 1000
+    )
+    np.testing.assert_array_equal(
+        epochs, [[0, 0, 2500, 0, 0], [0, 7500, 10_000, 7500, 2500]]
+    )
+
+
+def test_epochs_of_several_recordings():
+    epochs = get_time_window_epochs(
+        make_data_config([[1, 0, 1], [0, 2, 3], [1, 2, 2.5]]), [5000, 4000], 1000
+    )
+    # original start frames count from the start of the first selected recording
+    np.testing.assert_array_equal(
+        epochs,
+        [
+            [0, 2000, 3000, 2000, 0],
+            [1, 0, 1000, 5000, 1000],
+            [1, 2000, 2500, 7000, 2000],
+        ],
+    )
+
+
+def test_epochs_from_events_file(tmp_path):
+    (tmp_path / "events.txt").write_text("# event times\n3\n1.0\n\n4.5,5\n")
+    epochs = get_time_window_epochs(
+        make_data_config("events.txt", padding=0.25, session_folder=tmp_path),
+        [10_000],
+        1000,
+    )
+    np.testing.assert_array_equal(
+        epochs,
+        [
+            [0, 750, 1250, 750, 0],
+            [0, 2750, 3250, 2750, 500],
+            [0, 4250, 5250, 4250, 1000],
+        ],
+    )
+
+
+def test_single_events_need_padding():
+    with pytest.raises(AssertionError):
+        get_time_window_epochs(make_data_config([[3]]), [10_000], 1000)
+
+
+def test_epochs_reject_malformed_rows():
+    with pytest.raises(ValueError):
+        get_time_window_epochs(make_data_config([[0, 1, 2, 3]]), [10_000], 1000)
+
+
+def test_epochs_reject_windows_outside_recordings():
+    with pytest.raises(AssertionError):
+        get_time_window_epochs(make_data_config([[20, 21]]), [10_000], 1000)
+    with pytest.raises(AssertionError):
+        get_time_window_epochs(make_data_config([[2, 0, 1]]), [10_000], 1000)
+
+
+def test_map_to_original_frames():
+    epochs = get_time_window_epochs(
+        make_data_config([[1, 0, 1], [0, 2, 3], [1, 2, 2.5]]), [5000, 4000], 1000
+    )
+    spike_times = np.array([0, 999, 1000, 1500, 2000, 2499])
+    np.testing.assert_array_equal(
+        map_to_original_frames(spike_times, epochs),
+        [2000, 2999, 5000, 5500, 7000, 7499],
+    )
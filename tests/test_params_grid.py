@@ -0,0 +1,121 @@
+import pytest
+from sklearn.model_selection import ParameterGrid
+
+from emusort.emusort import get_worker_params_grid
+
+
+def make_config(KS_params_to_sweep, linked_params_for_sweep=None):
+    return {
+        "Sorting": {
+            "do_KS_param_sweep": True,
+            "KS_params_to_sweep": KS_params_to_sweep,
+            "linked_params_for_sweep": linked_params_for_sweep,
+        },
+        "KS": {
+            "Th_universal": 9,
+            "Th_learned": 8,
+            "Th_single_ch": 6,
+            "nblocks": 0,
+            "acg_threshold": 0.2,
+        },
+    }
+
+
+def eager_worker_params_list(KS_params_to_sweep, linked_param_groups_list):
+    # the grid as it was built before it was generated on demand, holding all combinations
+    KS_params_to_sweep = dict(KS_params_to_sweep)
+    orig_keys = list(KS_params_to_sweep.keys())
+    for gid, linked_params_keys in enumerate(linked_param_groups_list):
+        KS_params_to_sweep[f"gp{gid}"] = [
+            list(gval)
+            for gval in zip(
+                *(KS_params_to_sweep[k] for k in orig_keys if k in linked_params_keys)
+            )
+        ]
+        for key in linked_params_keys:
+            del KS_params_to_sweep[key]
+    worker_params_list = list(ParameterGrid(KS_params_to_sweep))
+    for worker_params in worker_params_list:
+        for gid, linked_params_keys in enumerate(linked_param_groups_list):
+            linked_keys = [k for k in orig_keys if k in linked_params_keys]
+            for key, param_key in enumerate(linked_keys):
+                worker_params[param_key] = worker_params[f"gp{gid}"][key]
+            del worker_params[f"gp{gid}"]
+    return worker_params_list
+
+
+@pytest.mark.parametrize(
+    "KS_params_to_sweep, linked_params_for_sweep",
+    [
+        ({"Th_universal": [7, 8, 9]}, None),
+        ({"Th_universal": [7, 8, 9], "nblocks": [0, 1]}, None),
+        (
+            {
+                "Th_universal": [7, 8, 9],
+                "Th_learned": [6, 7, 8],
+                "Th_single_ch": [[4, 6], [6]],
+                "acg_threshold": [0.1, 0.2],
+            },
+            [["Th_universal", "Th_learned"]],
+        ),
+        (
+            {
+                # linked keys listed in another order than in KS_params_to_sweep
+                "Th_universal": [7, 8],
+                "Th_learned": [6, 7],
+                "nblocks": [0, 1],
+                "acg_threshold": [0.1, 0.2],
+                "Th_single_ch": [5, 6, 7],
+            },
+            [["Th_learned", "Th_universal"], ["acg_threshold", "nblocks"]],
+        ),
+    ],
+)
+def test_worker_params_grid_matches_eager_grid(
+    KS_params_to_sweep, linked_params_for_sweep
+):
+    grid = get_worker_params_grid(
+        make_config(KS_params_to_sweep, linked_params_for_sweep)
+    )
+    expected = eager_worker_params_list(
+        KS_params_to_sweep, linked_params_for_sweep or []
+    )
+    assert len(grid) == len(expected)
+    for wid, worker_params in enumerate(expected):
+        assert grid[wid] == worker_params
+    assert list(grid) == expected
+
+
+def test_worker_params_grid_indexing_does_not_share_state():
+    grid = get_worker_params_grid(
+        make_config(
+            {"Th_universal": [7, 8], "Th_learned": [6, 7]},
+            [["Th_universal", "Th_learned"]],
+        )
+    )
+    grid[0]["Th_universal"] = 100
+    assert grid[0] == {"Th_universal": 7, "Th_learned": 6}
+    assert grid[1] == {"Th_universal": 8, "Th_learned": 7}
+
+
+def test_worker_params_grid_out_of_range():
+    grid = get_worker_params_grid(make_config({"Th_universal": [7, 8, 9]}))
+    with pytest.raises(IndexError):
+        grid[3]
+    with pytest.raises(IndexError):
+        grid[-1]
+
+
+def test_worker_params_grid_without_sweep():
+    config = make_config({"Th_universal": [7, 8, 9]})
+    config["Sorting"]["do_KS_param_sweep"] = False
+    assert get_worker_params_grid(config) == [{}]
+
+
+def test_worker_params_grid_rejects_unequal_linked_params():
+    config = make_config(
+        {"Th_universal": [7, 8, 9], "Th_learned": [6, 7]},
+        [["Th_universal", "Th_learned"]],
+    )
+    with pytest.raises(AssertionError):
+        get_worker_params_grid(config)
@@ -0,0 +1,90 @@
+import numpy as np
+import spikeinterface as si
+
+from emusort.emusort import (
+    INT16_MAX,
+    get_quantization_params,
+    load_group_quantization_params,
+    write_quantized_recording,
+)
+
+
+def make_recording():
+    rng = np.random.default_rng(0)
+    traces = np.stack(
+        [
+            # a large, a small and an offset channel, and a flat one
+            rng.normal(0, 500, 1000),
+            rng.normal(0, 0.01, 1000),
+            rng.normal(300, 20, 1000),
+            np.full(1000, 7.0),
+        ],
+        axis=1,
+    ).astype(np.float32)
+    return si.NumpyRecording([traces], 1000.0), traces
+
+
+def test_quantization_params_cover_range():
+    recording, traces = make_recording()
+    gains, offsets = get_quantization_params(recording)
+    quantized = (traces - offsets) / gains
+    assert np.all(np.abs(quantized) <= INT16_MAX)
+    # the range of every varying channel is almost fully used
+    assert np.all(np.abs(quantized[:, :3]).max(axis=0) > 0.99 * INT16_MAX)
+    assert gains[3] == 1.0
+    assert offsets[3] == 7.0
+
+
+def test_quantization_params_are_cached():
+    recording, _ = make_recording()
+    gains, offsets = get_quantization_params(recording)
+    np.testing.assert_array_equal(recording.get_property("quantization_gain"), gains)
+    np.testing.assert_array_equal(
+        recording.get_property("quantization_offset"), offsets
+    )
+    recording.set_property("quantization_gain", 2 * gains)
+    np.testing.assert_array_equal(get_quantization_params(recording)[0], 2 * gains)
+
+
+def test_quantized_recording_round_trip(tmp_path):
+    recording, traces = make_recording()
+    gains, offsets = get_quantization_params(recording)
+    file_path = tmp_path / "recording.dat"
+    stats = write_quantized_recording(recording, file_path, gains, offsets)
+    assert stats["clipped_samples"] == 0
+
+    # dequantized as Phy and the Kilosort GUI read the int16 file
+    quantized = np.memmap(file_path, dtype=np.int16, mode="r", shape=traces.shape)
+    restored = quantized * gains + offsets
+    assert np.all(np.abs(restored - traces) <= gains / 2 * 1.001 + 1e-6)
+    np.testing.assert_allclose(
+        stats["max_error"], np.abs(restored - traces).max(axis=0), rtol=1e-5
+    )
+
+
+def test_quantized_recording_reports_clipping(tmp_path):
+    recording, traces = make_recording()
+    gains, offsets = get_quantization_params(recording)
+    stats = write_quantized_recording(
+        recording, tmp_path / "recording.dat", gains / 2, offsets
+    )
+    assert stats["clipped_samples"] > 0
+    assert stats["max_error"][0] > gains[0]
+
+
+def test_group_quantization_params_are_saved(tmp_path):
+    recording, _ = make_recording()
+    quantization_path = tmp_path / "quantization.npy"
+    load_group_quantization_params(recording, quantization_path)
+    gains = recording.get_property("quantization_gain")
+    offsets = recording.get_property("quantization_offset")
+
+    # reusing the preprocessed data loads the saved parameters
+    reused_recording, _ = make_recording()
+    load_group_quantization_params(reused_recording, quantization_path)
+    np.testing.assert_array_equal(
+        reused_recording.get_property("quantization_gain"), gains
+    )
+    np.testing.assert_array_equal(
+        reused_recording.get_property("quantization_offset"), offsets
+    )
@@ -0,0 +1,158 @@
+import json
+import os
+import time
+
+import pytest
+
+from emusort.emusort import (
+    QUEUE_MAX_ATTEMPTS,
+    claim_queued_job,
+    enqueue_sorting_jobs,
+    get_queue_counts,
+    get_queued_job_name,
+    release_claimed_job,
+    requeue_lost_jobs,
+)
+
+LEASE_DURATION = 60
+
+
+@pytest.fixture
+def queue_folder(tmp_path):
+    queue_folder = tmp_path / "emusort_queue"
+    enqueue_sorting_jobs(
+        queue_folder,
+        {"Sorting": {}},
+        0,
+        tmp_path / "preprocessed_data" / "g0",
+        tmp_path / "sorted_g0",
+        3,
+        "emu",
+        job_order=[2, 0, 1],
+    )
+    return queue_folder
+
+
+def expire_lease(claimed_path):
+    # leases are the modification times of the claimed files
+    stale_time = time.time() - 2 * LEASE_DURATION
+    os.utime(claimed_path, (stale_time, stale_time))
+
+
+def read_spec(queue_folder, state, claimed_path):
+    return json.loads(
+        (queue_folder / state / get_queued_job_name(claimed_path)).read_text()
+    )
+
+
+def test_enqueue_writes_pending_jobs(queue_folder):
+    assert get_queue_counts(queue_folder) == {
+        "pending": 3,
+        "claimed": 0,
+        "done": 0,
+        "failed": 0,
+    }
+    assert (queue_folder / "queue_config.yaml").exists()
+
+
+def test_claims_follow_job_order(queue_folder):
+    claimed_wids = []
+    while (claimed_path := claim_queued_job(queue_folder, "host:1")) is not None:
+        claimed_wids.append(json.loads(claimed_path.read_text())["wid"])
+    assert claimed_wids == [2, 0, 1]
+    assert get_queue_counts(queue_folder)["claimed"] == 3
+
+
+def test_claimed_path_names_the_worker(queue_folder):
+    claimed_path = claim_queued_job(queue_folder, "host:1")
+    assert claimed_path.parent == queue_folder / "claimed"
+    assert "@host_1_" in claimed_path.name
+    assert not (queue_folder / "pending" / get_queued_job_name(claimed_path)).exists()
+
+
+def test_release_moves_job_with_its_spec(queue_folder):
+    claimed_path = claim_queued_job(queue_folder, "host:1")
+    job_spec = json.loads(claimed_path.read_text())
+    job_spec["attempts"] += 1
+    job_spec["result_folder"] = "sorted_g0_wkr2"
+    assert release_claimed_job(queue_folder, claimed_path, "done", job_spec)
+    assert not claimed_path.exists()
+    assert read_spec(queue_folder, "done", claimed_path) == job_spec
+    assert get_queue_counts(queue_folder)["done"] == 1
+    # no temporary files are left behind
+    assert list((queue_folder / "done").iterdir()) == [
+        queue_folder / "done" / get_queued_job_name(claimed_path)
+    ]
+
+
+def test_requeue_keeps_renewed_leases(queue_folder):
+    claimed_path = claim_queued_job(queue_folder, "host:1")
+    assert requeue_lost_jobs(queue_folder, LEASE_DURATION) == 0
+    assert claimed_path.exists()
+
+
+def test_requeue_counts_lost_attempts(queue_folder):
+    claimed_path = claim_queued_job(queue_folder, "host:1")
+    expire_lease(claimed_path)
+    assert requeue_lost_jobs(queue_folder, LEASE_DURATION) == 1
+    job_spec = read_spec(queue_folder, "pending", claimed_path)
+    assert job_spec["attempts"] == 1
+    assert "expired" in job_spec["error"]
+
+
+def test_job_lost_too_often_fails(queue_folder):
+    # a job which crashes every worker running it must not be retried forever
+    for attempt in range(1, QUEUE_MAX_ATTEMPTS + 1):
+        claimed_path = claim_queued_job(queue_folder, f"host:{attempt}")
+        assert json.loads(claimed_path.read_text())["wid"] == 2
+        expire_lease(claimed_path)
+        num_requeued = requeue_lost_jobs(queue_folder, LEASE_DURATION)
+        assert num_requeued == (attempt < QUEUE_MAX_ATTEMPTS)
+    job_spec = read_spec(queue_folder, "failed", claimed_path)
+    assert job_spec["attempts"] == QUEUE_MAX_ATTEMPTS
+    assert get_queue_counts(queue_folder) == {
+        "pending": 2,
+        "claimed": 0,
+        "done": 0,
+        "failed": 1,
+    }
+
+
+def test_stale_release_does_not_touch_new_claim(queue_folder):
+    # the first worker's lease expires, and another worker claims the job again
+    first_claim = claim_queued_job(queue_folder, "host:1")
+    first_spec = json.loads(first_claim.read_text())
+    expire_lease(first_claim)
+    requeue_lost_jobs(queue_folder, LEASE_DURATION)
+    second_claim = claim_queued_job(queue_folder, "host:2")
+    assert get_queued_job_name(second_claim) == get_queued_job_name(first_claim)
+    assert second_claim != first_claim
+    second_spec = json.loads(second_claim.read_text())
+
+    # the first worker finishes late, which must not move or overwrite the new claim
+    assert not release_claimed_job(queue_folder, first_claim, "done", first_spec)
+    assert second_claim.exists()
+    assert json.loads(second_claim.read_text()) == second_spec
+    assert get_queue_counts(queue_folder)["done"] == 0
+
+
+def test_enqueue_refuses_running_queue(queue_folder, tmp_path):
+    claim_queued_job(queue_folder, "host:1")
+    args = (
+        queue_folder,
+        {"Sorting": {}},
+        0,
+        tmp_path / "preprocessed_data" / "g0",
+        tmp_path / "sorted_g0",
+        2,
+        "emu",
+    )
+    with pytest.raises(AssertionError):
+        enqueue_sorting_jobs(*args)
+    enqueue_sorting_jobs(*args, clear_queue=True)
+    assert get_queue_counts(queue_folder) == {
+        "pending": 2,
+        "claimed": 0,
+        "done": 0,
+        "failed": 0,
+    }
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from emusort.emusort import (
+    adjust_KS_params_for_resampling,
+    get_resample_rate,
+    map_to_native_frames,
+)
+
+RESAMPLING = {"native_sampling_frequency": 30000.0, "sampling_frequency": 12500}
+
+
+def make_data_config(resample_rate, emg_passband=(250, 5000)):
+    return {"resample_rate": resample_rate, "emg_passband": list(emg_passband)}
+
+
+def test_resample_rate_from_passband():
+    assert get_resample_rate(make_data_config("auto"), 30000.0) == 12500
+    # rounded up to a multiple of RESAMPLE_RATE_STEP
+    assert get_resample_rate(make_data_config("auto", (250, 4100)), 30000.0) == 10500
+
+
+def test_resample_rate_given_in_hz():
+    assert get_resample_rate(make_data_config(15000.0), 30000.0) == 15000
+
+
+def test_no_resampling_unless_below_native_rate():
+    assert get_resample_rate(make_data_config(None), 30000.0) is None
+    assert get_resample_rate(make_data_config("auto"), 12500.0) is None
+    assert get_resample_rate(make_data_config(40000), 30000.0) is None
+
+
+def test_resample_rate_must_keep_passband():
+    with pytest.raises(AssertionError):
+        get_resample_rate(make_data_config(10000), 30000.0)
+    with pytest.raises(AssertionError):
+        get_resample_rate(make_data_config("fast"), 30000.0)
+
+
+def test_KS_params_keep_their_duration():
+    ks_config = {"nt": 61, "batch_size": 60000, "nt0min": 20, "duplicate_spike_bins": 7}
+    adjust_KS_params_for_resampling(ks_config, RESAMPLING)
+    assert ks_config == {
+        "nt": 25,
+        "batch_size": 25000,
+        "nt0min": 8,
+        "duplicate_spike_bins": 3,
+    }
+
+
+@pytest.mark.parametrize("nt", [61, 64, 81, 90])
+def test_resampled_nt_stays_odd(nt):
+    ks_config = {"nt": nt}
+    adjust_KS_params_for_resampling(ks_config, RESAMPLING)
+    assert ks_config["nt"] % 2 == 1
+    assert abs(ks_config["nt"] - nt * 12500 / 30000) <= 1
+
+
+def test_unset_KS_params_are_kept():
+    ks_config = {"nt": 61, "nt0min": None, "duplicate_spike_bins": 0}
+    adjust_KS_params_for_resampling(ks_config, RESAMPLING)
+    assert ks_config["nt0min"] is None
+    assert ks_config["duplicate_spike_bins"] == 0
+
+
+def test_map_to_native_frames():
+    spike_times = np.array([0, 1, 5, 12499, 12500])
+    np.testing.assert_array_equal(
+        map_to_native_frames(spike_times, RESAMPLING), [0, 2, 12, 29998, 30000]
+    )
@@ -0,0 +1,43 @@
+import pytest
+
+from emusort.emusort import read_params_py
+
+
+def test_read_params_py(tmp_path):
+    # written like write_rec_and_params writes it
+    params_path = tmp_path / "params.py"
+    params_path.write_text(
+        "dat_path = r'recording.dat'\n"
+        "n_channels_dat = 16\n"
+        "dtype = 'int16'\n"
+        "quantization_gain = [0.5, 0.25]\n"
+        "quantization_offset = [-1.0, 2.0]\n"
+        "offset = 0\n"
+        "sample_rate = 30000.0\n"
+        "hp_filtered = True"
+    )
+    assert read_params_py(params_path) == {
+        "dat_path": "recording.dat",
+        "n_channels_dat": 16,
+        "dtype": "int16",
+        "quantization_gain": [0.5, 0.25],
+        "quantization_offset": [-1.0, 2.0],
+        "offset": 0,
+        "sample_rate": 30000.0,
+        "hp_filtered": True,
+    }
+
+
+def test_read_params_py_skips_other_statements(tmp_path):
+    params_path = tmp_path / "params.py"
+    params_path.write_text("import os\n# comment\nsample_rate = 1000\n")
+    assert read_params_py(params_path) == {"sample_rate": 1000}
+
+
+def test_read_params_py_does_not_execute_code(tmp_path):
+    marker = tmp_path / "executed"
+    params_path = tmp_path / "params.py"
+    params_path.write_text(f"dat_path = open(r'{marker}', 'w').name\n")
+    with pytest.raises(ValueError):
+        read_params_py(params_path)
+    assert not marker.exists()
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from emusort.emusort import (
+    append_runtime_history,
+    fit_runtime_model,
+    get_job_order,
+    get_makespan,
+    load_runtime_history,
+    predict_sort_seconds,
+)
+
+KS_DEFAULTS = {"Th_single_ch": 6, "Th_universal": 9, "Th_learned": 8}
+
+
+def make_record(sort_s, num_samples=30_000, num_chans=8, **KS_params):
+    return {
+        "num_samples": num_samples,
+        "num_chans": num_chans,
+        "KS": {**KS_DEFAULTS, **KS_params},
+        "sort_s": sort_s,
+    }
+
+
+def test_runtime_model_prior_without_history():
+    coefficients = fit_runtime_model([], seconds_per_sample=1e-6)
+    assert predict_sort_seconds(coefficients, 1000, 10, KS_DEFAULTS) == pytest.approx(
+        1e-2
+    )
+    # lower thresholds and more of them are predicted to take longer
+    assert predict_sort_seconds(
+        coefficients, 1000, 10, {**KS_DEFAULTS, "Th_universal": 4.5}
+    ) == pytest.approx(2e-2)
+    assert predict_sort_seconds(
+        coefficients, 1000, 10, {**KS_DEFAULTS, "Th_single_ch": [4, 5, 6]}
+    ) == pytest.approx(3e-2)
+
+
+def test_runtime_model_follows_history():
+    rng = np.random.default_rng(0)
+    # measured runtimes 10 times the prior, growing steeply as Th_universal is lowered
+    history = []
+    for _ in range(1000):
+        Th_universal = rng.uniform(5, 12)
+        history.append(
+            make_record(
+                1e-5 * 240_000 * (9 / Th_universal) ** 3, Th_universal=Th_universal
+            )
+        )
+    coefficients = fit_runtime_model(history, seconds_per_sample=1e-6)
+    assert predict_sort_seconds(coefficients, 240_000, 1, KS_DEFAULTS) == pytest.approx(
+        2.4, rel=0.05
+    )
+    assert coefficients[2] == pytest.approx(-3, rel=0.1)
+
+
+def test_runtime_model_skips_invalid_records():
+    history = [make_record(0), make_record(5, num_samples=0)]
+    np.testing.assert_array_equal(
+        fit_runtime_model(history, 1e-6), fit_runtime_model([], 1e-6)
+    )
+
+
+def test_runtime_history_round_trip(tmp_path):
+    jobs = [
+        {
+            "num_samples": 1000,
+            "num_chans": 4,
+            "sampling_frequency": 30000.0,
+            "KS": {"Th_universal": np.float64(8.0), "nblocks": 0},
+            "durations": {"sorting": 12.5},
+            "state": "done",
+        },
+        # failed and unsorted jobs are not part of the history
+        {"durations": {"sorting": 3.0}, "state": "failed"},
+        {"durations": {}, "state": "pending"},
+    ]
+    append_runtime_history(tmp_path, jobs)
+    with (tmp_path / "emusort_runtime_history.jsonl").open("a") as f:
+        f.write('{"num_samples": 10')
+    history = load_runtime_history(tmp_path)
+    assert len(history) == 1
+    assert history[0]["KS"] == {"Th_universal": 8.0}
+    assert history[0]["sort_s"] == 12.5
+
+
+def test_job_order_longest_first():
+    assert get_job_order([1.0, 5.0, 2.0, 5.0, 3.0]) == [1, 3, 4, 2, 0]
+    assert get_job_order([]) == []
+
+
+def test_job_order_shortens_makespan():
+    predicted_sort_s = [1.0, 1.0, 1.0, 1.0, 4.0]
+    ordered = [predicted_sort_s[wid] for wid in get_job_order(predicted_sort_s)]
+    assert get_makespan(predicted_sort_s, 2) == 6.0
+    assert get_makespan(ordered, 2) == 4.0
@@ -0,0 +1,210 @@
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+
+from emusort.emusort import get_time_windows, match_window_units, merge_window_sortings
+
+
+def test_time_windows_cover_recording_with_overlap():
+    windows = get_time_windows(10_000, 1000, window_duration=3, window_overlap=1)
+    assert windows[0][0] == 0
+    assert windows[-1][1] == 10_000
+    for (_, end1), (start2, _) in zip(windows[:-1], windows[1:]):
+        assert end1 - start2 == 1000
+
+
+def test_time_windows_fold_short_remainder_into_last_window():
+    # windows start every 2 s, so a last window from 8 s would only hold 1.3 s
+    windows = get_time_windows(9300, 1000, window_duration=3, window_overlap=1)
+    assert windows == [(0, 3000), (2000, 5000), (4000, 7000), (6000, 9300)]
+
+
+def test_time_windows_single_window_for_short_recording():
+    assert get_time_windows(1500, 1000, window_duration=3, window_overlap=1) == [
+        (0, 1500)
+    ]
+
+
+def test_time_windows_reject_large_overlap():
+    with pytest.raises(AssertionError):
+        get_time_windows(10_000, 1000, window_duration=2, window_overlap=1)
+
+
+def make_window(spike_times, spike_clusters, unit_templates):
+    unit_ids = np.unique(spike_clusters)
+    return {
+        "spike_times": np.asarray(spike_times, dtype=np.int64),
+        "spike_clusters": np.asarray(spike_clusters),
+        "unit_ids": unit_ids,
+        "unit_templates": np.asarray(unit_templates, dtype=float),
+    }
+
+
+def brute_force_matches(window1, window2, overlap, delta_frames, min_sim, min_agree):
+    # reference implementation, comparing every spike with every other spike
+    num_units1, num_units2 = len(window1["unit_ids"]), len(window2["unit_ids"])
+    similarity = np.zeros((num_units1, num_units2))
+    agreement = np.zeros((num_units1, num_units2))
+    for i, unit1 in enumerate(window1["unit_ids"]):
+        for j, unit2 in enumerate(window2["unit_ids"]):
+            t1 = window1["unit_templates"][i].ravel()
+            t2 = window2["unit_templates"][j].ravel()
+            similarity[i, j] = t1 @ t2 / (np.linalg.norm(t1) * np.linalg.norm(t2))
+            times1 = window1["spike_times"][window1["spike_clusters"] == unit1]
+            times2 = window2["spike_times"][window2["spike_clusters"] == unit2]
+            times1 = times1[(times1 >= overlap[0]) & (times1 < overlap[1])]
+            times2 = times2[(times2 >= overlap[0]) & (times2 < overlap[1])]
+            matches = sum(np.any(np.abs(times2 - t) <= delta_frames) for t in times1)
+            total = len(times1) + len(times2) - matches
+            agreement[i, j] = matches / total if total > 0 else 0
+    is_valid = (similarity >= min_sim) & (agreement >= min_agree)
+    rows, cols = linear_sum_assignment(-np.where(is_valid, agreement, 0))
+    return [(i, j) for i, j in zip(rows, cols) if is_valid[i, j]]
+
+
+def test_match_window_units_pairs_same_units():
+    rng = np.random.default_rng(0)
+    templates = rng.normal(size=(2, 5, 3))
+    times_a = np.arange(1000, 2000, 50)
+    times_b = np.arange(1010, 2000, 70)
+    window1 = make_window(
+        np.concatenate([times_a, times_b]),
+        np.concatenate([np.full(len(times_a), 3), np.full(len(times_b), 8)]),
+        templates,
+    )
+    # the same units with other IDs, in the other order and jittered by a frame
+    window2 = make_window(
+        np.concatenate([times_b + 1, times_a - 1]),
+        np.concatenate([np.full(len(times_b), 0), np.full(len(times_a), 5)]),
+        templates[::-1],
+    )
+    matches = match_window_units(window1, window2, (1000, 2000), 2, 0.8, 0.5)
+    assert sorted(matches) == [(0, 1), (1, 0)]
+
+
+def test_match_window_units_requires_similar_templates():
+    times = np.arange(1000, 2000, 50)
+    window1 = make_window(times, np.zeros(len(times), dtype=int), [[[1.0, 0.0]]])
+    window2 = make_window(times, np.zeros(len(times), dtype=int), [[[0.0, 1.0]]])
+    assert match_window_units(window1, window2, (1000, 2000), 2, 0.8, 0.5) == []
+
+
+def test_match_window_units_without_units():
+    window1 = make_window(np.zeros(0), np.zeros(0, dtype=int), np.zeros((0, 5, 3)))
+    window2 = make_window([1500], [0], np.ones((1, 5, 3)))
+    assert match_window_units(window1, window2, (1000, 2000), 2, 0.8, 0.5) == []
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_window_units_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    base_templates = rng.normal(size=(6, 4, 3))
+    windows = []
+    for _ in range(2):
+        # noisy copies of the same units, with dense spikes so many of them coincide
+        num_units = rng.integers(1, 7)
+        unit_ids = np.sort(rng.choice(20, num_units, replace=False))
+        num_spikes = 400
+        windows.append(
+            make_window(
+                rng.integers(0, 3000, num_spikes),
+                rng.choice(unit_ids, num_spikes),
+                base_templates[:num_units] + 0.3 * rng.normal(size=(num_units, 4, 3)),
+            )
+        )
+    args = (windows[0], windows[1], (1000, 2000), 3, 0.5, 0.05)
+    assert sorted(match_window_units(*args)) == sorted(brute_force_matches(*args))
+
+
+def save_window_output(folder, spike_times, spike_clusters, amplitudes, templates, wmi):
+    folder.mkdir(parents=True)
+    np.save(folder / "spike_times.npy", np.asarray(spike_times, dtype=np.int64))
+    np.save(folder / "spike_clusters.npy", np.asarray(spike_clusters, dtype=np.int32))
+    np.save(folder / "spike_templates.npy", np.asarray(spike_clusters, dtype=np.int32))
+    np.save(folder / "amplitudes.npy", np.asarray(amplitudes, dtype=np.float32))
+    np.save(folder / "templates.npy", np.asarray(templates, dtype=np.float32))
+    np.save(folder / "whitening_mat_inv.npy", np.asarray(wmi, dtype=np.float32))
+    return folder
+
+
+@pytest.fixture
+def window_outputs(tmp_path):
+    rng = np.random.default_rng(1)
+    template_a = rng.normal(size=(5, 3))
+    template_b = rng.normal(size=(5, 3))
+    # unit A is found in both windows, unit B only in the second one
+    times_a = np.arange(100, 2000, 100)
+    times_b = np.arange(1350, 2000, 100)
+    in_window1 = times_a < 1200
+    in_window2 = times_a >= 800
+    amplitudes_a = rng.uniform(5, 15, len(times_a))
+    window1 = save_window_output(
+        tmp_path / "w0",
+        times_a[in_window1],
+        np.zeros(in_window1.sum()),
+        amplitudes_a[in_window1],
+        template_a[None],
+        np.eye(3),
+    )
+    # the second window has its own whitening, and twice the template scale of unit A
+    wmi = np.diag([1.0, 2.0, 4.0])
+    window2 = save_window_output(
+        tmp_path / "w1",
+        np.concatenate([times_a[in_window2], times_b]) - 800,
+        np.concatenate([np.full(in_window2.sum(), 4), np.full(len(times_b), 2)]),
+        np.concatenate([amplitudes_a[in_window2] / 2, np.ones(len(times_b))]),
+        np.stack(
+            [
+                np.zeros((5, 3)),
+                np.zeros((5, 3)),
+                template_b @ np.linalg.inv(wmi),
+                np.zeros((5, 3)),
+                2 * template_a @ np.linalg.inv(wmi),
+            ]
+        ),
+        wmi,
+    )
+    return {
+        "sorter_outputs": [window1, window2],
+        "windows": [(0, 1200), (800, 2000)],
+        "times_a": times_a,
+        "times_b": times_b,
+        "amplitudes_a": amplitudes_a,
+        "template_a": template_a,
+    }
+
+
+def test_merge_window_sortings(tmp_path, window_outputs):
+    this_config = {
+        "Sorting": {"window_template_similarity": 0.8, "window_spike_agreement": 0.5}
+    }
+    merged_output = tmp_path / "merged"
+    merge_window_sortings(
+        window_outputs["sorter_outputs"],
+        window_outputs["windows"],
+        merged_output,
+        this_config,
+        num_frames=2000,
+        sampling_frequency=10_000,
+    )
+    spike_times = np.load(merged_output / "spike_times.npy")
+    spike_clusters = np.load(merged_output / "spike_clusters.npy")
+    amplitudes = np.load(merged_output / "amplitudes.npy")
+    templates = np.load(merged_output / "templates.npy")
+
+    # each spike is kept once, and unit A keeps one ID across both windows
+    times_a, times_b = window_outputs["times_a"], window_outputs["times_b"]
+    assert np.all(np.diff(spike_times) >= 0)
+    np.testing.assert_array_equal(spike_times[spike_clusters == 0], times_a)
+    np.testing.assert_array_equal(spike_times[spike_clusters == 1], times_b)
+    np.testing.assert_array_equal(np.unique(spike_clusters), [0, 1])
+
+    # amplitudes times the merged template reconstruct the spikes of both windows
+    np.testing.assert_allclose(
+        amplitudes[spike_clusters == 0, None, None] * templates[0],
+        window_outputs["amplitudes_a"][:, None, None] * window_outputs["template_a"],
+        rtol=1e-4,
+    )
+    np.testing.assert_array_equal(
+        np.load(merged_output / "whitening_mat_inv.npy"), np.eye(3)
+    )